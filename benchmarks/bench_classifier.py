@@ -0,0 +1,277 @@
+from concurrent.futures import ProcessPoolExecutor
+from unittest import mock
+
+import multiprocessing
+import numpy as np
+
+import argparse
+import itertools
+import json
+import platform
+import resource
+import sys
+import time
+import zlib
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    """Benchmark LaminiClassifier over synthetic embeddings.
+
+    Each configuration in the sweep runs in a fresh process so that its peak
+    RSS is not polluted by earlier configurations.
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark the classifier on synthetic embeddings."
+    )
+
+    parser.add_argument(
+        "--classes",
+        help="Comma separated class counts to sweep.",
+        default="10,100,1000",
+    )
+
+    parser.add_argument(
+        "--examples-per-class",
+        help="Comma separated examples per class to sweep.",
+        default="10",
+    )
+
+    parser.add_argument(
+        "--dim",
+        help="Comma separated embedding widths to sweep.",
+        default="384",
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        help="Comma separated inference batch sizes to sweep.",
+        default="1,32",
+    )
+
+    parser.add_argument(
+        "--repeat",
+        help="The number of times each inference call is timed.",
+        type=int,
+        default=5,
+    )
+
+    parser.add_argument(
+        "--output",
+        help="The JSON file to write the results to.",
+        default="bench_results.json",
+    )
+
+    parser.add_argument(
+        "--compare",
+        help="Compare two result files, BASELINE CURRENT, instead of running.",
+        nargs=2,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--threshold",
+        help="The relative slowdown that counts as a regression.",
+        type=float,
+        default=0.1,
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if args.compare is not None:
+        regressions = compare(args.compare[0], args.compare[1], args.threshold)
+        sys.exit(1 if len(regressions) > 0 else 0)
+
+    cases = list(
+        itertools.product(
+            parse_ints(args.classes),
+            parse_ints(args.examples_per_class),
+            parse_ints(args.dim),
+        )
+    )
+
+    results = []
+    context = multiprocessing.get_context("spawn")
+    for classes, examples_per_class, dim in cases:
+        logger.info(
+            f"Benchmarking {classes} classes, {examples_per_class} examples per class, width {dim}"
+        )
+        with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+            results += pool.submit(
+                run_case,
+                classes,
+                examples_per_class,
+                dim,
+                parse_ints(args.batch_size),
+                args.repeat,
+            ).result()
+
+    report = {
+        "machine": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "processor": platform.processor(),
+        },
+        "results": results,
+    }
+
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+
+    for result in results:
+        print(format_result(result))
+
+    logger.info(f"Wrote {len(results)} results to {args.output}")
+
+
+def parse_ints(value):
+    return [int(item) for item in value.split(",")]
+
+
+def synthetic_embeddings(dim):
+    """Make a drop-in replacement for query_run_embedding.
+
+    Texts look like "<class>:<example>". Each embedding is the class center
+    plus noise, both seeded from the text, so every run sees the same data.
+    """
+
+    def query_run_embedding(texts, config=None):
+        embeddings = []
+        for text in texts:
+            class_id = text.split(":")[0]
+            center = np.random.default_rng(zlib.crc32(class_id.encode())).standard_normal(dim)
+            noise = np.random.default_rng(zlib.crc32(text.encode())).standard_normal(dim)
+            embeddings.append([(center + 0.5 * noise).tolist()])
+
+        return embeddings
+
+    return query_run_embedding
+
+
+def run_case(classes, examples_per_class, dim, batch_sizes, repeat):
+    from shopper.classifier import lamini_classifier
+
+    with mock.patch.object(
+        lamini_classifier, "query_run_embedding", synthetic_embeddings(dim)
+    ):
+        # Measure the classifier itself, not the result cache
+        classifier = lamini_classifier.LaminiClassifier(result_cache_size=0)
+        classifier.examples = {}
+
+        for class_id in range(classes):
+            classifier.add_data_to_class(
+                str(class_id),
+                [f"{class_id}:{example}" for example in range(examples_per_class)],
+            )
+
+        case = {
+            "classes": classes,
+            "examples_per_class": examples_per_class,
+            "dim": dim,
+        }
+
+        results = []
+
+        seconds = timed(classifier.train, 1)
+        results.append(
+            make_result(case, "train", None, seconds, classes * examples_per_class)
+        )
+
+        for batch_size in batch_sizes:
+            batch = [
+                f"{index % classes}:query-{index}" for index in range(batch_size)
+            ]
+
+            operations = {
+                "predict_proba": lambda: classifier.predict_proba(batch),
+                "predict": lambda: classifier.predict(batch),
+                "classify": lambda: classifier.classify(batch, top_n=5),
+            }
+
+            for operation, call in operations.items():
+                seconds = timed(call, repeat)
+                results.append(
+                    make_result(case, operation, batch_size, seconds, batch_size)
+                )
+
+    return results
+
+
+def timed(call, repeat):
+    """The best wall time of repeat calls, in seconds."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        call()
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+
+def make_result(case, operation, batch_size, seconds, items):
+    return {
+        **case,
+        "operation": operation,
+        "batch_size": batch_size,
+        "seconds": seconds,
+        "items_per_second": items / seconds if seconds > 0 else None,
+        # ru_maxrss is reported in kilobytes on Linux
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def result_key(result):
+    return (
+        result["classes"],
+        result["examples_per_class"],
+        result["dim"],
+        result["operation"],
+        result["batch_size"],
+    )
+
+
+def format_result(result):
+    return (
+        f"{result['operation']:>14} classes={result['classes']} "
+        f"examples={result['examples_per_class']} dim={result['dim']} "
+        f"batch={result['batch_size']}: {result['seconds'] * 1000:.2f}ms "
+        f"peak rss {result['peak_rss_mb']:.0f}MB"
+    )
+
+
+def compare(baseline_filename, current_filename, threshold):
+    """Print every result that got slower by more than threshold."""
+
+    with open(baseline_filename) as f:
+        baseline = {result_key(result): result for result in json.load(f)["results"]}
+
+    with open(current_filename) as f:
+        current = json.load(f)["results"]
+
+    regressions = []
+    for result in current:
+        previous = baseline.get(result_key(result))
+        if previous is None:
+            continue
+
+        change = result["seconds"] / previous["seconds"] - 1
+        if change > threshold:
+            regressions.append(result)
+            print(f"REGRESSION {change:+.1%} {format_result(result)}")
+        else:
+            print(f"ok         {change:+.1%} {format_result(result)}")
+
+    print(f"{len(regressions)} regressions beyond {threshold:.0%}")
+
+    return regressions
+
+
+if __name__ == "__main__":
+    main()
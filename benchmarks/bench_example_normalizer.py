@@ -0,0 +1,111 @@
+import argparse
+import csv
+import os
+import sys
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    """Check that example normalization only removes what it should.
+
+    Every product name must come out of the normalizer unchanged apart from
+    collapsed whitespace, since names such as "Great Northern Beans" start
+    with the same words as assistant openers. Typical generated examples
+    must lose their preambles and markup. The bytes saved on the saved
+    examples file are reported.
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Check and measure the example normalizer."
+    )
+
+    parser.add_argument(
+        "--products",
+        help="The csv of products whose names must not change.",
+        default="data/products.csv",
+    )
+
+    parser.add_argument(
+        "--examples",
+        help="A saved examples jsonl file to measure the bytes saved on.",
+        default="models/saved_examples.jsonl",
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    from shopper.classifier.example_normalizer import ExampleNormalizer
+
+    normalizer = ExampleNormalizer()
+
+    failures = 0
+
+    with open(args.products) as f:
+        names = [row["product_name"] for row in csv.DictReader(f)]
+
+    changed = [(name, normalizer.normalize(name)) for name in names]
+    changed = [
+        (name, normalized)
+        for name, normalized in changed
+        if normalized != " ".join(name.split())
+    ]
+
+    ok = len(changed) == 0
+    failures += 0 if ok else 1
+    print(f"{'ok  ' if ok else 'FAIL'} product names: {len(changed)} of {len(names)} changed")
+    for name, normalized in changed[:10]:
+        print(f"    {name!r} -> {normalized!r}")
+
+    cleaned = 0
+    for text, expected in GENERATED_EXAMPLES:
+        normalized = normalizer.normalize(text)
+        if normalized == expected:
+            cleaned += 1
+        else:
+            print(f"    {text!r} -> {normalized!r}, expected {expected!r}")
+
+    ok = cleaned == len(GENERATED_EXAMPLES)
+    failures += 0 if ok else 1
+    print(f"{'ok  ' if ok else 'FAIL'} generated examples: {cleaned} of {len(GENERATED_EXAMPLES)} cleaned")
+
+    if os.path.exists(args.examples):
+        from shopper.util.jsonl import read_jsonl
+
+        before = 0
+        after = 0
+        for row in read_jsonl(args.examples):
+            examples = row["examples"]
+            if isinstance(examples, str):
+                examples = [examples]
+
+            _, bytes_before, bytes_after = normalizer.normalize_examples(examples)
+            before += bytes_before
+            after += bytes_after
+
+        print(
+            f"saved examples: {before} bytes before, {after} after, "
+            f"{100 * (before - after) / max(1, before):.1f}% saved"
+        )
+
+    sys.exit(1 if failures > 0 else 0)
+
+
+# Generated examples and what they should normalize to
+GENERATED_EXAMPLES = [
+    ("Sure! Here is an example: Crisp apples.", "Crisp apples."),
+    ("Certainly, here's a description: **Fresh** bread.", "Fresh bread."),
+    ("Great! Crunchy chips for parties.", "Crunchy chips for parties."),
+    ("<p>Creamy Havarti cheese.</p>", "Creamy Havarti cheese."),
+    ("Try `salsa verde` with chips.", "Try salsa verde with chips."),
+    ("Great Northern Beans are mild and creamy.", "Great Northern Beans are mild and creamy."),
+    ("Absolutely Zero Energy Drink has no sugar.", "Absolutely Zero Energy Drink has no sugar."),
+    ("Tangy salsa. I hope this helps!", "Tangy salsa."),
+]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+import numpy as np
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Checks that loading a classifier and scoring features needs no scikit-learn
+SERVE_SCRIPT = """
+import sys
+import numpy as np
+from shopper.classifier.lamini_classifier import LaminiClassifier
+
+classifier = LaminiClassifier.load(sys.argv[1])
+width = classifier.logistic_regression.coef_.shape[1]
+features = np.random.default_rng(1).standard_normal((4, width), dtype=np.float32)
+classifier.classify_features(features, top_n=3)
+classifier.predict_features(features)
+
+print(",".join(name for name in ("sklearn", "scipy") if name in sys.modules))
+"""
+
+
+def main():
+    """Check the numpy inference path against scikit-learn.
+
+    Each supported kind of trained model is fit on synthetic data, exported
+    to a LinearModel, and both are compared for probabilities, predictions
+    and scoring time. A saved classifier is then loaded and scored in a
+    fresh interpreter, which must not import scikit-learn.
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Check the numpy inference path against scikit-learn."
+    )
+
+    parser.add_argument(
+        "--classes",
+        help="The number of classes of the synthetic data.",
+        type=int,
+        default=100,
+    )
+
+    parser.add_argument(
+        "--dim",
+        help="The embedding width of the synthetic data.",
+        type=int,
+        default=384,
+    )
+
+    parser.add_argument(
+        "--rows",
+        help="The number of rows to score.",
+        type=int,
+        default=2000,
+    )
+
+    parser.add_argument(
+        "--tolerance",
+        help="The largest allowed difference between probabilities.",
+        type=float,
+        default=1e-4,
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    X, y = make_data(args.classes, args.dim, args.rows)
+
+    failures = 0
+    for name, model, exported in fit_models(X, y):
+        expected, sklearn_seconds = time_call(model.predict_proba, X)
+        probs, numpy_seconds = time_call(exported.predict_proba, X)
+
+        difference = np.abs(probs - expected).max()
+        mismatches = (np.argmax(probs, axis=1) != np.argmax(expected, axis=1)).sum()
+
+        # Ties within float32 rounding may pick a different class
+        ok = difference <= args.tolerance and mismatches <= args.rows * 0.001
+        failures += 0 if ok else 1
+
+        print(
+            f"{'ok  ' if ok else 'FAIL'} {name}: max difference {difference:.1e}, "
+            f"{mismatches} different predictions, "
+            f"sklearn {sklearn_seconds * 1000:.1f}ms, numpy {numpy_seconds * 1000:.1f}ms"
+        )
+
+    imported = check_serving_imports(X, y)
+    ok = len(imported) == 0
+    failures += 0 if ok else 1
+
+    print(
+        f"{'ok  ' if ok else 'FAIL'} load and classify imports: "
+        + (", ".join(imported) if imported else "no scikit-learn")
+    )
+
+    sys.exit(1 if failures > 0 else 0)
+
+
+def make_data(classes, dim, rows):
+    """Rows of normalized embeddings scattered around one center per class."""
+    rng = np.random.default_rng(0)
+
+    centers = rng.standard_normal((classes, dim))
+    y = np.arange(rows) % classes
+    X = centers[y] + 2 * rng.standard_normal((rows, dim))
+    X /= np.linalg.norm(X, axis=1, keepdims=True)
+
+    return X, y
+
+
+def fit_models(X, y):
+    """Yield the kinds of models LaminiClassifier.train produces, each with a
+    scikit-learn model and the LinearModel that should match it."""
+    from sklearn.linear_model import LogisticRegression, SGDClassifier
+    from sklearn.multiclass import OneVsRestClassifier
+
+    from shopper.classifier.linear_model import LinearModel
+    from shopper.classifier.parallel_training import train_one_vs_rest
+
+    models = {
+        "LogisticRegression": LogisticRegression(random_state=0).fit(X, y),
+        "binary LogisticRegression": LogisticRegression(random_state=0).fit(X, y % 2),
+        "SGDClassifier": SGDClassifier(loss="log_loss", random_state=0).fit(X, y),
+    }
+
+    for name, model in models.items():
+        yield name, model, LinearModel.from_estimator(model)
+
+    # The parallel heads against scikit-learn's own one-vs-rest
+    yield (
+        "train_one_vs_rest",
+        OneVsRestClassifier(LogisticRegression(random_state=0)).fit(X, y),
+        train_one_vs_rest(X, y, n_jobs=2),
+    )
+
+
+def time_call(function, X, repeat=5):
+    """The result and the best time of repeated calls."""
+    best = float("inf")
+
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function(X)
+        best = min(best, time.perf_counter() - start)
+
+    return result, best
+
+
+def check_serving_imports(X, y):
+    """The heavy modules imported by loading and scoring a saved classifier."""
+    from sklearn.linear_model import LogisticRegression
+
+    from shopper.classifier.lamini_classifier import LaminiClassifier
+    from shopper.classifier.linear_model import LinearModel
+
+    classifier = LaminiClassifier(result_cache_size=0)
+    classifier.examples = {}
+
+    for class_id in sorted(set(y.tolist())):
+        classifier.add_class(f"class {class_id}")
+
+    classifier.logistic_regression = LinearModel.from_estimator(
+        LogisticRegression(random_state=0).fit(X, y)
+    )
+
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "classifier.pkl")
+        classifier.save(path)
+
+        result = subprocess.run(
+            [sys.executable, "-c", SERVE_SCRIPT, path],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+
+    return [name for name in result.stdout.strip().split(",") if name]
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,105 @@
+from shopper.classifier.parallel_training import train_one_vs_rest
+
+from sklearn.linear_model import LogisticRegression
+
+import numpy as np
+
+import argparse
+import os
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    """Show how one-vs-rest training time scales with cores."""
+
+    parser = argparse.ArgumentParser(
+        description="Benchmark sharded classifier training on synthetic embeddings."
+    )
+
+    parser.add_argument(
+        "--classes",
+        help="The number of classes.",
+        type=int,
+        default=1000,
+    )
+
+    parser.add_argument(
+        "--examples-per-class",
+        help="The number of training examples per class.",
+        type=int,
+        default=10,
+    )
+
+    parser.add_argument(
+        "--dim",
+        help="The embedding width.",
+        type=int,
+        default=384,
+    )
+
+    parser.add_argument(
+        "--jobs",
+        help="Comma separated process counts to compare.",
+        default=",".join(str(jobs) for jobs in job_counts()),
+    )
+
+    parser.add_argument(
+        "--baseline",
+        help="Also time a single multinomial LogisticRegression.",
+        action="store_true",
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    X, y = make_synthetic_embeddings(args.classes, args.examples_per_class, args.dim)
+
+    print(f"{len(X)} examples, {args.classes} classes, {args.dim} dimensions")
+
+    if args.baseline:
+        start = time.perf_counter()
+        model = LogisticRegression(random_state=0).fit(X, y)
+        elapsed = time.perf_counter() - start
+        print(f"single LogisticRegression: {elapsed:.2f}s accuracy {model.score(X, y):.3f}")
+
+    single = None
+    for jobs in [int(jobs) for jobs in args.jobs.split(",")]:
+        start = time.perf_counter()
+        model = train_one_vs_rest(X, y, n_jobs=jobs)
+        elapsed = time.perf_counter() - start
+
+        if single is None:
+            single = elapsed
+
+        accuracy = np.mean(model.predict(X) == y)
+        print(
+            f"one-vs-rest jobs={jobs}: {elapsed:.2f}s speedup {single / elapsed:.2f}x accuracy {accuracy:.3f}"
+        )
+
+
+def job_counts():
+    counts = [1]
+    while counts[-1] * 2 <= os.cpu_count():
+        counts.append(counts[-1] * 2)
+
+    return counts
+
+
+def make_synthetic_embeddings(classes, examples_per_class, dim, seed=0):
+    """Gaussian clusters around one random center per class."""
+    rng = np.random.default_rng(seed)
+
+    centers = rng.standard_normal((classes, dim), dtype=np.float32)
+    y = np.repeat(np.arange(classes), examples_per_class)
+    X = centers[y] + rng.standard_normal((len(y), dim), dtype=np.float32)
+
+    return X, y
+
+
+if __name__ == "__main__":
+    main()
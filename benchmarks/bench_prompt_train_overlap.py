@@ -0,0 +1,129 @@
+from unittest import mock
+
+import numpy as np
+
+import argparse
+import sys
+import time
+import zlib
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    """Check that prompt_train embeds classes while later classes generate.
+
+    Generation and embedding are replaced by sleeps of fixed latency per
+    class, so the check needs no Lamini calls. Without the embedding cache
+    prompt_train embeds every class after generation, taking the sum of
+    both. With it, the total should approach the slower of the two plus one
+    class of the faster one.
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Check that prompt_train overlaps embedding with generation."
+    )
+
+    parser.add_argument(
+        "--classes",
+        help="The number of classes to train.",
+        type=int,
+        default=20,
+    )
+
+    parser.add_argument(
+        "--generation-latency",
+        help="Seconds to generate the examples of one class.",
+        type=float,
+        default=0.1,
+    )
+
+    parser.add_argument(
+        "--embedding-latency",
+        help="Seconds to embed the examples of one class.",
+        type=float,
+        default=0.08,
+    )
+
+    parser.add_argument(
+        "--slack",
+        help="Allowed seconds on top of the ideal overlapped time.",
+        type=float,
+        default=0.5,
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+
+    prompts = {f"class {class_id}": f"prompt {class_id}" for class_id in range(args.classes)}
+
+    generation = args.classes * args.generation_latency
+    embedding = args.classes * args.embedding_latency
+
+    sequential = run_prompt_train(prompts, args, cache_embeddings=False)
+    overlapped = run_prompt_train(prompts, args, cache_embeddings=True)
+
+    ideal = max(generation, embedding) + min(
+        args.generation_latency, args.embedding_latency
+    )
+
+    print(f"generation {generation:.2f}s, embedding {embedding:.2f}s")
+    print(f"sequential prompt_train: {sequential:.2f}s")
+
+    ok = overlapped <= ideal + args.slack
+    print(
+        f"{'ok  ' if ok else 'FAIL'} overlapped prompt_train: {overlapped:.2f}s "
+        f"(ideal {ideal:.2f}s, budget {ideal + args.slack:.2f}s)"
+    )
+
+    sys.exit(0 if ok else 1)
+
+
+def run_prompt_train(prompts, args, cache_embeddings):
+    """The seconds prompt_train takes with simulated latencies."""
+    from shopper.classifier import lamini_classifier
+
+    def generate_examples_from_prompt(
+        self, class_name, prompt, original_examples, count=None, stats=None
+    ):
+        time.sleep(args.generation_latency)
+        return [f"{class_name}:{example}" for example in range(10)]
+
+    # One embedding request per class, with one center per class
+    def query_run_embedding(texts, config=None):
+        time.sleep(args.embedding_latency)
+
+        embeddings = []
+        for text in texts:
+            class_name = text.split(":")[0]
+            center = np.random.default_rng(zlib.crc32(class_name.encode())).standard_normal(64)
+            noise = np.random.default_rng(zlib.crc32(text.encode())).standard_normal(64)
+            embeddings.append([(center + 0.5 * noise).tolist()])
+
+        return embeddings
+
+    classifier_class = lamini_classifier.LaminiClassifier
+
+    with mock.patch.object(
+        lamini_classifier, "query_run_embedding", query_run_embedding
+    ), mock.patch.object(
+        classifier_class, "generate_examples_from_prompt", generate_examples_from_prompt
+    ), mock.patch.object(
+        classifier_class, "save_examples", lambda self: None
+    ):
+        classifier = classifier_class(
+            result_cache_size=0, cache_embeddings=cache_embeddings
+        )
+        classifier.examples = {}
+
+        start = time.perf_counter()
+        classifier.prompt_train(prompts)
+
+        return time.perf_counter() - start
+
+
+if __name__ == "__main__":
+    main()
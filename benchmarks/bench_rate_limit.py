@@ -0,0 +1,116 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import argparse
+import sys
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    """Check that the endpoint limiters hold their rate and in-flight limits.
+
+    Many threads make simulated calls of fixed latency through one limiter.
+    The achieved rate must stay within the configured requests per second,
+    plus the burst, and the calls in flight must never exceed the limit,
+    while the queue wait is reported.
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Check the rate limiter and in-flight governor."
+    )
+
+    parser.add_argument(
+        "--calls",
+        help="The number of simulated calls.",
+        type=int,
+        default=200,
+    )
+
+    parser.add_argument(
+        "--threads",
+        help="The number of threads making calls.",
+        type=int,
+        default=32,
+    )
+
+    parser.add_argument(
+        "--rps",
+        help="The requests per second limit.",
+        type=float,
+        default=100,
+    )
+
+    parser.add_argument(
+        "--burst",
+        help="The requests allowed at once before the rate applies.",
+        type=float,
+        default=10,
+    )
+
+    parser.add_argument(
+        "--max-in-flight",
+        help="The in-flight limit.",
+        type=int,
+        default=8,
+    )
+
+    parser.add_argument(
+        "--latency",
+        help="Seconds each simulated call takes.",
+        type=float,
+        default=0.05,
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    from shopper.util.rate_limit import configure_limiter, limit
+
+    limiter = configure_limiter(
+        "completion",
+        requests_per_second=args.rps,
+        burst=args.burst,
+        max_in_flight=args.max_in_flight,
+    )
+
+    def call(_):
+        with limit("completion"):
+            time.sleep(args.latency)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.threads) as pool:
+        list(pool.map(call, range(args.calls)))
+    seconds = time.perf_counter() - start
+
+    stats = limiter.get_stats()
+
+    # The bucket starts full, so the burst is free
+    rate = (args.calls - args.burst) / seconds
+    # Neither limit can go faster than the in-flight limit over the latency
+    expected = min(args.rps, args.max_in_flight / args.latency)
+
+    rate_ok = rate <= args.rps * 1.05
+    in_flight_ok = stats["peak_in_flight"] <= args.max_in_flight
+
+    print(
+        f"{'ok  ' if rate_ok else 'FAIL'} rate: {rate:.1f} requests/s after the burst, "
+        f"limit {args.rps:.1f}, best possible {expected:.1f}"
+    )
+    print(
+        f"{'ok  ' if in_flight_ok else 'FAIL'} in flight: peak {stats['peak_in_flight']}, "
+        f"limit {args.max_in_flight}"
+    )
+    print(
+        f"queue wait: {stats['waited_calls']} of {stats['calls']} calls waited, "
+        f"mean {stats['mean_wait'] * 1000:.1f}ms, max {stats['max_wait'] * 1000:.1f}ms"
+    )
+
+    sys.exit(0 if rate_ok and in_flight_ok else 1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+import multiprocessing
+import numpy as np
+
+import argparse
+import os
+import sys
+import tempfile
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    """Check that serving workers share one copy of the classifier weights.
+
+    A synthetic classifier is saved both as a plain pickle and with
+    save_shared. For each loading mode, 1 and then N workers load it, score a
+    batch so that every weight is read, and report their proportional set
+    size (PSS), which splits shared pages between the processes mapping them.
+    Workers that load and score a tiny shared classifier give the growth of
+    the interpreter and the scoring code alone, a few MB that do not depend
+    on the weights. The check fails if the shared mode grows by more than
+    the allowed fraction of the weights per additional worker, plus a noise
+    floor, on top of that.
+    """
+
+    parser = argparse.ArgumentParser(
+        description="Check that shared classifier weights are not copied per worker."
+    )
+
+    parser.add_argument(
+        "--classes",
+        help="The number of classes of the synthetic classifier.",
+        type=int,
+        default=50000,
+    )
+
+    parser.add_argument(
+        "--dim",
+        help="The embedding width of the synthetic classifier.",
+        type=int,
+        default=384,
+    )
+
+    parser.add_argument(
+        "--workers",
+        help="The number of workers to compare against a single worker.",
+        type=int,
+        default=4,
+    )
+
+    parser.add_argument(
+        "--max-growth",
+        help="Allowed memory growth per additional worker, as a fraction of the weights.",
+        type=float,
+        default=0.1,
+    )
+
+    parser.add_argument(
+        "--noise-mb",
+        help="Allowed memory growth per additional worker that PSS cannot resolve.",
+        type=float,
+        default=2.0,
+    )
+
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    if not os.path.exists("/proc/self/smaps_rollup"):
+        print("skipped: proportional set size needs Linux /proc/self/smaps_rollup")
+        return
+
+    # /dev/shm keeps the shared files in memory, as recommended for serving
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+    with tempfile.TemporaryDirectory(dir=base) as directory:
+        weights_mb = save_synthetic_classifier(directory, args.classes, args.dim)
+        save_synthetic_classifier(os.path.join(directory, "baseline"), 16, args.dim)
+        print(f"weights: {weights_mb:.0f}MB, {args.classes} classes x {args.dim}")
+
+        budget = args.max_growth * weights_mb + args.noise_mb
+
+        failures = 0
+        baseline_growth = 0
+        for mode in ("baseline", "pickle", "shared"):
+            single = run_workers(directory, mode, 1)
+            several = run_workers(directory, mode, args.workers)
+            growth = (several - single) / (args.workers - 1)
+
+            if mode == "baseline":
+                baseline_growth = growth
+
+            model_growth = growth - baseline_growth
+
+            ok = mode != "shared" or model_growth <= budget
+            failures += 0 if ok else 1
+
+            print(
+                f"{'ok  ' if ok else 'FAIL'} {mode}: total PSS {single:.0f}MB with 1 worker, "
+                f"{several:.0f}MB with {args.workers}, "
+                f"{model_growth:+.1f}MB per additional worker for the model"
+                + (f" (budget {budget:.1f}MB)" if mode == "shared" else "")
+            )
+
+    sys.exit(1 if failures > 0 else 0)
+
+
+def save_synthetic_classifier(directory, classes, dim):
+    """Save a classifier with random weights in both formats, returning
+    the size of its weights in MB."""
+
+    os.makedirs(directory, exist_ok=True)
+
+    from shopper.classifier.lamini_classifier import LaminiClassifier
+    from shopper.classifier.linear_model import LinearModel
+
+    rng = np.random.default_rng(0)
+
+    classifier = LaminiClassifier(result_cache_size=0)
+    classifier.examples = {}
+
+    for class_id in range(classes):
+        class_name = f"product {class_id}"
+        classifier.add_class(class_name)
+        classifier.add_metadata_to_class(
+            class_name,
+            {
+                "product_id": class_id,
+                "aisle_id": str(class_id % 134),
+                "department_id": str(class_id % 21),
+            },
+        )
+
+    classifier.logistic_regression = LinearModel(
+        np.arange(classes),
+        rng.standard_normal((classes, dim), dtype=np.float32),
+        rng.standard_normal(classes, dtype=np.float32),
+    )
+
+    classifier.save(os.path.join(directory, "classifier.pkl"))
+    classifier.save_shared(os.path.join(directory, "shared"))
+
+    return classifier.logistic_regression.coef_.nbytes / 2**20
+
+
+def run_workers(directory, mode, count):
+    """The total PSS in MB of count workers, all alive at the same time."""
+
+    context = multiprocessing.get_context("spawn")
+    barrier = context.Barrier(count)
+    results = context.Queue()
+
+    workers = [
+        context.Process(target=serve, args=(directory, mode, barrier, results))
+        for _ in range(count)
+    ]
+
+    for worker in workers:
+        worker.start()
+
+    total = sum(results.get() for _ in workers)
+
+    for worker in workers:
+        worker.join()
+
+    return total
+
+
+def serve(directory, mode, barrier, results):
+    from shopper.classifier.lamini_classifier import LaminiClassifier
+
+    if mode == "shared":
+        classifier = LaminiClassifier.load_shared(os.path.join(directory, "shared"))
+    elif mode == "pickle":
+        classifier = LaminiClassifier.load(os.path.join(directory, "classifier.pkl"))
+    else:
+        classifier = LaminiClassifier.load_shared(
+            os.path.join(directory, "baseline", "shared")
+        )
+
+    # Read every weight and a class name, as serving would
+    width = classifier.logistic_regression.coef_.shape[1]
+    features = np.random.default_rng(1).standard_normal((8, width), dtype=np.float32)
+    classifier.classify_features(features, top_n=3, metadata=True)
+
+    # Measure only once every worker has mapped the model
+    barrier.wait()
+    results.put(read_pss_mb())
+    barrier.wait()
+
+
+def read_pss_mb():
+    with open("/proc/self/smaps_rollup") as f:
+        for line in f:
+            if line.startswith("Pss:"):
+                return int(line.split()[1]) / 1024
+
+    return 0.0
+
+
+if __name__ == "__main__":
+    main()
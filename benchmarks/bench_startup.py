@@ -0,0 +1,115 @@
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Modules that must not be imported just to list commands or load the
+# classifier module
+HEAVY_MODULES = ["lamini", "llama", "sklearn", "scipy", "tqdm"]
+
+# Each check is a command and the heavy modules it must not import
+CHECKS = {
+    "shopper --help": (["-m", "shopper", "--help"], HEAVY_MODULES + ["numpy"]),
+    "shopper train --help": (["-m", "shopper", "train", "--help"], HEAVY_MODULES + ["numpy"]),
+    "import LaminiClassifier": (
+        ["-c", "from shopper.classifier.lamini_classifier import LaminiClassifier"],
+        HEAVY_MODULES,
+    ),
+}
+
+
+def main():
+    """Check that the shopper command and inference imports start quickly."""
+
+    parser = argparse.ArgumentParser(
+        description="Check shopper startup time against a budget."
+    )
+
+    parser.add_argument(
+        "--budget",
+        help="Allowed seconds of startup on top of a bare interpreter.",
+        type=float,
+        default=0.15,
+    )
+
+    parser.add_argument(
+        "--repeat",
+        help="The number of times each command is timed, the median is used.",
+        type=int,
+        default=5,
+    )
+
+    args = parser.parse_args()
+
+    baseline = time_command(["-c", "pass"], args.repeat)
+    print(f"bare interpreter: {baseline * 1000:.0f}ms")
+
+    failures = 0
+    for name, (command, forbidden) in CHECKS.items():
+        overhead = time_command(command, args.repeat) - baseline
+        imported = heavy_imports(command, forbidden)
+
+        ok = overhead <= args.budget and len(imported) == 0
+        failures += 0 if ok else 1
+
+        print(
+            f"{'ok  ' if ok else 'FAIL'} {name}: +{overhead * 1000:.0f}ms "
+            f"(budget {args.budget * 1000:.0f}ms)"
+            + (f", imported {', '.join(imported)}" if len(imported) > 0 else "")
+        )
+
+    sys.exit(1 if failures > 0 else 0)
+
+
+def environment():
+    env = dict(os.environ)
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env["PYTHONPATH"] = root + os.pathsep + env.get("PYTHONPATH", "")
+    return env
+
+
+def time_command(command, repeat):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run(
+            [sys.executable] + command,
+            env=environment(),
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            check=True,
+        )
+        times.append(time.perf_counter() - start)
+
+    return statistics.median(times)
+
+
+def heavy_imports(command, forbidden):
+    """Run the command with -X importtime and list forbidden top level imports."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime"] + command,
+        env=environment(),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+    )
+
+    imported = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        module = line.split("|")[-1].strip()
+        if module.split(".")[0] in forbidden:
+            imported.add(module.split(".")[0])
+
+    return sorted(imported)
+
+
+if __name__ == "__main__":
+    main()
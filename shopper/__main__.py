@@ -0,0 +1,5 @@
+from shopper.cli.main import main
+
+import sys
+
+sys.exit(main())
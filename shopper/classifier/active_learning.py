@@ -0,0 +1,61 @@
+import numpy as np
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_class_errors(X, y, folds=3, n_jobs=None, seed=0):
+    """Estimate held-out accuracy and the error rate of every class with
+    k-fold cross-validation.
+
+    Returns the overall accuracy and a dict from class id to its error rate
+    and the class it is most often mistaken for. Folds are stratified when
+    every class has at least one example per fold, which is not the case for
+    the small seed sets of active learning.
+    """
+
+    from sklearn.linear_model import LogisticRegression
+    from sklearn.model_selection import KFold, StratifiedKFold, cross_val_predict
+
+    X = np.asarray(X, dtype=np.float32)
+    y = np.asarray(y)
+
+    classes, counts = np.unique(y, return_counts=True)
+
+    folds = min(folds, len(y))
+    if counts.min() >= folds:
+        splitter = StratifiedKFold(n_splits=folds, shuffle=True, random_state=seed)
+    else:
+        splitter = KFold(n_splits=folds, shuffle=True, random_state=seed)
+
+    predicted = cross_val_predict(
+        LogisticRegression(random_state=0), X, y, cv=splitter, n_jobs=n_jobs
+    )
+
+    errors = {}
+    for class_id in classes:
+        rows = y == class_id
+        mistakes = predicted[rows][predicted[rows] != class_id]
+
+        confused_with = None
+        if len(mistakes) > 0:
+            values, mistake_counts = np.unique(mistakes, return_counts=True)
+            confused_with = int(values[mistake_counts.argmax()])
+
+        errors[int(class_id)] = {
+            "error_rate": len(mistakes) / rows.sum(),
+            "confused_with": confused_with,
+        }
+
+    return float((predicted == y).mean()), errors
+
+
+def select_weak_classes(errors, count):
+    """The ids of up to count classes with the highest error rates, skipping
+    classes that cross-validation never got wrong."""
+
+    weak = [class_id for class_id, error in errors.items() if error["error_rate"] > 0]
+    weak.sort(key=lambda class_id: -errors[class_id]["error_rate"])
+
+    return weak[:count]
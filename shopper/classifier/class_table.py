@@ -0,0 +1,280 @@
+from shopper.util.jsonl import dumps, loads
+
+from array import array
+from collections.abc import Mapping, Sequence
+from operator import index
+
+import os
+import sys
+
+# Layout of a class without metadata, or with metadata that is not a dict
+NO_METADATA = -1
+OTHER_METADATA = -2
+
+
+class ClassTable:
+    """The classes of a classifier, stored as columns instead of one dict per class.
+
+    Class ids index a list of interned names. Dict metadata is split into
+    one list per field, plus the id of the class's field layout, a tuple of
+    field names shared by every class with the same fields. At catalog
+    scale this is far smaller than a dict of dicts, and much faster to
+    pickle. Metadata that is not a dict is kept as is.
+    """
+
+    def __init__(self):
+        self.names = []
+        self.ids = {}
+
+        self.layouts = []
+        self.layout_ids = {}
+        self.class_layouts = array("i")
+
+        self.columns = {}
+        self.other_metadata = {}
+
+    def __len__(self):
+        return len(self.names)
+
+    def add_class(self, class_name):
+        """Add a class if it is new, and return its id."""
+        class_id = self.ids.get(class_name)
+
+        if class_id is None:
+            class_id = len(self.names)
+            class_name = intern(class_name)
+            self.names.append(class_name)
+            self.ids[class_name] = class_id
+            self.class_layouts.append(NO_METADATA)
+
+        return class_id
+
+    def set_metadata(self, class_id, metadata):
+        self.other_metadata.pop(class_id, None)
+
+        if not isinstance(metadata, dict):
+            self.class_layouts[class_id] = OTHER_METADATA
+            self.other_metadata[class_id] = metadata
+            return
+
+        self.class_layouts[class_id] = self.get_layout_id(tuple(metadata.keys()))
+
+        for field, value in metadata.items():
+            column = self.columns.get(field)
+            if column is None:
+                column = []
+                self.columns[field] = column
+
+            if len(column) < len(self.names):
+                column.extend([None] * (len(self.names) - len(column)))
+
+            column[class_id] = intern(value)
+
+    def get_layout_id(self, fields):
+        layout_id = self.layout_ids.get(fields)
+
+        if layout_id is None:
+            layout_id = len(self.layouts)
+            self.layouts.append(fields)
+            self.layout_ids[fields] = layout_id
+
+        return layout_id
+
+    def get_metadata(self, class_id, default=None):
+        """The metadata of a class, rebuilt as a new dict from the columns."""
+        layout_id = self.class_layouts[class_id]
+
+        if layout_id == NO_METADATA:
+            return default
+
+        if layout_id == OTHER_METADATA:
+            return self.other_metadata[class_id]
+
+        return {field: self.columns[field][class_id] for field in self.layouts[layout_id]}
+
+    def get_field(self, class_id, field, default=None):
+        """One metadata field of a class, without rebuilding its dict."""
+        layout_id = self.class_layouts[class_id]
+
+        if layout_id < 0 or field not in self.layouts[layout_id]:
+            return default
+
+        return self.columns[field][class_id]
+
+    def get_entry(self, class_id):
+        """The class name and metadata in the form of the old class_ids_to_metadata."""
+        entry = {"class_name": self.names[class_id]}
+
+        if self.class_layouts[class_id] != NO_METADATA:
+            entry["metadata"] = self.get_metadata(class_id)
+
+        return entry
+
+    def save(self, directory):
+        """Save the names and metadata so that they can be memory-mapped, see
+        MappedClassTable."""
+        write_strings(os.path.join(directory, "class_names"), self.names)
+
+        write_strings(
+            os.path.join(directory, "class_metadata"),
+            (
+                ""
+                if self.class_layouts[class_id] == NO_METADATA
+                else dumps(self.get_metadata(class_id))
+                for class_id in range(len(self.names))
+            ),
+        )
+
+    @staticmethod
+    def from_dicts(class_names_to_ids, class_ids_to_metadata):
+        """Build a table from the dicts of classifiers saved before it existed."""
+        table = ClassTable()
+
+        for class_name, class_id in sorted(class_names_to_ids.items(), key=lambda x: x[1]):
+            if table.add_class(class_name) != class_id:
+                raise Exception(f"Class ids are not contiguous at class '{class_name}'")
+
+            entry = class_ids_to_metadata.get(class_id, {})
+            if "metadata" in entry:
+                table.set_metadata(class_id, entry["metadata"])
+
+        return table
+
+
+class MappedClassTable:
+    """A read only ClassTable memory-mapped from the files written by
+    ClassTable.save, so that processes mapping the same files share them.
+
+    Names and metadata are decoded on access. The name to id dict is only
+    built if it is used.
+    """
+
+    def __init__(self, directory):
+        self.names = MappedStrings(os.path.join(directory, "class_names"))
+        self.metadata = MappedStrings(os.path.join(directory, "class_metadata"))
+        self.name_ids = None
+
+    def __len__(self):
+        return len(self.names)
+
+    @property
+    def ids(self):
+        if self.name_ids is None:
+            self.name_ids = {name: class_id for class_id, name in enumerate(self.names)}
+
+        return self.name_ids
+
+    def add_class(self, class_name):
+        class_id = self.ids.get(class_name)
+
+        if class_id is None:
+            raise Exception("Cannot add a class to a memory-mapped classifier")
+
+        return class_id
+
+    def set_metadata(self, class_id, metadata):
+        raise Exception("Cannot change the metadata of a memory-mapped classifier")
+
+    def get_metadata(self, class_id, default=None):
+        metadata = self.metadata[class_id]
+
+        if metadata == "":
+            return default
+
+        return loads(metadata)
+
+    def get_field(self, class_id, field, default=None):
+        metadata = self.get_metadata(class_id)
+
+        if not isinstance(metadata, dict):
+            return default
+
+        return metadata.get(field, default)
+
+    def get_entry(self, class_id):
+        entry = {"class_name": self.names[class_id]}
+
+        metadata = self.metadata[class_id]
+        if metadata != "":
+            entry["metadata"] = loads(metadata)
+
+        return entry
+
+
+class MappedStrings(Sequence):
+    """A read only list of strings memory-mapped from a utf-8 blob and an
+    array of offsets into it, written by write_strings."""
+
+    def __init__(self, path):
+        import numpy as np
+
+        self.offsets = np.load(path + ".offsets.npy", mmap_mode="r")
+
+        # numpy cannot map an empty file
+        if self.offsets[-1] > 0:
+            self.blob = np.memmap(path + ".bin", dtype=np.uint8, mode="r")
+        else:
+            self.blob = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position):
+        position = index(position)
+
+        if position < 0:
+            position += len(self)
+
+        if not 0 <= position < len(self):
+            raise IndexError(position)
+
+        start, end = self.offsets[position], self.offsets[position + 1]
+
+        return self.blob[start:end].tobytes().decode("utf-8")
+
+
+def write_strings(path, strings):
+    """Write strings as one utf-8 blob and an array of their offsets."""
+    import numpy as np
+
+    offsets = array("q", [0])
+
+    with open(path + ".bin", "wb") as f:
+        for string in strings:
+            data = string.encode("utf-8")
+            f.write(data)
+            offsets.append(offsets[-1] + len(data))
+
+    np.save(path + ".offsets.npy", np.frombuffer(offsets, dtype=np.int64))
+
+
+class ClassMetadataView(Mapping):
+    """A read only class_ids_to_metadata mapping over a ClassTable."""
+
+    def __init__(self, table):
+        self.table = table
+
+    def __getitem__(self, class_id):
+        try:
+            class_id = index(class_id)
+        except TypeError:
+            raise KeyError(class_id)
+
+        if not 0 <= class_id < len(self.table):
+            raise KeyError(class_id)
+
+        return self.table.get_entry(class_id)
+
+    def __iter__(self):
+        return iter(range(len(self.table)))
+
+    def __len__(self):
+        return len(self.table)
+
+
+def intern(value):
+    """Share one copy of repeated strings, such as aisle and department ids."""
+    if type(value) is str:
+        return sys.intern(value)
+
+    return value
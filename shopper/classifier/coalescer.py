@@ -0,0 +1,162 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import asyncio
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingCoalescer:
+    """Merges concurrent embedding calls into batched requests.
+
+    Texts requested within max_wait seconds of each other are sent together,
+    up to max_batch_size per request. A text that is already being embedded
+    shares the pending future instead of being requested again. At most
+    max_in_flight requests are outstanding at once, each one running the
+    blocking embed_batch on a worker thread so the event loop never blocks.
+    At most max_pending texts are waiting or in flight, and callers that
+    would go over wait for earlier batches to finish.
+
+    The worker threads come from executor if it is given, so that one pool
+    can serve the coalescers of several event loops, and otherwise from a
+    pool owned by the coalescer and shut down by close.
+    """
+
+    def __init__(
+        self,
+        embed_batch,
+        max_batch_size=100,
+        max_wait=0.005,
+        max_in_flight=8,
+        max_pending=None,
+        executor=None,
+    ):
+        self.embed_batch = embed_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.max_in_flight = max_in_flight
+
+        if max_pending is None:
+            max_pending = max_batch_size * max_in_flight * 4
+        self.max_pending = max_pending
+
+        self.loop = asyncio.get_running_loop()
+
+        self.owns_executor = executor is None
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self.executor = executor
+
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+
+        # Texts waiting to be sent, and the futures of every text that is
+        # waiting or in flight
+        self.pending = []
+        self.futures = {}
+        self.timer = None
+
+        # Notified when batches finish and make room for more texts
+        self.space = asyncio.Condition()
+
+        # The loop only keeps weak references to tasks, so the running
+        # batches are kept here until they finish
+        self.tasks = set()
+
+        self.requests = 0
+        self.texts = 0
+        self.shared = 0
+
+    async def embed(self, texts):
+        # A call larger than max_pending still runs once nothing else is
+        async with self.space:
+            await self.space.wait_for(
+                lambda: len(self.futures) == 0
+                or len(self.futures) + self.count_new(texts) <= self.max_pending
+            )
+
+        futures = []
+        for text in texts:
+            future = self.futures.get(text)
+
+            if future is None:
+                future = self.loop.create_future()
+                self.futures[text] = future
+                self.pending.append(text)
+            else:
+                self.shared += 1
+
+            futures.append(future)
+
+        if len(self.pending) >= self.max_batch_size:
+            self.flush()
+        elif self.timer is None and len(self.pending) > 0:
+            self.timer = self.loop.call_later(self.max_wait, self.flush)
+
+        # The futures are shared with other callers, so that cancelling this
+        # call must not cancel them
+        return await asyncio.gather(*[asyncio.shield(future) for future in futures])
+
+    def count_new(self, texts):
+        return len(set(text for text in texts if text not in self.futures))
+
+    def flush(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        while len(self.pending) > 0:
+            batch = self.pending[: self.max_batch_size]
+            self.pending = self.pending[self.max_batch_size :]
+            task = self.loop.create_task(self.run_batch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run_batch(self, batch):
+        try:
+            self.resolve_batch(batch, await self.embed_in_executor(batch))
+        except Exception as e:
+            self.fail_batch(batch, e)
+
+        async with self.space:
+            self.space.notify_all()
+
+    async def embed_in_executor(self, batch):
+        async with self.semaphore:
+            self.requests += 1
+            self.texts += len(batch)
+
+            return await self.loop.run_in_executor(self.executor, self.embed_batch, batch)
+
+    def resolve_batch(self, batch, embeddings):
+        if len(embeddings) != len(batch):
+            raise Exception(f"Got {len(embeddings)} embeddings for a batch of {len(batch)} texts")
+
+        for text, embedding in zip(batch, embeddings):
+            future = self.futures.pop(text)
+            if not future.done():
+                future.set_result(embedding)
+
+    def fail_batch(self, batch, exception):
+        for text in batch:
+            future = self.futures.pop(text)
+            if not future.done():
+                future.set_exception(exception)
+
+    def close(self):
+        """Stop the flush timer, and shut down the worker threads if the
+        coalescer owns them."""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if self.owns_executor:
+            self.executor.shutdown(wait=False)
+
+    def get_stats(self):
+        return {
+            "requests": self.requests,
+            "texts": self.texts,
+            "shared": self.shared,
+            "texts_per_request": self.texts / self.requests if self.requests > 0 else 0,
+        }
@@ -0,0 +1,144 @@
+import re
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Assistant openers such as "Sure!" or "No problem,", only when punctuated
+# and followed by more text, since product names such as "Great Northern
+# Beans" start with the same words
+ACKNOWLEDGEMENT = re.compile(
+    r"^(sure|certainly|of course|absolutely|no problem|okay|ok|great)[!,.]+\s*(?=\S)",
+    re.IGNORECASE,
+)
+
+# Introductions such as "Here is a complete example that matches the summary:"
+INTRODUCTION = re.compile(
+    r"^(here is|here's|here are|below is|the following is)\b[^:\n]{0,200}:\s*",
+    re.IGNORECASE,
+)
+
+# The same introductions ending in a period, only if they name what follows
+INTRODUCTION_SENTENCE = re.compile(
+    r"^(here is|here's|here are)\b[^.\n]{0,200}\b(example|summary|description)\b[^.\n]*\.\s+",
+    re.IGNORECASE,
+)
+
+# Labels such as "Example 2:" or "Expanded summary:"
+LABEL = re.compile(
+    r"^((complete|expanded|full)\s+)?(example|summary|description|output|answer)(\s+\d+)?\s*:\s*",
+    re.IGNORECASE,
+)
+
+# Closings such as "I hope this helps!"
+CLOSING = re.compile(
+    r"\s*(i hope (this|that) helps|let me know if)[^\n]*$",
+    re.IGNORECASE,
+)
+
+# Markup patterns and what replaces them
+MARKUP = [
+    # HTML tags
+    (re.compile(r"<[^>\n]+>"), " "),
+    # Code fences
+    (re.compile(r"```[a-z]*"), " "),
+    # Bold and inline code, only in pairs since names such as "A`s" use them
+    (re.compile(r"\*\*([^*\n]+)\*\*|__([^_\n]+)__|`([^`\n]+)`"), r"\1\2\3"),
+    # Headings, bullets and numbered list markers at the start of a line
+    (re.compile(r"^[ \t]*(#+|[-*•]|\d+[.)])[ \t]+", re.MULTILINE), ""),
+]
+
+QUOTES = "\"'“”‘’"
+
+# Words and individual punctuation marks, a rough count of LLM tokens
+TOKEN = re.compile(r"\w+|[^\w\s]")
+
+
+class ExampleNormalizer:
+    """Cleans generated examples before they are embedded and stored.
+
+    Strips assistant preambles and closings, markdown and html markup, and
+    surrounding quotes, collapses whitespace, and truncates to max_tokens,
+    at the end of a sentence if one is close enough.
+    """
+
+    def __init__(self, max_tokens=128):
+        self.max_tokens = max_tokens
+
+    def normalize(self, text):
+        if not isinstance(text, str):
+            return text
+
+        for pattern, replacement in MARKUP:
+            text = pattern.sub(replacement, text)
+
+        text = self.strip_preamble(text.strip())
+        text = CLOSING.sub("", text)
+
+        text = " ".join(text.split())
+
+        # A whole example wrapped in quotes
+        if len(text) >= 2 and text[0] in QUOTES and text[-1] in QUOTES:
+            text = text[1:-1].strip()
+
+        return self.truncate(text)
+
+    def strip_preamble(self, text):
+        """Remove openers, introductions and labels from the start, which
+        often follow each other as in "Sure! Here is an example:"."""
+        while True:
+            stripped = text
+            for pattern in (ACKNOWLEDGEMENT, INTRODUCTION, INTRODUCTION_SENTENCE, LABEL):
+                stripped = pattern.sub("", stripped, count=1)
+
+            if stripped == text:
+                return text
+
+            text = stripped
+
+    def truncate(self, text):
+        if self.max_tokens is None:
+            return text
+
+        tokens = list(TOKEN.finditer(text))
+        if len(tokens) <= self.max_tokens:
+            return text
+
+        cut = tokens[self.max_tokens - 1].end()
+
+        # Prefer ending on a whole sentence, unless that loses over half
+        sentence_end = max(text.rfind(mark, 0, cut) for mark in ".!?")
+        if sentence_end >= cut // 2:
+            cut = sentence_end + 1
+
+        return text[:cut].rstrip()
+
+    def normalize_examples(self, examples):
+        """Normalize a list of examples, dropping the ones that end up empty
+        or duplicated. Returns the examples and the bytes before and after."""
+        bytes_before = 0
+        bytes_after = 0
+
+        normalized = {}
+        for example in examples:
+            bytes_before += count_bytes(example)
+
+            example = self.normalize(example)
+            if not example or example in normalized:
+                continue
+
+            normalized[example] = True
+            bytes_after += count_bytes(example)
+
+        return list(normalized), bytes_before, bytes_after
+
+
+def count_bytes(example):
+    if not isinstance(example, str):
+        return 0
+
+    return len(example.encode("utf-8"))
+
+
+def count_tokens(text):
+    return len(TOKEN.findall(text))
@@ -0,0 +1,218 @@
+from shopper.classifier.lamini_classifier import LaminiClassifier
+
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import os
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class HierarchicalLaminiClassifier(LaminiClassifier):
+    """A LaminiClassifier that classifies through a tree of small models,
+    e.g. department -> aisle -> product, instead of one softmax over every
+    class.
+
+    Each class is placed in the tree using the metadata attached with
+    add_metadata_to_class, one level per key in levels. A beam search keeps
+    the beam_width best partial paths at each level, so top-k results can
+    span several aisles.
+    """
+
+    def __init__(
+        self,
+        *args,
+        levels=("department_id", "aisle_id"),
+        beam_width=3,
+        n_jobs=None,
+        **kwargs,
+    ):
+        super().__init__(*args, n_jobs=n_jobs, **kwargs)
+
+        self.levels = tuple(levels)
+        self.beam_width = beam_width
+
+        # Maps a path of level values, e.g. ("19", "61"), to a node model
+        self.node_models = {}
+
+    def get_path(self, class_id):
+        """Get the path of level values for a class from its metadata."""
+        return tuple(
+            str(self.class_table.get_field(class_id, level)) for level in self.levels
+        )
+
+    def train(self):
+        # Form the embeddings
+        X, y = self.get_training_embeddings()
+        X = self.fit_projection(X, y)
+
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        y = np.asarray(y)
+
+        # Label every example at every depth of the tree, the last column is
+        # the class id itself
+        paths = {class_id: self.get_path(class_id) for class_id in set(y.tolist())}
+        labels = [paths[class_id] + (class_id,) for class_id in y.tolist()]
+
+        # Form one training task per node in the tree
+        tasks = {}
+        for depth in range(len(self.levels) + 1):
+            node_rows = {}
+            for row, label in enumerate(labels):
+                node_rows.setdefault(label[:depth], []).append(row)
+
+            for node, rows in node_rows.items():
+                tasks[node] = (
+                    np.asarray(rows, dtype=np.int64),
+                    [labels[row][depth] for row in rows],
+                )
+
+        logger.info(f"Training {len(tasks)} hierarchical node models")
+
+        from shopper.classifier.parallel_training import attach_shared_matrix, share_matrix
+
+        # Train the nodes in parallel. The workers map one shared copy of
+        # the embeddings, and each task only sends the row numbers of its node
+        max_workers = self.n_jobs or os.cpu_count()
+        with share_matrix(X) as shared, ProcessPoolExecutor(
+            max_workers=max_workers,
+            initializer=attach_shared_matrix,
+            initargs=(shared.name, X.shape, X.dtype.str, None),
+        ) as pool:
+            futures = {
+                node: pool.submit(fit_shared_node, rows, node_y)
+                for node, (rows, node_y) in tasks.items()
+            }
+
+            self.node_models = {
+                node: self.fold_projection(future.result()) for node, future in futures.items()
+            }
+
+        self.model_changed()
+
+    def fold_trained_weights(self):
+        self.node_models = {
+            node: self.fold_projection(model) for node, model in self.node_models.items()
+        }
+
+    def get_model_state(self):
+        return (self.node_models, self.levels, self.projection, self.class_table.names)
+
+    def save_shared(self, directory):
+        raise Exception("Shared loading only supports flat classifiers")
+
+    def tune(self, *args, **kwargs):
+        raise Exception("Tuning only supports flat classifiers")
+
+    def beam_search(self, embeddings, beam_width=None):
+        """Find the most likely classes for each embedding.
+
+        Returns a list with one list of (class_id, prob) per embedding, sorted
+        by decreasing probability.
+        """
+        if beam_width is None:
+            beam_width = self.beam_width
+
+        embeddings = np.asarray(embeddings)
+
+        # Each beam is a list of (path, prob) for the matching row
+        beams = [[((), 1.0)] for _ in range(len(embeddings))]
+
+        for depth in range(len(self.levels) + 1):
+            # Group the rows by node so each node model runs once per batch
+            node_rows = {}
+            for row, beam in enumerate(beams):
+                for path, prob in beam:
+                    node_rows.setdefault(path, []).append((row, prob))
+
+            next_beams = [[] for _ in range(len(embeddings))]
+            for path, row_probs in node_rows.items():
+                node = self.node_models[path]
+                rows = [row for row, _ in row_probs]
+                child_probs = node.predict_proba(embeddings[rows])
+
+                for (row, prob), probs in zip(row_probs, child_probs):
+                    for child, child_prob in zip(node.classes_, probs):
+                        next_beams[row].append((path + (child,), prob * child_prob))
+
+            beams = [
+                sorted(beam, key=lambda x: x[1], reverse=True)[:beam_width]
+                for beam in next_beams
+            ]
+
+        return [[(int(path[-1]), prob) for path, prob in beam] for beam in beams]
+
+    def predict_proba_features(self, features):
+        """Dense probabilities over all classes, zero outside the beam."""
+        results = self.beam_search(features)
+
+        probs = np.zeros((len(results), len(self.class_table)))
+        for row, result in enumerate(results):
+            for class_id, prob in result:
+                probs[row, class_id] = prob
+
+        return probs
+
+    def predict_features(self, features):
+        results = self.beam_search(features, beam_width=1)
+
+        return [self.class_table.names[result[0][0]] for result in results]
+
+    def classify_features(self, features, top_n=None, threshold=None, metadata=False):
+        beam_width = self.beam_width
+        if top_n is not None:
+            beam_width = max(beam_width, top_n)
+
+        results = self.beam_search(features, beam_width=beam_width)
+
+        batch_final_probs = []
+        for result in results:
+            final_probs = []
+            for class_id, prob in result:
+                if threshold is None or prob > threshold:
+                    final_prob = {
+                        "class_id": class_id,
+                        "class_name": self.class_table.names[class_id],
+                        "prob": float(prob),
+                    }
+                    if metadata:
+                        final_prob["metadata"] = self.class_table.get_entry(class_id)
+                    final_probs.append(final_prob)
+
+            if top_n is not None:
+                final_probs = final_probs[:top_n]
+            batch_final_probs.append(final_probs)
+
+        return batch_final_probs
+
+
+class ConstantNode:
+    """A node with a single child, which always has probability one."""
+
+    def __init__(self, child):
+        self.classes_ = [child]
+
+    def predict_proba(self, X):
+        return np.ones((len(X), 1))
+
+
+def fit_shared_node(rows, y):
+    from shopper.classifier.parallel_training import shared_training_data
+
+    return fit_node(shared_training_data["X"][rows], y)
+
+
+def fit_node(X, y):
+    from sklearn.linear_model import LogisticRegression
+
+    from shopper.classifier.linear_model import LinearModel
+
+    children = set(y)
+
+    if len(children) == 1:
+        return ConstantNode(children.pop())
+
+    return LinearModel.from_estimator(LogisticRegression(random_state=0).fit(X, y))
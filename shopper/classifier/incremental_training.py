@@ -0,0 +1,33 @@
+import numpy as np
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def train_incremental(X, y, batch_size=10000, epochs=5, seed=0):
+    """Fit a logistic regression with SGD, streaming mini-batches of rows.
+
+    X may be a memory-mapped matrix larger than RAM. Only one mini-batch is
+    copied into memory at a time, as float64 for sklearn. The rows are
+    shuffled every epoch since the matrix is stored class by class.
+    """
+
+    from sklearn.linear_model import SGDClassifier
+
+    classes = np.unique(y)
+    model = SGDClassifier(loss="log_loss", random_state=seed)
+
+    rng = np.random.default_rng(seed)
+
+    for epoch in range(epochs):
+        order = rng.permutation(len(y))
+
+        for start in range(0, len(order), batch_size):
+            # Sorted rows read the memory map sequentially
+            rows = np.sort(order[start : start + batch_size])
+            model.partial_fit(X[rows], y[rows], classes=classes)
+
+        logger.info(f"Finished epoch {epoch + 1} of {epochs}")
+
+    return model
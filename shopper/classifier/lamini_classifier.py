@@ -1,27 +1,52 @@
 from typing import List
-from llama.program.util.run_ai import query_run_embedding
 
-from lamini import LlamaV2Runner, Type, Context
+from shopper.classifier.class_table import (
+    ClassMetadataView,
+    ClassTable,
+    MappedClassTable,
+)
+from shopper.classifier.example_normalizer import ExampleNormalizer, count_bytes
+from shopper.classifier.result_cache import ResultCache
+from shopper.util.jsonl import JsonlWriter, read_jsonl
+from shopper.util.rate_limit import limit, limit_runner
 
 from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from sklearn.linear_model import LogisticRegression
-
-from tqdm import tqdm
-
-from itertools import chain
-
 import os
+import copy
+import time
 import re
+import math
 import random
 import pickle
 import json
-import jsonlines
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+# lamini, sklearn, numpy and tqdm are imported inside the code paths that need them,
+# so that loading a trained classifier stays fast
+
+# Marks a text whose result is not in the result cache
+MISSING = object()
+
+# The example generator and modifier each return five outputs per prompt
+OUTPUTS_PER_PROMPT = 5
+
+# Give up on a class after this many rounds in a row that keep no examples
+MAX_IDLE_ROUNDS = 3
+
+# Generated examples are saved here as they are generated
+SAVED_EXAMPLES_FILENAME = "/app/copyai/models/saved_examples.jsonl"
+
+
+def query_run_embedding(examples, config):
+    from llama.program.util.run_ai import query_run_embedding
+
+    with limit("embedding"):
+        return query_run_embedding(examples, config=config)
+
 
 class LaminiClassifier:
     """A zero shot classifier that uses the Lamini LlamaV2Runner to generate
@@ -38,12 +63,74 @@ class LaminiClassifier:
         generator_from_prompt=None,
         example_modifier=None,
         example_expander=None,
+        n_jobs=1,
+        projection=None,
+        report_projection_accuracy=False,
+        training_matrix_path=None,
+        minibatch_size=None,
+        minibatch_epochs=5,
+        result_cache_size=10000,
+        result_cache_ttl=None,
+        overprovision=1.25,
+        cache_embeddings=None,
+        logistic_regression_params=None,
+        normalize_examples=True,
+        max_example_tokens=128,
     ):
         self.config = config
         self.model_name = model_name
         self.augmented_example_count = augmented_example_count
         self.batch_size = batch_size
 
+        # More than one job trains one-vs-rest heads across a process pool
+        self.n_jobs = n_jobs
+
+        # An optional EmbeddingProjection applied before the classifier
+        self.projection = projection
+        self.report_projection_accuracy = report_projection_accuracy
+        self.projection_report = None
+
+        # Whether the trained weights score the quantized codes of the
+        # projection, see EmbeddingProjection.fold
+        self.projection_folded = True
+
+        # The training embeddings are memory-mapped from this file if it is
+        # set, and streamed through an incremental learner if minibatch_size
+        # is set, so that datasets larger than RAM can be trained
+        self.training_matrix_path = training_matrix_path
+        self.minibatch_size = minibatch_size
+        self.minibatch_epochs = minibatch_epochs
+
+        # Extra LogisticRegression parameters, such as C, solver and
+        # class_weight, usually chosen by tune
+        self.logistic_regression_params = dict(logistic_regression_params or {})
+        self.tuning_report = None
+
+        # Final classify and predict results are cached per model version,
+        # a size of 0 disables the cache
+        self.result_cache_size = result_cache_size
+        self.result_cache_ttl = result_cache_ttl
+        self.result_cache = self.create_result_cache()
+        self.model_version = None
+
+        # Generation asks for this many times the examples still needed, to
+        # cover duplicates and failed generations
+        self.overprovision = overprovision
+        self.generation_stats = {}
+        self.active_learning_report = []
+
+        # Training example embeddings are kept in memory by text, so that
+        # retraining and cross-validation never embed the same example twice.
+        # The cache is a second copy of the training matrix, so it is always
+        # off for memory-mapped and minibatch training, which bound memory
+        bounded_memory = training_matrix_path is not None or minibatch_size is not None
+        if cache_embeddings and bounded_memory:
+            logger.warning(
+                "Not caching embeddings with memory-mapped or minibatch training"
+            )
+        self.cache_embeddings = cache_embeddings is not False and not bounded_memory
+        self.embedding_cache = {}
+
         if generator_from_prompt is None:
             generator_from_prompt = DefaultExampleGenerator
         self.generator_from_prompt = generator_from_prompt
@@ -56,8 +143,14 @@ class LaminiClassifier:
             example_expander = DefaultExampleExpander
         self.example_expander = example_expander
 
-        self.class_ids_to_metadata = {}
-        self.class_names_to_ids = {}
+        # Generated examples are cleaned of assistant preambles and markup,
+        # and truncated, before they are embedded and stored
+        self.example_normalizer = None
+        if normalize_examples:
+            self.example_normalizer = ExampleNormalizer(max_tokens=max_example_tokens)
+
+        # The names and metadata of the classes, indexed by class id
+        self.class_table = ClassTable()
 
         # Examples is a dict of examples, where each row is a different
         # example class, followed by examples of that class
@@ -68,9 +161,142 @@ class LaminiClassifier:
 
         First, augment the examples for each class using the prompts.
         """
+        self.generate_classes(prompts)
+
+        self.train()
+
+    def active_prompt_train(
+        self,
+        prompts: dict,
+        budget=1000,
+        seed_example_count=2,
+        step_example_count=None,
+        classes_per_round=None,
+        folds=3,
+        min_improvement=0.005,
+        patience=2,
+    ):
+        """Trains the classifier, spending generation only on weak classes.
+
+        Every class first gets seed_example_count examples. Then each round
+        cross-validates on the cached embeddings and generates
+        step_example_count more examples for the classes_per_round classes
+        with the highest error rates. Rounds stop when budget LLM calls are
+        spent, no class is misclassified, or the cross-validated accuracy
+        has not improved on its best by min_improvement for patience rounds.
+        """
+        from shopper.classifier.active_learning import (
+            estimate_class_errors,
+            select_weak_classes,
+        )
+
+        if step_example_count is None:
+            step_example_count = self.augmented_example_count
+
+        if classes_per_round is None:
+            classes_per_round = max(1, len(prompts) // 10)
+
+        self.active_learning_report = []
+
+        calls = self.generate_classes(
+            prompts,
+            counts={class_name: seed_example_count for class_name in prompts},
+            budget=budget,
+        )
+
+        best_accuracy = None
+        stalled_rounds = 0
+        while calls < budget:
+            X, y = self.get_training_embeddings()
+            X = self.fit_projection(X, y)
+
+            accuracy, errors = estimate_class_errors(X, y, folds=folds, n_jobs=self.n_jobs)
+
+            weak_class_ids = select_weak_classes(errors, classes_per_round)
+            weak_class_names = [
+                self.class_table.names[class_id] for class_id in weak_class_ids
+            ]
+
+            logger.info(
+                f"Active learning round {len(self.active_learning_report)}: "
+                f"cross-validated accuracy {accuracy:.3f} after {calls} LLM calls, "
+                f"weakest classes {weak_class_names}"
+            )
+
+            self.active_learning_report.append(
+                {
+                    "calls": calls,
+                    "accuracy": accuracy,
+                    "weak_classes": weak_class_names,
+                }
+            )
+
+            if len(weak_class_names) == 0:
+                break
+
+            if best_accuracy is not None and accuracy - best_accuracy < min_improvement:
+                stalled_rounds += 1
+            else:
+                stalled_rounds = 0
+
+            if stalled_rounds >= patience:
+                logger.info("Stopping active learning, accuracy has plateaued")
+                break
+
+            best_accuracy = (
+                accuracy if best_accuracy is None else max(best_accuracy, accuracy)
+            )
+
+            calls += self.generate_classes(
+                {class_name: prompts[class_name] for class_name in weak_class_names},
+                counts={
+                    class_name: len(self.examples.get(class_name, []))
+                    + step_example_count
+                    for class_name in weak_class_names
+                },
+                budget=budget - calls,
+            )
+
+        self.train()
+
+    def generate_classes(self, prompts, counts=None, budget=None):
+        """Generate examples for each class from its prompt, up to its count
+        in counts or augmented_example_count.
+
+        Classes are skipped once budget LLM calls are spent. Returns the
+        number of LLM calls made.
+        """
+        from tqdm import tqdm
+
+        calls = 0
+
+        def generate(class_name, prompt, original_examples):
+            nonlocal calls
+
+            if budget is not None and calls >= budget:
+                logger.info(f"LLM call budget spent, skipping class '{class_name}'")
+                return original_examples
+
+            count = None if counts is None else counts[class_name]
+
+            stats = {}
+            examples = self.generate_examples_from_prompt(
+                class_name, prompt, original_examples, count=count, stats=stats
+            )
+            calls += stats.get("calls", 0)
+
+            return examples
+
+        # Each class is embedded into the embedding cache as soon as its
+        # generation finishes, so that the embedding service works while the
+        # LLM generates the next classes, and train finds every embedding
+        # cached
+        embedding_pool = ThreadPoolExecutor(max_workers=1) if self.cache_embeddings else None
+        embedding_tasks = []
+
         with ThreadPoolExecutor(max_workers=1) as thread_pool:
             # Generate examples from prompts
-            generation_tasks = []
+            generation_tasks = {}
 
             for class_name, prompt in prompts.items():
                 logger.info(
@@ -80,20 +306,32 @@ class LaminiClassifier:
 
                 # submit the generation task to the thread pool
                 generated_examples = thread_pool.submit(
-                    self.generate_examples_from_prompt,
+                    generate,
                     class_name,
                     prompt,
                     self.examples.get(class_name, []),
                 )
 
-                # save the future
-                generation_tasks.append(generated_examples)
+                # save the future with its class
+                generation_tasks[generated_examples] = class_name
 
             # Wait for all the generation tasks to finish
-            for class_name, generated_examples in zip(tqdm(prompts.keys()), as_completed(generation_tasks)):
+            for generated_examples in tqdm(
+                as_completed(generation_tasks), total=len(generation_tasks)
+            ):
+                class_name = generation_tasks[generated_examples]
                 try:
                     self.examples[class_name] = generated_examples.result()
 
+                    if embedding_pool is not None:
+                        embedding_tasks.append(
+                            embedding_pool.submit(
+                                self.prefetch_embeddings,
+                                class_name,
+                                self.examples[class_name],
+                            )
+                        )
+
                     # Save partial progress
                     self.save_examples()
                 except Exception as e:
@@ -104,21 +342,287 @@ class LaminiClassifier:
                         "Consider rerunning the generation task if the error is transient, e.g. 500"
                     )
 
-        self.train()
+        if embedding_pool is not None:
+            start = time.time()
+            embedding_pool.shutdown(wait=True)
+
+            logger.info(
+                f"Waited {time.time() - start:.1f}s for the embeddings of "
+                f"{len(embedding_tasks)} classes after generation finished"
+            )
+
+        return calls
 
     def train(self):
         # Form the embeddings
-        X = []
-        y = []
+        X, y = self.get_training_embeddings()
+        X = self.fit_projection(X, y)
+
+        # Train the classifier
+        from sklearn.linear_model import LogisticRegression
 
+        from shopper.classifier.incremental_training import train_incremental
+        from shopper.classifier.linear_model import LinearModel
+        from shopper.classifier.parallel_training import train_one_vs_rest
+
+        if self.minibatch_size is not None:
+            model = train_incremental(
+                X, y, batch_size=self.minibatch_size, epochs=self.minibatch_epochs
+            )
+        elif self.n_jobs == 1:
+            model = LogisticRegression(
+                random_state=0, **self.logistic_regression_params
+            ).fit(X, y)
+        else:
+            model = train_one_vs_rest(
+                X, y, n_jobs=self.n_jobs, **self.logistic_regression_params
+            )
+
+        # Only the float32 weights are kept, so that inference never needs
+        # scikit-learn
+        self.logistic_regression = self.fold_projection(LinearModel.from_estimator(model))
+
+        self.model_changed()
+
+    def evaluate(self, folds=5, top_k=5, n_jobs=None):
+        """Cross-validate the current LogisticRegression parameters on the
+        training examples, see tune."""
+        return self.tune(
+            grid={name: [value] for name, value in self.logistic_regression_params.items()},
+            folds=folds,
+            top_k=top_k,
+            n_jobs=n_jobs,
+            apply=False,
+        )[0]
+
+    def tune(self, grid=None, folds=5, top_k=5, n_jobs=None, tolerance=0.005, apply=True):
+        """Search a grid of LogisticRegression parameters with k-fold
+        cross-validation on the training examples.
+
+        The examples are embedded once, through the embedding cache, into
+        one matrix that every fold and configuration maps. Each result has
+        the accuracy, top-k accuracy, fit seconds and predict latency of a
+        configuration. If apply is set, the cheapest configuration within
+        tolerance of the best accuracy is used by the next train. Returns
+        the results, best accuracy first.
+        """
+        from shopper.classifier.model_selection import (
+            DEFAULT_GRID,
+            cross_validate,
+            expand_grid,
+            format_results,
+            select_configuration,
+        )
+
+        if grid is None:
+            grid = DEFAULT_GRID
+
+        if self.minibatch_size is not None:
+            logger.warning("Minibatch training ignores the LogisticRegression parameters")
+
+        # The projection is fitted on a copy, so that evaluating never
+        # changes the projection the trained weights expect
+        X, y = self.get_training_embeddings()
+        X = self.fit_projection_copy(X)
+
+        results = cross_validate(
+            X,
+            y,
+            expand_grid(grid),
+            folds=folds,
+            top_k=top_k,
+            n_jobs=self.n_jobs if n_jobs is None else n_jobs,
+        )
+
+        logger.info("Cross-validation results:\n" + format_results(results))
+
+        if apply:
+            selected = select_configuration(results, tolerance=tolerance)
+            self.logistic_regression_params = dict(selected["params"])
+
+            logger.info(
+                f"Selected {selected['params']} with accuracy {selected['accuracy']:.4f}"
+            )
+
+            self.tuning_report = {"selected": selected, "results": results}
+
+        return results
+
+    def model_changed(self):
+        """Invalidate everything derived from the weights after training."""
+        self.model_version = None
+
+        if self.result_cache is not None:
+            self.result_cache.clear()
+
+    def get_model_state(self):
+        """Everything that determines the classifier's outputs."""
+        return (self.logistic_regression, self.projection, self.class_table.names)
+
+    def get_model_version(self):
+        """A fingerprint of the trained weights, computed once per training."""
+        if self.model_version is None:
+            import hashlib
+
+            self.model_version = hashlib.blake2b(
+                pickle.dumps(self.get_model_state()), digest_size=16
+            ).hexdigest()
+
+        return self.model_version
+
+    def create_result_cache(self):
+        if not self.result_cache_size:
+            return None
+
+        return ResultCache(max_size=self.result_cache_size, ttl=self.result_cache_ttl)
+
+    def lookup_results(self, texts, key):
+        """Look up cached results, returning copies of them with MISSING for
+        the texts that still need to be computed, and the unique missing
+        texts."""
+        if self.result_cache is None:
+            return [MISSING] * len(texts), list(texts)
+
+        version = self.get_model_version()
+
+        # Callers own the results they get, so that changing one never
+        # changes what the cache serves next
+        results = [self.result_cache.get((version, key, text), MISSING) for text in texts]
+        results = [result if result is MISSING else copy.deepcopy(result) for result in results]
+
+        missing = list(
+            dict.fromkeys(
+                text for text, result in zip(texts, results) if result is MISSING
+            )
+        )
+
+        return results, missing
+
+    def fill_results(self, texts, key, results, missing, computed):
+        """Cache the computed results and fill them into results."""
+        computed = dict(zip(missing, computed))
+
+        if self.result_cache is not None:
+            version = self.get_model_version()
+            for text, result in computed.items():
+                self.result_cache.put((version, key, text), copy.deepcopy(result))
+
+        return [
+            computed[text] if result is MISSING else result
+            for text, result in zip(texts, results)
+        ]
+
+    def get_training_embeddings(self):
+        """Embed the examples for every class, returning the inputs and labels.
+
+        The embeddings are written class by class into one preallocated
+        float32 matrix, memory-mapped if training_matrix_path is set.
+        """
+        import numpy as np
+        from tqdm import tqdm
+
+        count = sum(len(examples) for examples in self.examples.values())
+
+        X = None
+        y = np.empty(count, dtype=np.int64)
+
+        offset = 0
         for class_name, examples in tqdm(self.examples.items()):
+            if len(examples) == 0:
+                continue
+
             index = self.class_names_to_ids[class_name]
-            y += [index] * len(examples)
-            class_embeddings = self.get_embeddings(examples)
-            X += class_embeddings
+            class_embeddings = self.get_training_example_embeddings(examples)
 
-        # Train the classifier
-        self.logistic_regression = LogisticRegression(random_state=0).fit(X, y)
+            # The embedding width is only known after the first class
+            if X is None:
+                X = self.allocate_training_matrix(count, class_embeddings.shape[1])
+
+            X[offset : offset + len(examples)] = class_embeddings
+            y[offset : offset + len(examples)] = index
+            offset += len(examples)
+
+        return X, y
+
+    def prefetch_embeddings(self, class_name, examples):
+        """Embed examples into the embedding cache ahead of training."""
+        try:
+            self.get_training_example_embeddings(examples)
+        except Exception as e:
+            # train embeds whatever is missing from the cache again
+            logger.error(f"Failed to embed examples for class '{class_name}'")
+            logger.error(e)
+
+    def get_training_example_embeddings(self, examples):
+        """Embed training examples as float32, reusing cached embeddings."""
+        import numpy as np
+
+        if not self.cache_embeddings:
+            return np.asarray(self.get_embeddings(examples), dtype=np.float32)
+
+        missing = list(
+            dict.fromkeys(example for example in examples if example not in self.embedding_cache)
+        )
+
+        if len(missing) > 0:
+            embeddings = np.asarray(self.get_embeddings(missing), dtype=np.float32)
+            self.embedding_cache.update(zip(missing, embeddings))
+
+        return np.stack([self.embedding_cache[example] for example in examples])
+
+    def allocate_training_matrix(self, rows, width):
+        import numpy as np
+
+        if self.training_matrix_path is None:
+            return np.empty((rows, width), dtype=np.float32)
+
+        logger.info(
+            f"Memory-mapping a {rows} x {width} training matrix at {self.training_matrix_path}"
+        )
+
+        return np.lib.format.open_memmap(
+            self.training_matrix_path, mode="w+", dtype=np.float32, shape=(rows, width)
+        )
+
+    def fit_projection(self, X, y):
+        """Fit the projection, if any, and return the projected inputs as the
+        float32 values of their quantized codes."""
+        if self.projection is None:
+            return X
+
+        if self.report_projection_accuracy:
+            from shopper.classifier.projection import compare_projection_accuracy
+
+            self.projection_report = compare_projection_accuracy(
+                X, y, self.projection
+            )
+
+        return self.projection.decode(self.projection.fit_transform(X))
+
+    def fit_projection_copy(self, X):
+        """Like fit_projection, but fits a copy of the projection and leaves
+        the classifier's own untouched."""
+        if self.projection is None:
+            return X
+
+        projection = copy.deepcopy(self.projection)
+
+        return projection.decode(projection.fit_transform(X))
+
+    def fold_projection(self, model):
+        """Make a model trained on fit_projection's inputs score the codes
+        that get_features returns."""
+        if self.projection is None:
+            return model
+
+        return self.projection.fold(model)
+
+    def fold_trained_weights(self):
+        """Fold the projection into weights trained before the features
+        were quantized codes."""
+        model = getattr(self, "logistic_regression", None)
+        if model is not None:
+            self.logistic_regression = self.fold_projection(model)
 
     def add_data_to_class(self, class_name, examples):
         if not isinstance(examples, list):
@@ -131,15 +635,22 @@ class LaminiClassifier:
         self.examples[class_name] += examples
 
     def add_class(self, class_name):
-        if not class_name in self.class_names_to_ids:
-            class_id = len(self.class_names_to_ids)
-            self.class_names_to_ids[class_name] = class_id
-            self.class_ids_to_metadata[class_id] = {"class_name": class_name}
+        self.class_table.add_class(class_name)
 
     def add_metadata_to_class(self, class_name, metadata):
-        self.class_ids_to_metadata[self.class_names_to_ids[class_name]][
-            "metadata"
-        ] = metadata
+        self.class_table.set_metadata(self.class_table.ids[class_name], metadata)
+
+        # Results with metadata include the old metadata
+        self.model_changed()
+
+    @property
+    def class_names_to_ids(self):
+        return self.class_table.ids
+
+    @property
+    def class_ids_to_metadata(self):
+        """Read only, each class as {"class_name": ..., "metadata": ...}."""
+        return ClassMetadataView(self.class_table)
 
     def get_data(self):
         return self.examples
@@ -151,47 +662,100 @@ class LaminiClassifier:
 
         return [embedding[0] for embedding in embeddings]
 
+    def get_features(self, text):
+        """Get the classifier inputs for text, projected if configured."""
+        embeddings = self.get_embeddings(text)
+
+        if self.projection is None:
+            return embeddings
+
+        return self.projection.transform(embeddings)
+
     def predict_proba(self, text):
-        return self.logistic_regression.predict_proba(self.get_embeddings(text))
+        return self.predict_proba_features(self.get_features(text))
+
+    def predict_proba_features(self, features):
+        return self.logistic_regression.predict_proba(features)
 
     def predict(self, text):
         if not isinstance(text, list):
             raise Exception("Text to predict must be a list of string(s)")
 
-        probs = self.predict_proba(text)
+        results, missing = self.lookup_results(text, "predict")
 
-        # select the class with the highest probability, note that text and
-        # probs are lists of arbitrary length
-        winning_classes = [
-            max(enumerate(prob), key=lambda x: x[1])[0] for prob in probs
-        ]
+        computed = []
+        if len(missing) > 0:
+            computed = self.predict_features(self.get_features(missing))
+
+        return self.fill_results(text, "predict", results, missing, computed)
+
+    def predict_features(self, features):
+        """Predict class names for already embedded text, see predict."""
+        probs = self.predict_proba_features(features)
+
+        import numpy as np
+
+        # select the class with the highest probability, one row per text.
+        # The columns are the trained classes, which leave out any class
+        # without examples, so map them back to class ids
+        classes = np.asarray(self.logistic_regression.classes_)
+        winning_classes = classes[np.argmax(probs, axis=1)].tolist()
 
         # convert the class ids to class names
-        return [
-            list(self.class_names_to_ids.keys())[class_id]
-            for class_id in winning_classes
-        ]
+        return [self.class_table.names[class_id] for class_id in winning_classes]
 
     def classify(self, text, top_n=None, threshold=None, metadata=False):
         is_singleton = True if isinstance(text, str) else False
+        texts = [text] if is_singleton else text
+
+        key = ("classify", top_n, threshold, bool(metadata))
+        results, missing = self.lookup_results(texts, key)
+
+        computed = []
+        if len(missing) > 0:
+            computed = self.classify_features(
+                self.get_features(missing),
+                top_n=top_n,
+                threshold=threshold,
+                metadata=metadata,
+            )
+
+        batch_final_probs = self.fill_results(texts, key, results, missing, computed)
+
+        return batch_final_probs if not is_singleton else batch_final_probs[0]
+
+    def classify_features(self, features, top_n=None, threshold=None, metadata=False):
+        """Classify already embedded text, see classify."""
+        import numpy as np
 
-        batch_probs = self.predict_proba(text)
+        batch_probs = self.predict_proba_features(features)
+
+        # The class id of each column, see predict_features
+        classes = np.asarray(self.logistic_regression.classes_)
 
         batch_final_probs = []
         for probs in batch_probs:
+            # Only the top_n most likely classes can make it into the result,
+            # so avoid visiting every class
+            if top_n is not None and top_n < len(probs):
+                candidates = np.argpartition(probs, -top_n)[-top_n:]
+            else:
+                candidates = range(len(probs))
+
             final_probs = []
-            for class_id, prob in enumerate(probs):
+            for column in candidates:
+                class_id = int(classes[column])
+                # A plain float, the scores are float32 which json cannot encode
+                prob = float(probs[column])
                 if threshold is None or prob > threshold:
-                    # Include the metadata if requested
-                    class_name = self.class_ids_to_metadata[class_id]["class_name"]
                     final_prob = {
                         "class_id": class_id,
-                        "class_name": class_name,
+                        "class_name": self.class_table.names[class_id],
                         "prob": prob,
                     }
+                    # Include the metadata if requested
                     if metadata:
-                        metadata = self.class_ids_to_metadata[class_id]
-                        final_prob["metadata"] = metadata
+                        final_prob["metadata"] = self.class_table.get_entry(class_id)
                     final_probs.append(final_prob)
 
             # Sort the final_probs, a list of dicts each with a key "prob"
@@ -201,8 +765,166 @@ class LaminiClassifier:
                 sorted_probs = sorted_probs[:top_n]
             batch_final_probs.append(sorted_probs)
 
+        return batch_final_probs
+
+    def get_cache_stats(self):
+        """Hit rate and size of the result cache."""
+        if self.result_cache is None:
+            return None
+
+        return self.result_cache.get_stats()
+
+    def get_coalescer(self):
+        """The embedding coalescer for the running event loop."""
+        import asyncio
+
+        from shopper.classifier.coalescer import EmbeddingCoalescer
+
+        coalescer = getattr(self, "coalescer", None)
+
+        if coalescer is None or coalescer.loop is not asyncio.get_running_loop():
+            # The coalescer is bound to its event loop, but the worker threads
+            # are not, so every coalescer reuses the classifier's pool
+            coalescer = EmbeddingCoalescer(
+                self.get_embeddings,
+                max_batch_size=self.batch_size * 10,
+                executor=self.get_embedding_executor(),
+            )
+            self.coalescer = coalescer
+
+        return coalescer
+
+    def get_embedding_executor(self):
+        """The worker threads that run the async embedding requests."""
+        executor = getattr(self, "embedding_executor", None)
+
+        if executor is None:
+            executor = ThreadPoolExecutor(max_workers=8)
+            self.embedding_executor = executor
+
+        return executor
+
+    def close(self):
+        """Shut down the worker threads of the async methods."""
+        executor = getattr(self, "embedding_executor", None)
+
+        if executor is not None:
+            executor.shutdown(wait=False)
+
+        self.embedding_executor = None
+        self.coalescer = None
+
+    async def aget_embeddings(self, examples):
+        """Like get_embeddings, but merges concurrent calls into batches
+        without blocking the event loop."""
+        if isinstance(examples, str):
+            examples = [examples]
+
+        return await self.get_coalescer().embed(examples)
+
+    async def aget_features(self, text):
+        embeddings = await self.aget_embeddings(text)
+
+        if self.projection is None:
+            return embeddings
+
+        return self.projection.transform(embeddings)
+
+    async def apredict_proba(self, text):
+        return self.predict_proba_features(await self.aget_features(text))
+
+    async def apredict(self, text):
+        if not isinstance(text, list):
+            raise Exception("Text to predict must be a list of string(s)")
+
+        results, missing = self.lookup_results(text, "predict")
+
+        computed = []
+        if len(missing) > 0:
+            computed = self.predict_features(await self.aget_features(missing))
+
+        return self.fill_results(text, "predict", results, missing, computed)
+
+    async def aclassify(self, text, top_n=None, threshold=None, metadata=False):
+        is_singleton = True if isinstance(text, str) else False
+        texts = [text] if is_singleton else text
+
+        key = ("classify", top_n, threshold, bool(metadata))
+        results, missing = self.lookup_results(texts, key)
+
+        computed = []
+        if len(missing) > 0:
+            computed = self.classify_features(
+                await self.aget_features(missing),
+                top_n=top_n,
+                threshold=threshold,
+                metadata=metadata,
+            )
+
+        batch_final_probs = self.fill_results(texts, key, results, missing, computed)
+
         return batch_final_probs if not is_singleton else batch_final_probs[0]
 
+    def __getstate__(self):
+        # The coalescer is bound to an event loop and the result cache holds a
+        # lock, neither is saved with the classifier, nor are its threads or
+        # the cached training embeddings
+        state = self.__dict__.copy()
+        state.pop("coalescer", None)
+        state.pop("embedding_executor", None)
+        state.pop("result_cache", None)
+        state.pop("embedding_cache", None)
+        return state
+
+    def __setstate__(self, state):
+        # Classifiers saved before these options existed load with the defaults
+        self.__dict__.update(
+            {
+                "n_jobs": 1,
+                "projection": None,
+                "report_projection_accuracy": False,
+                "projection_report": None,
+                "projection_folded": False,
+                "training_matrix_path": None,
+                "minibatch_size": None,
+                "minibatch_epochs": 5,
+                "result_cache_size": 10000,
+                "result_cache_ttl": None,
+                "model_version": None,
+                "overprovision": 1.25,
+                "generation_stats": {},
+                "active_learning_report": [],
+                "cache_embeddings": False,
+                "logistic_regression_params": {},
+                "tuning_report": None,
+                "example_normalizer": ExampleNormalizer(),
+            }
+        )
+        # Classifiers saved before the class table kept the classes in dicts
+        if "class_table" not in state:
+            state = dict(state)
+            state["class_table"] = ClassTable.from_dicts(
+                state.pop("class_names_to_ids"), state.pop("class_ids_to_metadata")
+            )
+
+        self.__dict__.update(state)
+
+        # Classifiers saved with a scikit-learn model switch to the numpy
+        # inference path
+        model = state.get("logistic_regression")
+        if model is not None and type(model).__name__ != "LinearModel":
+            from shopper.classifier.linear_model import LinearModel
+
+            self.logistic_regression = LinearModel.from_estimator(model)
+
+        # Classifiers saved when the projection decoded its codes to float32
+        if not self.projection_folded:
+            self.fold_trained_weights()
+            self.projection_folded = True
+
+        self.result_cache = self.create_result_cache()
+        self.embedding_cache = {}
+
     def dumps(self):
         return pickle.dumps(self)
 
@@ -219,61 +941,233 @@ class LaminiClassifier:
         with open(filename, "rb") as f:
             return LaminiClassifier.loads(f.read())
 
-    def create_new_example_generator(self, prompt, original_examples):
-        example_generator = self.generator_from_prompt(
-            prompt,
-            config=self.config,
-            model_name=self.model_name,
-            batch_size=self.batch_size // 5,
-        )
-        example_modifier = self.example_modifier(
-            config=self.config, model_name=self.model_name, batch_size=self.batch_size // 5
+    def save_shared(self, directory):
+        """Save the classifier for serving from several processes, see load_shared.
+
+        The weights and the class table are written as flat files next to a
+        small pickle of everything else. The training examples are left out.
+        """
+        from shopper.classifier.linear_model import LinearModel
+
+        os.makedirs(directory, exist_ok=True)
+
+        LinearModel.from_estimator(self.logistic_regression).save(directory)
+        self.class_table.save(directory)
+
+        state = self.__getstate__()
+        state["logistic_regression"] = None
+        state["class_table"] = None
+        state["examples"] = {}
+        state["model_version"] = self.get_model_version()
+
+        with open(os.path.join(directory, "classifier.pkl"), "wb") as f:
+            pickle.dump((type(self), state), f)
+
+    @staticmethod
+    def load_shared(directory):
+        """Load a classifier saved by save_shared, memory-mapping its weights
+        and class table read only.
+
+        Every process that loads the same directory maps the same pages, so
+        N workers share one physical copy of the model. Put the directory on
+        /dev/shm to keep it in shared memory rather than on disk. The loaded
+        classifier can classify but not train.
+        """
+        from shopper.classifier.linear_model import LinearModel
+
+        with open(os.path.join(directory, "classifier.pkl"), "rb") as f:
+            cls, state = pickle.load(f)
+
+        classifier = cls.__new__(cls)
+        classifier.__setstate__(state)
+
+        classifier.logistic_regression = LinearModel.load(directory, mmap_mode="r")
+        classifier.class_table = MappedClassTable(directory)
+
+        return classifier
+
+    def create_new_example_generator(
+        self, prompt, original_examples, stats=None, count=None
+    ):
+        """Yield new examples until the class has count examples, by default
+        augmented_example_count.
+
+        Each round sizes every phase to the examples still needed, times the
+        overprovision factor, instead of always running full batches whose
+        output is mostly discarded once the target is reached. Empty and
+        duplicate examples are dropped after normalization. The number of LLM
+        calls, features, generated examples, kept examples and the bytes of
+        the examples before and after normalization are counted in stats.
+        """
+        if stats is None:
+            stats = {}
+        stats.update(
+            {
+                "calls": 0,
+                "features": 0,
+                "generated": 0,
+                "kept": 0,
+                "bytes_generated": 0,
+                "bytes_kept": 0,
+            }
         )
+
+        if count is None:
+            count = self.augmented_example_count
+
         example_expander = self.example_expander(
             prompt, config=self.config, model_name=self.model_name
         )
 
+        max_prompts = max(1, self.batch_size // OUTPUTS_PER_PROMPT)
+
         examples = original_examples.copy()
+        seen = set(examples)
 
         index = len(examples)
+        rounds = 0
+        idle_rounds = 0
 
-        while True:
-            # Phase 1: Generate example types from prompt
-            compressed_example_features = example_generator.generate_examples(
-                seed=index, examples=examples
+        while index < count:
+            needed = math.ceil(
+                (count - index) * self.overprovision
             )
 
-            # Phase 2: Modify the features to be more diverse
-            different_example_features = example_modifier.modify_examples(
-                compressed_example_features
+            # Phase 1: Generate example types from prompt
+            example_generator = self.generator_from_prompt(
+                prompt,
+                config=self.config,
+                model_name=self.model_name,
+                batch_size=min(max_prompts, self.get_prompt_count(needed)),
+            )
+            compressed_example_features = list(
+                example_generator.generate_examples(
+                    seed=index + rounds, examples=examples
+                )
             )
 
-            different_example_features = chain(
-                different_example_features, compressed_example_features
+            # Phase 2: Modify the features to be more diverse, only if the
+            # generated features are not enough on their own
+            different_example_features = []
+            modifier_prompts = min(
+                max_prompts,
+                self.get_prompt_count(needed - len(compressed_example_features)),
             )
+            if modifier_prompts > 0:
+                example_modifier = self.example_modifier(
+                    config=self.config,
+                    model_name=self.model_name,
+                    batch_size=modifier_prompts,
+                )
+                different_example_features = list(
+                    example_modifier.modify_examples(compressed_example_features)
+                )
 
-            different_example_features_batches = self.batchify(
-                different_example_features
+            features = (different_example_features + compressed_example_features)[
+                :needed
+            ]
+            stats["features"] += len(different_example_features) + len(
+                compressed_example_features
             )
+            stats["calls"] += self.get_prompt_count(
+                len(different_example_features)
+            ) + self.get_prompt_count(len(compressed_example_features))
+
+            rounds += 1
+            kept = 0
 
             # Phase 3: Expand examples from features
-            for features_batches in different_example_features_batches:
-                expanded_example_batch = example_expander.expand_example(
-                    features_batches
+            for features_batch in self.batchify(features):
+                expanded_example_batch = list(
+                    example_expander.expand_example(features_batch)
                 )
+                stats["calls"] += len(features_batch)
+                stats["generated"] += len(expanded_example_batch)
 
                 for expanded_example in expanded_example_batch:
+                    stats["bytes_generated"] += count_bytes(expanded_example)
+
+                    expanded_example = self.normalize_example(expanded_example)
+                    if not expanded_example or expanded_example in seen:
+                        continue
+
+                    stats["bytes_kept"] += count_bytes(expanded_example)
+
                     logger.debug(
-                        f"Generated example number {index} out of {self.augmented_example_count}"
+                        f"Generated example number {index} out of {count}"
                     )
 
                     index += 1
+                    kept += 1
+                    stats["kept"] += 1
+                    seen.add(expanded_example)
                     examples.append(expanded_example)
                     yield expanded_example
 
-                    if index >= self.augmented_example_count:
+                    if index >= count:
                         return
 
+            idle_rounds = idle_rounds + 1 if kept == 0 else 0
+            if idle_rounds >= MAX_IDLE_ROUNDS:
+                logger.warning(
+                    f"Stopping generation after {idle_rounds} rounds without a new example"
+                )
+                return
+
+    def normalize_example(self, example):
+        if self.example_normalizer is None:
+            return example
+
+        return self.example_normalizer.normalize(example)
+
+    def normalize_stored_examples(self):
+        """Normalize the examples already stored for every class, as new
+        examples are, see the normalize-examples command. Returns the bytes
+        before and after per class, and drops the embeddings of examples that
+        no longer exist."""
+        report = {}
+
+        if self.example_normalizer is None:
+            return report
+
+        for class_name, examples in self.examples.items():
+            if isinstance(examples, str):
+                examples = [examples]
+
+            normalized, bytes_before, bytes_after = (
+                self.example_normalizer.normalize_examples(examples)
+            )
+            self.examples[class_name] = normalized
+
+            report[class_name] = {
+                "examples_before": len(examples),
+                "examples_after": len(normalized),
+                "bytes_before": bytes_before,
+                "bytes_after": bytes_after,
+                "bytes_saved": bytes_before - bytes_after,
+            }
+
+        kept = set(
+            example for examples in self.examples.values() for example in examples
+        )
+        self.embedding_cache = {
+            example: embedding
+            for example, embedding in self.embedding_cache.items()
+            if example in kept
+        }
+
+        saved = sum(entry["bytes_saved"] for entry in report.values())
+        if saved > 0:
+            logger.info(
+                f"Normalizing the stored examples of {len(report)} classes saved {saved} bytes"
+            )
+
+        return report
+
+    def get_prompt_count(self, needed):
+        """The number of prompts whose outputs cover needed examples."""
+        return max(0, math.ceil(needed / OUTPUTS_PER_PROMPT))
+
     def batchify(self, examples):
         batches = []
         # handle batches that are smaller than batch_size
@@ -284,50 +1178,73 @@ class LaminiClassifier:
 
         return batches
 
-    def generate_examples_from_prompt(self, class_name, prompt, original_examples):
+    def generate_examples_from_prompt(
+        self, class_name, prompt, original_examples, count=None, stats=None
+    ):
+        from tqdm import tqdm
+
+        if count is None:
+            count = self.augmented_example_count
+
+        if stats is None:
+            stats = {}
+
         examples = []
         if isinstance(original_examples, str):
             original_examples = [original_examples]
 
         # No need to generate more examples if we already have enough
-        if len(original_examples) >= self.augmented_example_count:
+        if len(original_examples) >= count:
             logger.debug(
                 f"Already have enough examples ({len(original_examples)}) for class '{class_name}', not generating more"
             )
             return original_examples
 
         for example in tqdm(
-            self.create_new_example_generator(prompt, original_examples),
-            total=self.augmented_example_count,
+            self.create_new_example_generator(
+                prompt, original_examples, stats, count=count
+            ),
+            total=count - len(original_examples),
         ):
             examples.append(example)
 
-            if len(examples) >= self.augmented_example_count:
+            if len(examples) + len(original_examples) >= count:
                 break
 
+        # Counts add up across the rounds of active learning
+        totals = self.generation_stats.setdefault(class_name, {})
+        for key, value in stats.items():
+            totals[key] = totals.get(key, 0) + value
+
+        logger.info(
+            f"Kept {stats['kept']} of {stats['generated']} generated examples, "
+            f"from {stats['features']} features in {stats['calls']} LLM calls, "
+            f"for class '{class_name}', normalization saved "
+            f"{stats['bytes_generated'] - stats['bytes_kept']} bytes"
+        )
+
         return examples + original_examples
 
     def load_examples(self):
-        filename = "/app/copyai/models/saved_examples.jsonl"
+        filename = SAVED_EXAMPLES_FILENAME
         if not os.path.exists(filename):
             return {}
 
-        # load the examples from the jsonl file using the jsonlines library
-        with jsonlines.open(filename) as reader:
-            examples = {}
-            for row in reader:
-                class_name = row["class_name"]
-                example = row["examples"]
-                self.add_class(class_name)
-                examples[class_name] = example
+        # load the examples from the jsonl file
+        examples = {}
+        for row in read_jsonl(filename):
+            class_name = row["class_name"]
+            example = row["examples"]
+            self.add_class(class_name)
+            examples[class_name] = example
 
         return examples
 
     def save_examples(self):
-        filename = "/app/copyai/models/saved_examples.jsonl"
+        filename = SAVED_EXAMPLES_FILENAME
 
-        # save the examples as a jsonl file using the jsonlines library
-        with jsonlines.open(filename, "w") as writer:
+        # save the examples as a jsonl file
+        with JsonlWriter(filename, "w") as writer:
             for class_name, example in self.examples.items():
                 row = {
                     "class_name": class_name,
@@ -357,6 +1274,8 @@ class DefaultExampleGenerator:
             seed=seed, examples=examples
         )
 
+        from lamini import LlamaV2Runner, Type, Context
+
         class FiveOutputs(Type):
             example_1: str = Context("")
             example_2: str = Context("")
@@ -364,7 +1283,7 @@ class DefaultExampleGenerator:
             example_4: str = Context("")
             example_5: str = Context("")
 
-        runner = LlamaV2Runner(config=self.config, model_name=self.model_name)
+        runner = limit_runner(LlamaV2Runner(config=self.config, model_name=self.model_name))
 
         results = runner(
             inputs=prompt_batch,
@@ -386,9 +1305,11 @@ class DefaultExampleGenerator:
 
         prompts = []
 
+        # Each prompt in the batch gets its own seed, so the batch is the same
+        # no matter which thread builds it
         for i in range(batch_size):
             prompt, system_prompt = self.get_prompt_and_system_prompt(
-                seed=seed, examples=examples
+                seed=seed * self.batch_size + i, examples=examples
             )
 
             prompts.append(prompt)
@@ -411,9 +1332,10 @@ class DefaultExampleGenerator:
 
         prompt = ""
 
-        # Randomly shuffle the examples
-        random.seed(seed)
-        random.shuffle(examples)
+        # Randomly shuffle a copy of the examples, with a private random number
+        # generator so that concurrent generators do not share state
+        examples = examples.copy()
+        random.Random(seed).shuffle(examples)
 
         # Include examples if they are available
         if len(examples) > 0:
@@ -461,6 +1383,8 @@ class DefaultExampleModifier:
     def modify_examples(self, examples):
         prompts, system_prompt = self.get_prompt_batch(examples)
 
+        from lamini import LlamaV2Runner, Type, Context
+
         class FiveOutputs(Type):
             example_1: str = Context("")
             example_2: str = Context("")
@@ -468,7 +1392,7 @@ class DefaultExampleModifier:
             example_4: str = Context("")
             example_5: str = Context("")
 
-        runner = LlamaV2Runner(config=self.config, model_name=self.model_name)
+        runner = limit_runner(LlamaV2Runner(config=self.config, model_name=self.model_name))
 
         results = runner(
             inputs=prompts, system_prompt=system_prompt, output_type=FiveOutputs
@@ -507,9 +1431,9 @@ class DefaultExampleModifier:
 
         examples = existing_examples.copy()
 
-        # Randomly shuffle the examples
-        random.seed(seed)
-        random.shuffle(examples)
+        # Randomly shuffle the examples, with a private random number generator
+        # so that concurrent modifiers do not share state
+        random.Random(seed).shuffle(examples)
 
         example_count = min(5, len(examples))
 
@@ -550,7 +1474,9 @@ class DefaultExampleExpander:
         self.model_name = model_name
 
     def expand_example(self, example_batch):
-        runner = LlamaV2Runner(config=self.config, model_name=self.model_name)
+        from lamini import LlamaV2Runner
+
+        runner = limit_runner(LlamaV2Runner(config=self.config, model_name=self.model_name))
 
         prompts, system_prompt = self.get_prompt_batch(example_batch)
 
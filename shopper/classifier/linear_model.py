@@ -0,0 +1,149 @@
+import numpy as np
+
+import os
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class LinearModel:
+    """An inference only linear classifier over exported weights.
+
+    Scores are X @ coef.T + intercept. The "softmax" link turns them into
+    multinomial probabilities, and the "ovr" link into normalized one-vs-rest
+    sigmoids, matching sklearn's LogisticRegression, SGDClassifier and
+    OneVsRestClassifier, and the LinearModel built by train_one_vs_rest.
+    The weights can be saved as .npy files and loaded memory-mapped, so that
+    processes mapping the same files share one copy.
+    """
+
+    def __init__(self, classes, coef, intercept, link="softmax"):
+        if link not in ("softmax", "ovr"):
+            raise Exception(f"Unknown link '{link}'")
+
+        self.classes_ = classes
+        self.coef_ = coef
+        self.intercept_ = intercept
+        self.link = link
+
+    @staticmethod
+    def from_estimator(model, dtype=np.float32):
+        """Export the weights of a fitted linear model."""
+        if not hasattr(model, "coef_"):
+            raise Exception(f"Cannot export the weights of a {type(model).__name__}")
+
+        return LinearModel(
+            np.asarray(model.classes_),
+            np.ascontiguousarray(model.coef_, dtype=dtype),
+            np.ascontiguousarray(model.intercept_, dtype=dtype),
+            link=get_link(model),
+        )
+
+    def decision_function(self, X):
+        scores = np.asarray(X, dtype=self.coef_.dtype) @ self.coef_.T
+        scores += self.intercept_
+
+        return scores
+
+    def predict_proba(self, X):
+        scores = self.decision_function(X)
+
+        # A binary model has a single column of scores for the second class
+        if scores.shape[1] == 1:
+            positive = sigmoid(scores[:, 0])
+            return np.stack([1 - positive, positive], axis=1)
+
+        if self.link == "softmax":
+            return softmax(scores)
+
+        probs = sigmoid(scores)
+        probs /= probs.sum(axis=1, keepdims=True)
+
+        return probs
+
+    def predict(self, X):
+        scores = self.decision_function(X)
+
+        if scores.shape[1] == 1:
+            return self.classes_[(scores[:, 0] > 0).astype(int)]
+
+        return self.classes_[np.argmax(scores, axis=1)]
+
+    def save(self, directory):
+        os.makedirs(directory, exist_ok=True)
+
+        np.save(os.path.join(directory, "classes.npy"), self.classes_)
+        np.save(os.path.join(directory, "coef.npy"), self.coef_)
+        np.save(os.path.join(directory, "intercept.npy"), self.intercept_)
+
+        with open(os.path.join(directory, "link.txt"), "w") as f:
+            f.write(self.link)
+
+    @staticmethod
+    def load(directory, mmap_mode="r"):
+        """Load saved weights, memory-mapped read only by default."""
+        with open(os.path.join(directory, "link.txt")) as f:
+            link = f.read().strip()
+
+        return LinearModel(
+            np.load(os.path.join(directory, "classes.npy")),
+            np.load(os.path.join(directory, "coef.npy"), mmap_mode=mmap_mode),
+            np.load(os.path.join(directory, "intercept.npy"), mmap_mode=mmap_mode),
+            link=link,
+        )
+
+
+def set_blas_threads(threads):
+    """Limit the threads numpy's BLAS uses for the matrix products.
+
+    Serving processes usually run one per core, where BLAS threads only
+    compete with each other. Uses threadpoolctl if it is installed, and
+    otherwise the environment variables, which only take effect if they are
+    set before numpy loads its BLAS.
+    """
+    try:
+        from threadpoolctl import threadpool_limits
+    except ImportError:
+        threadpool_limits = None
+
+    if threadpool_limits is not None:
+        threadpool_limits(limits=threads, user_api="blas")
+        return
+
+    for variable in ("OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS"):
+        os.environ[variable] = str(threads)
+
+    logger.warning(
+        "threadpoolctl is not installed, BLAS threads are only limited if numpy "
+        "has not loaded its BLAS yet"
+    )
+
+
+def get_link(model):
+    """How a fitted sklearn style model turns scores into probabilities."""
+    if isinstance(model, LinearModel):
+        return model.link
+
+    # LogisticRegression is multinomial unless it was fit one-vs-rest
+    if type(model).__name__ == "LogisticRegression":
+        multi_class = getattr(model, "multi_class", "auto")
+        if multi_class == "ovr" or model.solver == "liblinear":
+            return "ovr"
+        return "softmax"
+
+    return "ovr"
+
+
+def softmax(scores):
+    """Row-wise softmax, shifted by the row maximum so exp never overflows."""
+    scores = scores - scores.max(axis=1, keepdims=True)
+    np.exp(scores, out=scores)
+    scores /= scores.sum(axis=1, keepdims=True)
+
+    return scores
+
+
+def sigmoid(scores):
+    """The logistic function, written with tanh so it never overflows."""
+    return 0.5 * (1 + np.tanh(0.5 * scores))
@@ -0,0 +1,232 @@
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import numpy as np
+
+import itertools
+import os
+import tempfile
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The LogisticRegression parameters tried by tune when no grid is given
+DEFAULT_GRID = {
+    "C": [0.1, 1.0, 10.0],
+    "solver": ["lbfgs", "saga"],
+    "class_weight": [None, "balanced"],
+}
+
+
+def expand_grid(grid):
+    """Every combination of a dict of parameter lists, as a list of dicts."""
+    names = list(grid.keys())
+
+    return [dict(zip(names, values)) for values in itertools.product(*grid.values())]
+
+
+def cross_validate(X, y, configurations, folds=5, top_k=5, n_jobs=None, seed=0):
+    """Score LogisticRegression configurations with k-fold cross-validation.
+
+    Every (configuration, fold) pair is fit in a process pool. The workers
+    map one read only copy of X from a .npy file, either the file X is
+    already memory-mapped from or a temporary copy, instead of each
+    receiving its own. The fitted weights are exported to a LinearModel, so
+    that the predict latency is that of the serving path.
+
+    Returns one result per configuration, best accuracy first, with the
+    mean accuracy, top-k accuracy, fit seconds and predict latency per row
+    over the folds.
+    """
+
+    y = np.asarray(y)
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    splits = split_folds(y, folds, seed)
+    tasks = list(itertools.product(range(len(configurations)), range(len(splits))))
+
+    logger.info(
+        f"Cross-validating {len(configurations)} configurations on {len(splits)} folds "
+        f"in {len(tasks)} fits on {n_jobs} processes"
+    )
+
+    with shared_matrix(X) as path:
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=attach_matrix,
+            initargs=(path, y, top_k),
+        ) as pool:
+            scores = list(
+                pool.map(
+                    score_fold,
+                    [configurations[configuration] for configuration, _ in tasks],
+                    [splits[fold] for _, fold in tasks],
+                )
+            )
+
+    results = []
+    for index, configuration in enumerate(configurations):
+        fold_scores = [
+            score for (task_configuration, _), score in zip(tasks, scores)
+            if task_configuration == index
+        ]
+
+        # Some parameter combinations are invalid, e.g. for the installed
+        # scikit-learn, they are reported and left out
+        errors = [score["error"] for score in fold_scores if "error" in score]
+        if len(errors) > 0:
+            logger.warning(f"Skipping {configuration}, it failed with: {errors[0]}")
+            continue
+
+        accuracies = [score["accuracy"] for score in fold_scores]
+
+        results.append(
+            {
+                "params": configuration,
+                "accuracy": float(np.mean(accuracies)),
+                "accuracy_std": float(np.std(accuracies)),
+                "top_k": min(top_k, len(np.unique(y))),
+                "top_k_accuracy": float(np.mean([score["top_k_accuracy"] for score in fold_scores])),
+                "fit_seconds": float(np.mean([score["fit_seconds"] for score in fold_scores])),
+                "predict_latency_us": float(
+                    np.mean([score["predict_latency_us"] for score in fold_scores])
+                ),
+                "folds": len(fold_scores),
+            }
+        )
+
+    results.sort(key=lambda result: (-result["accuracy"], result["fit_seconds"]))
+
+    return results
+
+
+def select_configuration(results, tolerance=0.005):
+    """The cheapest result to fit whose accuracy is within tolerance of the
+    best, preferring lower predict latency on ties."""
+    if len(results) == 0:
+        raise Exception("No configuration could be cross-validated")
+
+    best = max(result["accuracy"] for result in results)
+
+    candidates = [result for result in results if result["accuracy"] >= best - tolerance]
+
+    return min(
+        candidates, key=lambda result: (result["fit_seconds"], result["predict_latency_us"])
+    )
+
+
+def format_results(results):
+    lines = [
+        f"{'accuracy':>9} {'top-k':>7} {'fit s':>8} {'predict us/row':>15}  params"
+    ]
+
+    for result in results:
+        lines.append(
+            f"{result['accuracy']:9.4f} {result['top_k_accuracy']:7.4f} "
+            f"{result['fit_seconds']:8.3f} {result['predict_latency_us']:15.2f}  "
+            f"{result['params']}"
+        )
+
+    return "\n".join(lines)
+
+
+def split_folds(y, folds, seed):
+    """Train and test row indices for each fold, stratified when every class
+    has at least one example per fold."""
+    from sklearn.model_selection import KFold, StratifiedKFold
+
+    _, counts = np.unique(y, return_counts=True)
+
+    folds = max(2, min(folds, len(y)))
+    if counts.min() >= folds:
+        splitter = StratifiedKFold(n_splits=folds, shuffle=True, random_state=seed)
+    else:
+        splitter = KFold(n_splits=folds, shuffle=True, random_state=seed)
+
+    return list(splitter.split(np.zeros((len(y), 1)), y))
+
+
+@contextmanager
+def shared_matrix(X):
+    """Yield the path of a .npy file holding X, reusing the file X is
+    memory-mapped from if there is one."""
+    filename = getattr(X, "filename", None)
+
+    if (
+        filename is not None
+        and str(filename).endswith(".npy")
+        and X.dtype == np.float32
+        and np.load(filename, mmap_mode="r").shape == X.shape
+    ):
+        X.flush()
+        yield str(filename)
+        return
+
+    # /dev/shm keeps the copy in memory
+    base = "/dev/shm" if os.path.isdir("/dev/shm") else None
+
+    with tempfile.TemporaryDirectory(dir=base) as directory:
+        path = os.path.join(directory, "embeddings.npy")
+        np.save(path, np.ascontiguousarray(X, dtype=np.float32))
+
+        yield path
+
+
+# The memory-mapped matrix, attached once per worker process
+shared_data = {}
+
+
+def attach_matrix(path, y, top_k):
+    # Each worker fits one model at a time, so keep BLAS single threaded,
+    # which also keeps the timings comparable
+    from shopper.classifier.linear_model import set_blas_threads
+
+    set_blas_threads(1)
+
+    shared_data["X"] = np.load(path, mmap_mode="r")
+    shared_data["y"] = y
+    shared_data["top_k"] = top_k
+
+
+def score_fold(params, split):
+    from sklearn.linear_model import LogisticRegression
+
+    from shopper.classifier.linear_model import LinearModel
+
+    X = shared_data["X"]
+    y = shared_data["y"]
+
+    train_rows, test_rows = split
+
+    start = time.perf_counter()
+    try:
+        model = LinearModel.from_estimator(
+            LogisticRegression(random_state=0, **params).fit(X[train_rows], y[train_rows])
+        )
+    except ValueError as e:
+        return {"error": str(e)}
+    fit_seconds = time.perf_counter() - start
+
+    X_test = np.asarray(X[test_rows])
+
+    start = time.perf_counter()
+    probs = model.predict_proba(X_test)
+    predict_seconds = time.perf_counter() - start
+
+    # Column positions of the classes that were in the training folds
+    classes = np.asarray(model.classes_)
+    top_k = min(shared_data["top_k"], len(classes))
+
+    top = classes[np.argpartition(probs, -top_k, axis=1)[:, -top_k:]]
+    predicted = classes[np.argmax(probs, axis=1)]
+
+    return {
+        "accuracy": float((predicted == y[test_rows]).mean()),
+        "top_k_accuracy": float((top == y[test_rows][:, None]).any(axis=1).mean()),
+        "fit_seconds": fit_seconds,
+        "predict_latency_us": predict_seconds / len(test_rows) * 1e6,
+    }
@@ -0,0 +1,106 @@
+from shopper.classifier.linear_model import LinearModel
+
+from sklearn.linear_model import LogisticRegression
+
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import os
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def train_one_vs_rest(X, y, n_jobs=None, shards_per_job=4, **kwargs):
+    """Fit one binary logistic regression head per class across a process pool.
+
+    The embedding matrix is copied once into shared memory, and every worker
+    maps it instead of receiving its own pickled copy. The classes are split
+    into shards so that each task amortizes the dispatch overhead over several
+    heads. The heads are merged into a single LinearModel with the
+    one-vs-rest link.
+    """
+
+    X = np.ascontiguousarray(X, dtype=np.float32)
+    y = np.asarray(y)
+
+    if n_jobs is None:
+        n_jobs = os.cpu_count()
+
+    classes = np.unique(y)
+    shards = [
+        shard
+        for shard in np.array_split(classes, max(1, n_jobs * shards_per_job))
+        if len(shard) > 0
+    ]
+
+    logger.info(
+        f"Training {len(classes)} one-vs-rest heads in {len(shards)} shards on {n_jobs} processes"
+    )
+
+    with share_matrix(X) as shared:
+        with ProcessPoolExecutor(
+            max_workers=n_jobs,
+            initializer=attach_shared_matrix,
+            initargs=(shared.name, X.shape, X.dtype.str, y),
+        ) as pool:
+            results = list(pool.map(fit_shard, shards, [kwargs] * len(shards)))
+
+    coef = np.concatenate([coef for coef, _ in results])
+    intercept = np.concatenate([intercept for _, intercept in results])
+
+    return LinearModel(classes, coef, intercept, link="ovr")
+
+
+@contextmanager
+def share_matrix(X):
+    """Copy a contiguous matrix once into shared memory, yielding the block
+    for attach_shared_matrix to map in the workers."""
+    shared = shared_memory.SharedMemory(create=True, size=max(1, X.nbytes))
+    try:
+        np.ndarray(X.shape, dtype=X.dtype, buffer=shared.buf)[:] = X
+
+        yield shared
+    finally:
+        shared.close()
+        shared.unlink()
+
+
+# The shared training data, attached once per worker process
+shared_training_data = {}
+
+
+def attach_shared_matrix(name, shape, dtype, y):
+    # Each worker fits one head at a time, so keep BLAS single threaded to
+    # avoid oversubscribing the cores
+    try:
+        from threadpoolctl import threadpool_limits
+
+        threadpool_limits(1)
+    except ImportError:
+        pass
+
+    shared = shared_memory.SharedMemory(name=name)
+
+    shared_training_data["shared"] = shared
+    shared_training_data["X"] = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shared.buf)
+    shared_training_data["y"] = y
+
+
+def fit_shard(shard, kwargs):
+    X = shared_training_data["X"]
+    y = shared_training_data["y"]
+
+    coef = np.zeros((len(shard), X.shape[1]), dtype=np.float32)
+    intercept = np.zeros(len(shard), dtype=np.float32)
+
+    for index, class_id in enumerate(shard):
+        head = LogisticRegression(random_state=0, **kwargs).fit(X, y == class_id)
+        coef[index] = head.coef_[0]
+        intercept[index] = head.intercept_[0]
+
+    return coef, intercept
@@ -0,0 +1,157 @@
+from shopper.classifier.linear_model import LinearModel
+
+import numpy as np
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class EmbeddingProjection:
+    """Reduces embeddings to fewer dimensions and a smaller number format
+    before they reach the classifier.
+
+    The projection is either "pca", fitted on the training embeddings, or a
+    seeded Gaussian "random" projection. The projected values are then
+    quantized to "float16" or "int8" (or left as float32 with None). Both
+    stages are fitted in train() and saved with the classifier.
+
+    transform returns the quantized codes, which are the features the
+    classifier scores at inference. The classifier is trained on the values
+    the codes stand for, and fold then moves the int8 scale into its
+    weights, so the codes never need to be decoded to float32 first.
+    """
+
+    def __init__(self, method="pca", n_components=128, quantize="float16", seed=0):
+        if method not in ("pca", "random"):
+            raise Exception(f"Unknown projection method '{method}'")
+
+        if quantize not in (None, "float16", "int8"):
+            raise Exception(f"Unknown quantization '{quantize}'")
+
+        self.method = method
+        self.n_components = n_components
+        self.quantize = quantize
+        self.seed = seed
+
+        self.mean = None
+        self.components = None
+        self.scale = None
+
+    def fit(self, X):
+        X = np.asarray(X, dtype=np.float32)
+
+        n_components = min(self.n_components, X.shape[1])
+
+        if self.method == "pca":
+            self.mean = X.mean(axis=0)
+            centered = X - self.mean
+
+            # The covariance is only width x width, which is much cheaper to
+            # decompose than the examples themselves
+            covariance = centered.T @ centered
+            eigenvalues, eigenvectors = np.linalg.eigh(covariance)
+            order = np.argsort(eigenvalues)[::-1][:n_components]
+            self.components = eigenvectors[:, order].T.astype(np.float32)
+        else:
+            rng = np.random.default_rng(self.seed)
+            self.mean = np.zeros(X.shape[1], dtype=np.float32)
+            self.components = (
+                rng.standard_normal((n_components, X.shape[1]), dtype=np.float32)
+                / np.sqrt(n_components)
+            )
+
+        if self.quantize == "int8":
+            projected = self.project(X)
+            self.scale = np.abs(projected).max(axis=0) / 127.0
+            self.scale[self.scale == 0] = 1.0
+
+        return self
+
+    def project(self, X):
+        return (np.asarray(X, dtype=np.float32) - self.mean) @ self.components.T
+
+    def encode(self, X):
+        """Project and quantize, returning the compact representation."""
+        projected = self.project(X)
+
+        if self.quantize == "float16":
+            return projected.astype(np.float16)
+
+        if self.quantize == "int8":
+            return np.clip(np.round(projected / self.scale), -127, 127).astype(np.int8)
+
+        return projected
+
+    def decode(self, codes):
+        """Expand a compact representation back to float32 features."""
+        if self.quantize == "int8":
+            return codes.astype(np.float32) * self.scale
+
+        return codes.astype(np.float32)
+
+    def transform(self, X):
+        return self.encode(X)
+
+    def fit_transform(self, X):
+        return self.fit(X).transform(X)
+
+    def fold(self, model):
+        """Adapt a LinearModel trained on decoded features to score the codes.
+
+        With int8 codes, decode(codes) @ coef.T is codes @ (coef * scale).T,
+        so the scale is multiplied into the weights once. The other formats
+        decode by a cast, which the model's matrix product already does.
+        """
+        if self.quantize != "int8" or not isinstance(model, LinearModel):
+            return model
+
+        return LinearModel(
+            model.classes_,
+            np.ascontiguousarray(model.coef_ * self.scale, dtype=model.coef_.dtype),
+            model.intercept_,
+            link=model.link,
+        )
+
+
+def compare_projection_accuracy(X, y, projection, holdout=0.2, seed=0):
+    """Compare held-out accuracy of the classifier with and without a
+    projection, fitting both on the same split."""
+
+    from sklearn.linear_model import LogisticRegression
+
+    X = np.asarray(X, dtype=np.float32)
+    y = np.asarray(y)
+
+    rng = np.random.default_rng(seed)
+    order = rng.permutation(len(y))
+    split = int(len(y) * (1 - holdout))
+    train_rows, test_rows = order[:split], order[split:]
+
+    full = LogisticRegression(random_state=0).fit(X[train_rows], y[train_rows])
+    full_accuracy = full.score(X[test_rows], y[test_rows])
+
+    projection.fit(X[train_rows])
+    reduced = LogisticRegression(random_state=0).fit(
+        projection.decode(projection.transform(X[train_rows])), y[train_rows]
+    )
+    reduced_accuracy = reduced.score(
+        projection.decode(projection.transform(X[test_rows])), y[test_rows]
+    )
+
+    codes = projection.transform(X[:1])
+
+    report = {
+        "full_accuracy": full_accuracy,
+        "reduced_accuracy": reduced_accuracy,
+        "accuracy_delta": reduced_accuracy - full_accuracy,
+        "full_width": X.shape[1],
+        "reduced_width": projection.components.shape[0],
+        "quantize": projection.quantize,
+        "full_bytes_per_row": X.shape[1] * X.itemsize,
+        "reduced_bytes_per_row": codes.shape[1] * codes.itemsize,
+    }
+
+    logger.info(f"Projection accuracy report: {report}")
+
+    return report
@@ -0,0 +1,211 @@
+from shopper.util.jsonl import JsonlWriter, count_rows, read_jsonl
+from shopper.util.profiling import add_profile_arguments, start_profiling
+from shopper.util.rate_limit import add_rate_limit_arguments, configure_rate_limits
+
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+import csv
+import itertools
+
+import argparse
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    """Classify every row of a large JSONL or CSV file."""
+
+    parser = argparse.ArgumentParser(
+        description="Classify the text in a JSONL or CSV file with a trained classifier."
+    )
+
+    # The input to the program is a file of texts
+    parser.add_argument(
+        "input",
+        help="The .jsonl or .csv file containing the texts to classify",
+    )
+
+    # The classifier to classify with
+    parser.add_argument(
+        "--model",
+        help="The classifier to load",
+        default="/app/shopper/models/classifier.pkl",
+    )
+
+    # The output of the program is a json lines file
+    parser.add_argument(
+        "--output",
+        help="The JSONL file to write the classes to",
+        default="/app/shopper/data/classified.jsonl",
+    )
+
+    parser.add_argument(
+        "--text-field",
+        help="The field or column containing the text.",
+        default="text",
+    )
+
+    parser.add_argument(
+        "--batch-size",
+        help="The number of texts to embed per request.",
+        type=int,
+        default=100,
+    )
+
+    parser.add_argument(
+        "--prefetch",
+        help="The number of batches to embed ahead of the batch being scored.",
+        type=int,
+        default=4,
+    )
+
+    parser.add_argument(
+        "--top-n",
+        help="The number of classes to write per text.",
+        type=int,
+        default=5,
+    )
+
+    parser.add_argument(
+        "--offset",
+        help="Skip this many input rows. Defaults to the rows already in the output.",
+        type=int,
+        default=None,
+    )
+
+    # Scoring runs on numpy, whose BLAS threads compete with the embedding
+    # requests and with other classifier processes
+    parser.add_argument(
+        "--blas-threads",
+        help="Limit the BLAS threads used to score the embeddings.",
+        type=int,
+        default=None,
+    )
+
+    add_profile_arguments(parser)
+    add_rate_limit_arguments(parser)
+
+    # Get the arguments
+    args = parser.parse_args()
+
+    # Profile the run if requested, the reports are written next to the output
+    start_profiling(args, args.output)
+
+    # Share the Lamini rate limits between every call this process makes
+    configure_rate_limits(args)
+
+    # Set the logging level
+    logging.basicConfig(level=logging.INFO)
+
+    # Resume after the rows that were already classified
+    offset = args.offset if args.offset is not None else count_rows(args.output)
+
+    logging.info(f"Classifying {args.input} starting at row {offset}")
+
+    if args.blas_threads is not None:
+        from shopper.classifier.linear_model import set_blas_threads
+
+        set_blas_threads(args.blas_threads)
+
+    from shopper.classifier.lamini_classifier import LaminiClassifier
+
+    classifier = LaminiClassifier.load(args.model)
+
+    texts = load_texts(args.input, args.text_field, offset)
+
+    rows = classify_texts(
+        classifier,
+        texts,
+        batch_size=args.batch_size,
+        prefetch=args.prefetch,
+        top_n=args.top_n,
+    )
+
+    # Flush once per batch so that a resumed run never repeats more than one batch
+    with JsonlWriter(args.output, mode="a", batch_size=args.batch_size) as writer:
+        count = 0
+        for row in rows:
+            writer.write(row)
+            count += 1
+
+    logging.info(f"Classified {count} rows into {args.output}")
+
+
+def load_texts(filename, text_field, offset):
+    """Yield (row index, text) for every input row from offset onwards."""
+
+    if filename.endswith(".csv"):
+        f = open(filename, newline="")
+        rows = csv.DictReader(f)
+    else:
+        f = None
+        rows = read_jsonl(filename)
+
+    try:
+        for index, row in enumerate(itertools.islice(rows, offset, None), start=offset):
+            yield index, row[text_field]
+    finally:
+        if f is not None:
+            f.close()
+
+
+def classify_texts(classifier, texts, batch_size=100, prefetch=4, top_n=5):
+    """Classify (index, text) pairs, embedding upcoming batches while the
+    current batch is scored.
+
+    Embedding is network bound and scoring is CPU bound, so up to prefetch
+    embedding requests are kept in flight on a thread pool while the main
+    thread scores and yields the results in input order.
+    """
+
+    batches = batchify(texts, batch_size)
+
+    with ThreadPoolExecutor(max_workers=max(1, prefetch)) as pool:
+        pending = deque()
+
+        def submit_next():
+            batch = next(batches, None)
+            if batch is not None:
+                texts = [text for _, text in batch]
+                pending.append((batch, pool.submit(classifier.get_features, texts)))
+
+        for _ in range(max(1, prefetch)):
+            submit_next()
+
+        while len(pending) > 0:
+            batch, features = pending.popleft()
+
+            # Keep the embedding service busy while this batch is scored
+            submit_next()
+
+            results = classifier.classify_features(features.result(), top_n=top_n)
+
+            for (index, text), classes in zip(batch, results):
+                yield {
+                    "index": index,
+                    "text": text,
+                    "classes": [
+                        {
+                            "class_id": int(result["class_id"]),
+                            "class_name": result["class_name"],
+                            "prob": float(result["prob"]),
+                        }
+                        for result in classes
+                    ],
+                }
+
+
+def batchify(rows, batch_size):
+    rows = iter(rows)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if len(batch) == 0:
+            return
+        yield batch
+
+
+if __name__ == "__main__":
+    main()
@@ -1,33 +1,109 @@
-from lamini import Lamini
+from shopper.util.dataset import ShardWriter, submit_dataset
+from shopper.util.jsonl import read_jsonl
+from shopper.util.profiling import add_profile_arguments, start_profiling
+from shopper.util.rate_limit import (
+    add_rate_limit_arguments,
+    configure_rate_limits,
+    limit_runner,
+)
 
+import argparse
 import random
-import jsonlines
+
+import logging
+
+logger = logging.getLogger(__name__)
 
 
 def train():
     """Train an LLM on raw csv of products and their info."""
 
-    # Load jsonlines file
-    training_data = []
-    with jsonlines.open("/app/shopper/data/products.jsonl") as reader:
-        products = list(reader)
-
-        for product in products:
-            product_id = product["product"]["product_id"]
-            product_name = product["product"]["product_name"]
-            product_description = product["descriptions"]
-
-            hydrated_prompt = f"""We sell this product at Instacart, its name is {product_name}, {product_description} and its product ID is {product_id}. We can use its this product description to understand how the product can be used to recommend with other relevant products"""
-            
-            split_i = random.randrange(len(hydrated_prompt))
-            product = { 
-                "input": hydrated_prompt[:split_i],
-                "output": hydrated_prompt[split_i:]
-            }
-            training_data.append(product)
-    print(training_data)
-
-    llm = Lamini(model_name="mistralai/Mistral-7B-Instruct-v0.1")
-    llm.train(data=training_data)
-
-train()
+    parser = argparse.ArgumentParser(
+        description="Tune an LLM on the product descriptions."
+    )
+
+    # The input to the program is the list of products and descriptions
+    parser.add_argument(
+        "product_jsonl",
+        nargs="?",
+        help="The jsonl file containing the products",
+        default="/app/shopper/data/products.jsonl",
+    )
+
+    # The training data is written here in shards before it is submitted
+    parser.add_argument(
+        "--dataset",
+        help="The directory to write the training data shards to",
+        default="/app/shopper/data/description-tune-dataset",
+    )
+
+    parser.add_argument(
+        "--shard-size",
+        help="The number of training examples per shard.",
+        type=int,
+        default=1000,
+    )
+
+    # The prompt split points are derived from the seed and the product id
+    parser.add_argument(
+        "--seed",
+        help="The seed for the random split of each prompt.",
+        type=int,
+        default=0,
+    )
+
+    parser.add_argument(
+        "--model-name",
+        help="The base model to tune.",
+        default="mistralai/Mistral-7B-Instruct-v0.1",
+    )
+
+    add_profile_arguments(parser)
+    add_rate_limit_arguments(parser)
+
+    # Get the arguments
+    args = parser.parse_args()
+
+    # Profile the run if requested, the reports are written next to the input
+    start_profiling(args, args.product_jsonl)
+
+    # Share the Lamini rate limits between every call this process makes
+    configure_rate_limits(args)
+
+    # Set the logging level
+    logging.basicConfig(level=logging.INFO)
+
+    # Stream the products into shards
+    with ShardWriter(args.dataset, shard_size=args.shard_size) as writer:
+        for product in read_jsonl(args.product_jsonl):
+            writer.write(make_training_example(product, args.seed))
+
+    def submit(training_data):
+        from lamini import Lamini
+
+        llm = limit_runner(Lamini(model_name=args.model_name))
+        llm.train(data=training_data)
+
+    # Identical training data is never submitted twice
+    submit_dataset(args.dataset, submit, key=args.model_name)
+
+
+def make_training_example(product, seed):
+    product_id = product["product"]["product_id"]
+    product_name = product["product"]["product_name"]
+    product_description = product["descriptions"]
+
+    hydrated_prompt = f"""We sell this product at Instacart, its name is {product_name}, {product_description} and its product ID is {product_id}. We can use its this product description to understand how the product can be used to recommend with other relevant products"""
+
+    # Seeded per product, so the shards do not depend on the order or number
+    # of products before this one
+    split_i = random.Random(f"{seed}:{product_id}").randrange(len(hydrated_prompt))
+
+    return {
+        "input": hydrated_prompt[:split_i],
+        "output": hydrated_prompt[split_i:]
+    }
+
+
+if __name__ == "__main__":
+    train()
@@ -1,4 +1,15 @@
-from lamini import Lamini, MistralRunner
+from shopper.util.jsonl import JsonlWriter, dumps, loads, read_jsonl
+from shopper.util.profiling import add_profile_arguments, start_profiling
+from shopper.util.rate_limit import (
+    add_rate_limit_arguments,
+    configure_rate_limits,
+    limit,
+)
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import argparse
+import time
 
 import logging
 
@@ -15,34 +26,271 @@ eval_questions = [
     "What are some essential ingredients for a traditional Thanksgiving dinner?",
 ]
 
-# Without prompt template
-llm_without_template = Lamini(model_name=trained_1k_name)
-
-# With prompt template
-llm_with_template = MistralRunner(model_name=trained_1k_name)
-
-def compare_no_prompt_eng():
-    for question in eval_questions:
-        print("===============Question===============")
-        print(question)
-        print("===============Without prompt template===============")
-        print(llm_without_template.generate(question))
-        print("===============With prompt template===============")
-        print(llm_with_template.call(question))
-        print()
-
-def compare_prompt_eng():
-    for question in eval_questions:
-        print("===============Question===============")
-        print(question)
-        print("===============Without prompt template===============")
-        print(llm_without_template.generate(question + " " + "Use Instacart products in your recommendations and include their product IDs."))
-        print("===============With prompt template===============")
-        print(llm_with_template.call(question, system_prompt="You are a grocery product expert for Instacart. Include Instacart products in each of your recommendations, including the product's product ID."))
-        print()
-
-print("===============NO PROMPT ENGINEERING===============")
-compare_no_prompt_eng()
-
-print("===============PROMPT ENGINEERING===============")
-compare_prompt_eng()
+# Each variant asks one model one way. "runner" is "lamini" to send the raw
+# question, or "mistral" to wrap it in the prompt template. The suffix is
+# appended to the question and the system prompt is only used by "mistral".
+default_variants = [
+    {
+        "name": "no_prompt_eng_without_template",
+        "model_name": trained_1k_name,
+        "runner": "lamini",
+    },
+    {
+        "name": "no_prompt_eng_with_template",
+        "model_name": trained_1k_name,
+        "runner": "mistral",
+    },
+    {
+        "name": "prompt_eng_without_template",
+        "model_name": trained_1k_name,
+        "runner": "lamini",
+        "suffix": " Use Instacart products in your recommendations and include their product IDs.",
+    },
+    {
+        "name": "prompt_eng_with_template",
+        "model_name": trained_1k_name,
+        "runner": "mistral",
+        "system_prompt": "You are a grocery product expert for Instacart. Include Instacart products in each of your recommendations, including the product's product ID.",
+    },
+]
+
+
+def main():
+    """Evaluate tuned models on a set of questions, concurrently."""
+
+    parser = argparse.ArgumentParser(
+        description="Evaluate model and prompt template variants on a question file."
+    )
+
+    # The questions, one per line or in the "question" field of a jsonl file
+    parser.add_argument(
+        "--questions",
+        help="The .txt or .jsonl file of questions. Defaults to the built in questions.",
+        default=None,
+    )
+
+    # The variants to compare, a json list like default_variants
+    parser.add_argument(
+        "--variants",
+        help="The .json file listing the model and prompt variants to compare.",
+        default=None,
+    )
+
+    # The output of the program is a json lines file with one record per request
+    parser.add_argument(
+        "--output",
+        help="The JSONL file to write every request and response to",
+        default="/app/shopper/data/eval_results.jsonl",
+    )
+
+    parser.add_argument(
+        "--workers",
+        help="The number of requests in flight at once.",
+        type=int,
+        default=16,
+    )
+
+    add_profile_arguments(parser)
+    add_rate_limit_arguments(parser)
+
+    # Get the arguments
+    args = parser.parse_args()
+
+    # Profile the run if requested, the reports are written next to the output
+    start_profiling(args, args.output)
+
+    # Share the Lamini rate limits between every call this process makes
+    configure_rate_limits(args)
+
+    # Set the logging level
+    logging.basicConfig(level=logging.INFO)
+
+    questions = load_questions(args.questions)
+    variants = load_variants(args.variants)
+
+    logger.info(
+        f"Evaluating {len(variants)} variants on {len(questions)} questions "
+        f"with {args.workers} workers"
+    )
+
+    records = run_evaluation(questions, variants, args.output, workers=args.workers)
+
+    summaries = {}
+    for variant in variants:
+        summaries[variant["name"]] = summarize(
+            [record for record in records if record["variant"] == variant["name"]]
+        )
+        print(format_summary(variant["name"], summaries[variant["name"]]))
+
+    # Keep the summary next to the records, so that runs can be compared later
+    with open(args.output + ".summary.json", "w") as f:
+        f.write(dumps(summaries))
+
+    logger.info(f"Wrote {len(records)} records to {args.output}")
+
+
+def load_questions(filename):
+    if filename is None:
+        return eval_questions
+
+    if filename.endswith(".jsonl"):
+        return [row["question"] for row in read_jsonl(filename)]
+
+    with open(filename) as f:
+        return [line.strip() for line in f if line.strip()]
+
+
+def load_variants(filename):
+    if filename is None:
+        return default_variants
+
+    with open(filename) as f:
+        variants = loads(f.read())
+
+    for variant in variants:
+        if variant.get("runner", "lamini") not in ("lamini", "mistral"):
+            raise Exception(f"Unknown runner '{variant['runner']}' in variant '{variant['name']}'")
+
+    return variants
+
+
+def create_runner(variant):
+    # The runners are not wrapped with limit_runner, run_evaluation holds the
+    # limiter itself so that the queue wait is kept out of the latency
+    from lamini import Lamini, MistralRunner
+
+    if variant.get("runner", "lamini") == "mistral":
+        return MistralRunner(model_name=variant["model_name"])
+
+    return Lamini(model_name=variant["model_name"])
+
+
+def ask(runner, variant, question):
+    question = question + variant.get("suffix", "")
+
+    if variant.get("runner", "lamini") == "mistral":
+        if variant.get("system_prompt") is None:
+            return runner.call(question)
+        return runner.call(question, system_prompt=variant["system_prompt"])
+
+    return runner.generate(question)
+
+
+def run_evaluation(questions, variants, output, workers=16):
+    """Ask every variant every question, at most workers requests at a time.
+
+    Each request is written to output as soon as it finishes, with its
+    latency, output length and any error, and all the records are returned.
+    The latency is timed from when the rate limiter admits the request, and
+    the time spent queued for the limiter is recorded as queue_wait.
+    """
+
+    runners = {variant["name"]: create_runner(variant) for variant in variants}
+
+    records = []
+
+    def request(variant, index, question):
+        queued = time.perf_counter()
+        record = {
+            "variant": variant["name"],
+            "model_name": variant["model_name"],
+            "question_index": index,
+            "question": question,
+            "output": None,
+            "error": None,
+        }
+
+        with limit("completion"):
+            start = time.perf_counter()
+
+            try:
+                output = ask(runners[variant["name"]], variant, question)
+                record["output"] = output["output"] if isinstance(output, dict) else str(output)
+            except Exception as e:
+                logger.error(f"Variant '{variant['name']}' failed on question {index}: {e}")
+                record["error"] = repr(e)
+
+            end = time.perf_counter()
+
+        record["start"] = start
+        record["queue_wait"] = start - queued
+        record["latency"] = end - start
+        record["output_chars"] = len(record["output"] or "")
+        record["output_words"] = len((record["output"] or "").split())
+
+        return record
+
+    with JsonlWriter(output, batch_size=100) as writer:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            futures = [
+                pool.submit(request, variant, index, question)
+                for index, question in enumerate(questions)
+                for variant in variants
+            ]
+
+            for future in as_completed(futures):
+                record = future.result()
+                writer.write(record)
+                records.append(record)
+
+    return records
+
+
+def summarize(records):
+    """Latency percentiles and throughput of one variant's records."""
+
+    succeeded = [record for record in records if record["error"] is None]
+    latencies = sorted(record["latency"] for record in succeeded)
+    queue_waits = sorted(record.get("queue_wait", 0.0) for record in records)
+
+    if len(records) > 0:
+        wall_time = max(record["start"] + record["latency"] for record in records) - min(
+            record["start"] for record in records
+        )
+    else:
+        wall_time = 0
+
+    return {
+        "requests": len(records),
+        "errors": len(records) - len(succeeded),
+        "p50_latency": percentile(latencies, 0.5),
+        "p95_latency": percentile(latencies, 0.95),
+        "p50_queue_wait": percentile(queue_waits, 0.5),
+        "p95_queue_wait": percentile(queue_waits, 0.95),
+        "requests_per_second": len(succeeded) / wall_time if wall_time > 0 else None,
+        "mean_output_words": sum(record["output_words"] for record in succeeded)
+        / len(succeeded)
+        if len(succeeded) > 0
+        else None,
+    }
+
+
+def percentile(sorted_values, q):
+    """The q quantile of sorted values, interpolating between neighbours."""
+    if len(sorted_values) == 0:
+        return None
+
+    position = (len(sorted_values) - 1) * q
+    lower = int(position)
+    upper = min(lower + 1, len(sorted_values) - 1)
+
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (
+        position - lower
+    )
+
+
+def format_summary(name, summary):
+    if summary["p50_latency"] is None:
+        return f"{name}: {summary['requests']} requests, all failed"
+
+    return (
+        f"{name}: {summary['requests']} requests, {summary['errors']} errors, "
+        f"p50 {summary['p50_latency']:.2f}s, p95 {summary['p95_latency']:.2f}s, "
+        f"queued p50 {summary['p50_queue_wait']:.2f}s, p95 {summary['p95_queue_wait']:.2f}s, "
+        f"{summary['requests_per_second']:.2f} requests/s, "
+        f"{summary['mean_output_words']:.0f} words per answer"
+    )
+
+
+if __name__ == "__main__":
+    main()
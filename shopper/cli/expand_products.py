@@ -1,9 +1,11 @@
-from lamini import MistralRunner
+from shopper.util.jsonl import JsonlWriter, count_rows
+from shopper.util.profiling import add_profile_arguments, start_profiling
+from shopper.util.rate_limit import (
+    add_rate_limit_arguments,
+    configure_rate_limits,
+    limit_runner,
+)
 
-from tqdm import tqdm
-
-import jsonlines
-import os
 import csv
 import random
 
@@ -41,9 +43,18 @@ def main():
         default=100,
     )
 
+    add_profile_arguments(parser)
+    add_rate_limit_arguments(parser)
+
     # Get the arguments
     args = parser.parse_args()
 
+    # Profile the run if requested, the reports are written next to the output
+    start_profiling(args, args.output)
+
+    # Share the Lamini rate limits between every call this process makes
+    configure_rate_limits(args)
+
     # Set the logging level
     logging.basicConfig(level=logging.INFO)
 
@@ -67,21 +78,18 @@ def main():
 def save_product_descriptions(product_descriptions, args):
 
     # Get the size of the existing file
-    if os.path.exists(args.output):
-        with open(args.output, "r") as f:
-            size = len(f.readlines())
-    else:
-        size = 0
+    size = count_rows(args.output)
 
     logging.info("Fast forward -- Skipping %s product descriptions", size)
 
-    for index, product_description in enumerate(product_descriptions):
-        # Skip the questions that have already been generated
-        if index < size:
-            logging.info("Fast forward -- Skipping product %s", index)
-            continue
+    # Flush once per generated batch so that a crash loses at most one batch
+    with JsonlWriter(args.output, mode="a", batch_size=20) as writer:
+        for index, product_description in enumerate(product_descriptions):
+            # Skip the questions that have already been generated
+            if index < size:
+                logging.info("Fast forward -- Skipping product %s", index)
+                continue
 
-        with jsonlines.open(args.output, mode="a") as writer:
             writer.write(product_description)
 
 class ProductDescriptionGenerator:
@@ -93,7 +101,11 @@ class ProductDescriptionGenerator:
         self.config = config
 
         # Create the runner
-        self.runner = MistralRunner(config=config, local_cache_file='/app/shopper/data/local_cache.txt')
+        from lamini import MistralRunner
+
+        self.runner = limit_runner(
+            MistralRunner(config=config, local_cache_file='/app/shopper/data/local_cache.txt')
+        )
 
         self.batch_size = batch_size
 
@@ -105,6 +117,8 @@ class ProductDescriptionGenerator:
     def generate(self):
         """Generate the product descriptions."""
 
+        from tqdm import tqdm
+
         # Generate the product descriptions
         for product_batch in tqdm(self.products):
             prompt_batch = [self.make_prompt(product) for product in product_batch]
@@ -177,5 +191,5 @@ def load_products(args):
 
     logging.info("Randly selected %s products", index)
 
-main()
-
+if __name__ == "__main__":
+    main()
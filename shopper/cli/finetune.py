@@ -1,8 +1,11 @@
-from lamini import LlamaV2Runner
-
-import jsonlines
-import os
-from tqdm import tqdm
+from shopper.util.dataset import ShardWriter, submit_dataset
+from shopper.util.jsonl import read_jsonl
+from shopper.util.profiling import add_profile_arguments, start_profiling
+from shopper.util.rate_limit import (
+    add_rate_limit_arguments,
+    configure_rate_limits,
+    limit_runner,
+)
 
 import argparse
 
@@ -33,46 +36,75 @@ def main():
         default=100,
     )
 
+    # The training data is written here in shards before it is submitted
+    parser.add_argument(
+        "--dataset",
+        help="The directory to write the training data shards to",
+        default="/app/shopper/data/finetune-dataset",
+    )
+
+    parser.add_argument(
+        "--shard-size",
+        help="The number of training examples per shard.",
+        type=int,
+        default=1000,
+    )
+
+    add_profile_arguments(parser)
+    add_rate_limit_arguments(parser)
+
     # Get the arguments
     args = parser.parse_args()
 
+    # Profile the run if requested, the reports are written next to the output
+    start_profiling(args, args.recommendation_jsonl)
+
+    # Share the Lamini rate limits between every call this process makes
+    configure_rate_limits(args)
+
     # Set the logging level
     logging.basicConfig(level=logging.DEBUG)
 
     logging.info(f"Generating product descriptions for {args.limit} products.")
 
-    # Load the recommendations
-    recommendations = load_recommendations(args)
+    # Stream the recommendations into shards
+    with ShardWriter(args.dataset, shard_size=args.shard_size) as writer:
+        writer.write_all(load_recommendations(args))
 
-    runner = LlamaV2Runner()
+    def submit(recommendations):
+        from lamini import LlamaV2Runner
 
-    runner.load_data(recommendations)
+        runner = limit_runner(LlamaV2Runner())
 
-    runner.train()
+        runner.load_data(recommendations)
 
+        runner.train()
+
+    # Identical training data is never submitted twice
+    submit_dataset(args.dataset, submit, key="LlamaV2Runner")
 
 
 def load_recommendations(args):
+    from tqdm import tqdm
 
     # Load the recommendations
-    recommendations = []
-    with jsonlines.open(args.recommendation_jsonl) as reader:
-        for recommendation in tqdm(reader, total=int(args.limit)):
-            recommendation_example = {
-                    "user" : f"What would go well with {recommendation['product']['product']['product_name']}?",
-                    "output" : recommendation['recommendation'],
-                    }
-
-            logging.debug(recommendation_example)
-            recommendations.append(recommendation_example)
-
-            if len(recommendations) >= int(args.limit):
-                break
+    count = 0
+    reader = read_jsonl(args.recommendation_jsonl)
+    for recommendation in tqdm(reader, total=int(args.limit)):
+        recommendation_example = {
+                "user" : f"What would go well with {recommendation['product']['product']['product_name']}?",
+                "output" : recommendation['recommendation'],
+                }
 
-    logging.info(f"Loaded {len(recommendations)} recommendations.")
+        logging.debug(recommendation_example)
+        yield recommendation_example
+        count += 1
 
-    return recommendations
+        if count >= int(args.limit):
+            break
 
+    logging.info(f"Loaded {count} recommendations.")
 
-main()
 
+if __name__ == "__main__":
+    main()
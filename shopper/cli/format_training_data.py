@@ -1,11 +1,13 @@
-from lamini import LlamaV2Runner, Type, Context
+from shopper.util.jsonl import JsonlWriter, read_jsonl
+from shopper.util.profiling import add_profile_arguments, start_profiling
+from shopper.util.rate_limit import (
+    add_rate_limit_arguments,
+    configure_rate_limits,
+    limit_runner,
+)
 
-import jsonlines
-import os
 import random
 
-from tqdm import tqdm
-
 import argparse
 
 import logging
@@ -42,9 +44,18 @@ def main():
         default="/app/shopper/data/formatted-recommendations.jsonl",
     )
 
+    add_profile_arguments(parser)
+    add_rate_limit_arguments(parser)
+
     # Get the arguments
     args = parser.parse_args()
 
+    # Profile the run if requested, the reports are written next to the output
+    start_profiling(args, args.output)
+
+    # Share the Lamini rate limits between every call this process makes
+    configure_rate_limits(args)
+
     # Set the logging level
     logging.basicConfig(level=logging.DEBUG)
 
@@ -66,12 +77,13 @@ def main():
 
 def load_recommendations(args):
     """Load the recommendations from the jsonl file."""
+    from tqdm import tqdm
 
     # Load the recommendations
     recommendations = []
-    with jsonlines.open(args.product_jsonl) as reader:
-        for recommendation in tqdm(reader, total=int(args.limit)):
-            recommendations.append(recommendation)
+    reader = read_jsonl(args.product_jsonl)
+    for recommendation in tqdm(reader, total=int(args.limit)):
+        recommendations.append(recommendation)
 
     logging.info(f"Loaded {len(recommendations)} recommendations.")
 
@@ -136,7 +148,9 @@ class RecommendationFormatter:
     def format_batch(self, batch):
         prompts, system_prompt = self.generate_prompts(batch)
 
-        runner = LlamaV2Runner(config=self.config)
+        from lamini import LlamaV2Runner
+
+        runner = limit_runner(LlamaV2Runner(config=self.config))
 
         recommendations = runner(prompts, system_prompt)
 
@@ -188,8 +202,9 @@ class RecommendationFormatter:
 
 def save_formatted_recommendations(final_recommendations, output, limit):
     """Save the final recommendations to the output file."""
+    from tqdm import tqdm
 
-    with jsonlines.open(output, "w") as writer:
+    with JsonlWriter(output, "w") as writer:
         for index, final_recommendation in tqdm(enumerate(final_recommendations)):
             writer.write(final_recommendation)
             # stop after limit
@@ -197,4 +212,5 @@ def save_formatted_recommendations(final_recommendations, output, limit):
                 break
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,104 @@
+import sys
+
+# Each subcommand maps to the module and function that implements it. The
+# module is only imported once its subcommand is chosen, so listing the
+# subcommands never pays for lamini, sklearn or numpy.
+COMMANDS = {
+    "expand-products": (
+        "shopper.cli.expand_products",
+        "main",
+        "Generate product descriptions for the catalog.",
+    ),
+    "train": (
+        "shopper.cli.train",
+        "main",
+        "Train a classifier on product descriptions.",
+    ),
+    "make-training-data": (
+        "shopper.cli.make_training_data",
+        "main",
+        "Generate recommendations with real product ids.",
+    ),
+    "format-training-data": (
+        "shopper.cli.format_training_data",
+        "main",
+        "Format recommendations into english paragraphs.",
+    ),
+    "finetune": (
+        "shopper.cli.finetune",
+        "main",
+        "Finetune an LLM on the formatted recommendations.",
+    ),
+    "normalize-examples": (
+        "shopper.cli.normalize_examples",
+        "main",
+        "Clean and truncate the saved generated examples.",
+    ),
+    "pipeline": (
+        "shopper.cli.pipeline",
+        "main",
+        "Run the pipeline stages that are out of date.",
+    ),
+    "description-tune": (
+        "shopper.cli.description_tune",
+        "train",
+        "Tune an LLM on the product descriptions.",
+    ),
+    "eval": (
+        "shopper.cli.eval_description_tuned",
+        "main",
+        "Evaluate a description tuned model.",
+    ),
+    "classify-file": (
+        "shopper.cli.classify_file",
+        "main",
+        "Classify every text in a JSONL or CSV file.",
+    ),
+    "simple-qa-tune": (
+        "shopper.cli.simple_qa_tune",
+        "main",
+        "Generate a simple question and answer dataset.",
+    ),
+}
+
+
+def main(argv=None):
+    """The shopper command, which dispatches to one of the pipeline CLIs."""
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if len(argv) == 0 or argv[0] in ("-h", "--help"):
+        print_help()
+        return 0
+
+    command = argv[0]
+
+    if command not in COMMANDS:
+        print(f"shopper: unknown command '{command}'\n", file=sys.stderr)
+        print_help(file=sys.stderr)
+        return 2
+
+    module_name, function_name, _ = COMMANDS[command]
+
+    # The subcommands parse sys.argv themselves
+    sys.argv = [f"shopper {command}"] + argv[1:]
+
+    import importlib
+
+    module = importlib.import_module(module_name)
+    getattr(module, function_name)()
+
+    return 0
+
+
+def print_help(file=sys.stdout):
+    print("usage: shopper <command> [<args>]\n", file=file)
+    print("commands:", file=file)
+    for command, (_, _, description) in COMMANDS.items():
+        print(f"  {command:<22}{description}", file=file)
+    print("\nRun 'shopper <command> --help' for the options of a command.", file=file)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,13 +1,13 @@
-from shopper.classifier.lamini_classifier import LaminiClassifier
+from shopper.util.jsonl import JsonlWriter, read_jsonl
+from shopper.util.profiling import add_profile_arguments, start_profiling
+from shopper.util.rate_limit import (
+    add_rate_limit_arguments,
+    configure_rate_limits,
+    limit_runner,
+)
 
-from lamini import LlamaV2Runner, Type, Context
-
-import jsonlines
-import os
 import random
 
-from tqdm import tqdm
-
 import argparse
 
 import logging
@@ -51,9 +51,18 @@ def main():
         default="/app/shopper/data/recommendations.jsonl",
     )
 
+    add_profile_arguments(parser)
+    add_rate_limit_arguments(parser)
+
     # Get the arguments
     args = parser.parse_args()
 
+    # Profile the run if requested, the reports are written next to the output
+    start_profiling(args, args.output)
+
+    # Share the Lamini rate limits between every call this process makes
+    configure_rate_limits(args)
+
     # Set the logging level
     logging.basicConfig(level=logging.DEBUG)
 
@@ -68,6 +77,8 @@ def main():
     )
 
     # Load the classifier
+    from shopper.classifier.lamini_classifier import LaminiClassifier
+
     classifier = LaminiClassifier.load(args.model)
 
     # Answer the questions
@@ -81,12 +92,13 @@ def main():
 
 def load_products(args):
     """Load the products from the jsonl file."""
+    from tqdm import tqdm
 
     # Load the products
     products = []
-    with jsonlines.open(args.product_jsonl) as reader:
-        for product in tqdm(reader, total=int(args.limit)):
-            products.append(product)
+    reader = read_jsonl(args.product_jsonl)
+    for product in tqdm(reader, total=int(args.limit)):
+        products.append(product)
 
     logging.info(f"Loaded {len(products)} products.")
 
@@ -126,6 +138,7 @@ class RecommendationGenerator:
 
     def expand_recommendations(self, recommendation_batchs):
         """Expand the recommendations."""
+        from tqdm import tqdm
 
         # Expand the recommendations
         for recommendation_batch in tqdm(recommendation_batchs):
@@ -138,7 +151,9 @@ class RecommendationGenerator:
         # Generate questions for the batch
         prompts, system_prompt = self.generate_expansion_prompts(recommendation_batch)
 
-        runner = LlamaV2Runner(config=self.config)
+        from lamini import LlamaV2Runner
+
+        runner = limit_runner(LlamaV2Runner(config=self.config))
 
         # Run the model
         expanded_recommendations = runner(prompts, system_prompt=system_prompt)
@@ -182,6 +197,8 @@ class RecommendationGenerator:
         return prompt
 
     def generate_simple_recommendations(self, products, limit):
+        from tqdm import tqdm
+
         # Generate questions in batches
         for i in tqdm(range(0, limit, self.batch_size)):
             batch = self.generate_recommendation_batch(products, seed=i)
@@ -197,7 +214,9 @@ class RecommendationGenerator:
         # Generate questions for the batch
         prompts, system_prompt = self.generate_prompts(batch)
 
-        runner = LlamaV2Runner(config=self.config)
+        from lamini import LlamaV2Runner, Type, Context
+
+        runner = limit_runner(LlamaV2Runner(config=self.config))
 
         class TopProducts(Type):
             product_1: str = Context("")
@@ -257,6 +276,8 @@ class AnswerGenerator:
             product["product"]["product_name"]: product for product in products
         }
 
+        from tqdm import tqdm
+
         # Group recommendations into batches
         recommendation_batchs = self.group_recommendations(recommendations)
 
@@ -313,10 +334,12 @@ class AnswerGenerator:
 
 def save_final_recommendations(final_recommendations, output):
     """Save the final recommendations to the output file."""
+    from tqdm import tqdm
 
-    with jsonlines.open(output, "w") as writer:
+    with JsonlWriter(output, "w") as writer:
         for final_recommendation in tqdm(final_recommendations):
             writer.write(final_recommendation)
 
 
-main()
+if __name__ == "__main__":
+    main()
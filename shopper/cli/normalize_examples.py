@@ -0,0 +1,144 @@
+from shopper.util.jsonl import JsonlWriter, dumps, read_jsonl
+
+import argparse
+import os
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def main():
+    """Normalize the generated examples that are already stored."""
+
+    parser = argparse.ArgumentParser(
+        description="Strip preambles and markup from stored examples and truncate them."
+    )
+
+    # The examples saved during generation, one class per row
+    parser.add_argument(
+        "examples_jsonl",
+        nargs="?",
+        help="The jsonl file of saved examples, rewritten in place. Defaults to "
+        "the file the classifier saves examples to.",
+        default=None,
+    )
+
+    # A trained classifier pickles its examples too
+    parser.add_argument(
+        "--model",
+        help="Also normalize the examples stored in this classifier.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--max-tokens",
+        help="Truncate every example to this many tokens.",
+        type=int,
+        default=128,
+    )
+
+    parser.add_argument(
+        "--report",
+        help="Write the bytes saved per class to this json file.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--top",
+        help="Log this many classes with the most bytes saved.",
+        type=int,
+        default=10,
+    )
+
+    # Get the arguments
+    args = parser.parse_args()
+
+    # Set the logging level
+    logging.basicConfig(level=logging.INFO)
+
+    from shopper.classifier.example_normalizer import ExampleNormalizer
+    from shopper.classifier.lamini_classifier import (
+        SAVED_EXAMPLES_FILENAME,
+        LaminiClassifier,
+    )
+
+    normalizer = ExampleNormalizer(max_tokens=args.max_tokens)
+
+    examples_jsonl = args.examples_jsonl
+    if examples_jsonl is None:
+        examples_jsonl = SAVED_EXAMPLES_FILENAME
+
+    reports = {}
+
+    if os.path.exists(examples_jsonl):
+        reports["examples"] = normalize_examples_file(examples_jsonl, normalizer)
+        log_report(examples_jsonl, reports["examples"], args.top)
+    elif args.examples_jsonl is not None:
+        raise Exception(f"No saved examples at {examples_jsonl}")
+
+    if args.model is not None:
+        classifier = LaminiClassifier.load(args.model)
+        classifier.example_normalizer = normalizer
+
+        reports["model"] = classifier.normalize_stored_examples()
+        classifier.save(args.model)
+
+        log_report(args.model, reports["model"], args.top)
+        logger.info("Retrain the classifier for its weights to use the normalized examples")
+
+    if args.report is not None:
+        with open(args.report, "w") as f:
+            f.write(dumps(reports))
+
+
+def normalize_examples_file(filename, normalizer):
+    """Rewrite a saved examples file with normalized examples, returning the
+    bytes before and after per class."""
+    report = {}
+
+    # Write a new file and swap it in, so an interrupted run never leaves a
+    # truncated file
+    with JsonlWriter(filename + ".tmp", "w") as writer:
+        for row in read_jsonl(filename):
+            examples = row["examples"]
+            if isinstance(examples, str):
+                examples = [examples]
+
+            normalized, bytes_before, bytes_after = normalizer.normalize_examples(examples)
+
+            report[row["class_name"]] = {
+                "examples_before": len(examples),
+                "examples_after": len(normalized),
+                "bytes_before": bytes_before,
+                "bytes_after": bytes_after,
+                "bytes_saved": bytes_before - bytes_after,
+            }
+
+            writer.write({"class_name": row["class_name"], "examples": normalized})
+
+    os.replace(filename + ".tmp", filename)
+
+    return report
+
+
+def log_report(filename, report, top):
+    before = sum(entry["bytes_before"] for entry in report.values())
+    after = sum(entry["bytes_after"] for entry in report.values())
+
+    logger.info(
+        f"{filename}: {len(report)} classes, {before} bytes of examples before and "
+        f"{after} after, {before - after} saved "
+        f"({100 * (before - after) / max(1, before):.1f}%)"
+    )
+
+    largest = sorted(report.items(), key=lambda item: -item[1]["bytes_saved"])[:top]
+    for class_name, entry in largest:
+        logger.info(
+            f"  {entry['bytes_saved']:8d} bytes saved, "
+            f"{entry['examples_before']} -> {entry['examples_after']} examples: {class_name}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+from shopper.util.pipeline import Pipeline, Stage
+from shopper.util.rate_limit import add_rate_limit_arguments, get_rate_limit_environment
+
+import argparse
+import os
+import shlex
+import sys
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The stages run when --stages is not given, description-tune is an optional
+# branch that runs in parallel with the classifier chain
+DEFAULT_STAGES = [
+    "expand-products",
+    "train",
+    "make-training-data",
+    "format-training-data",
+    "finetune",
+]
+
+
+def main():
+    """Run the out of date stages of the training data pipeline."""
+
+    parser = argparse.ArgumentParser(
+        description="Run the pipeline stages whose inputs, arguments or code changed."
+    )
+
+    # Every stage reads and writes its files in these directories
+    parser.add_argument(
+        "--data",
+        help="The directory of the pipeline's data files.",
+        default="/app/shopper/data",
+    )
+
+    parser.add_argument(
+        "--models",
+        help="The directory of the pipeline's models.",
+        default="/app/shopper/models",
+    )
+
+    parser.add_argument(
+        "--limit",
+        help="The number of products or recommendations each stage processes.",
+        type=int,
+        default=100,
+    )
+
+    parser.add_argument(
+        "--stages",
+        help="Comma separated stages to consider, defaults to "
+        + ",".join(DEFAULT_STAGES)
+        + ". Choices: "
+        + ",".join(STAGE_NAMES)
+        + ".",
+        default=",".join(DEFAULT_STAGES),
+    )
+
+    # Forced stages rerun even if they are up to date, and so do the stages
+    # after them if their outputs change
+    parser.add_argument(
+        "--force",
+        help="Comma separated stages to rerun even if they are up to date.",
+        default="",
+    )
+
+    parser.add_argument(
+        "--stage-args",
+        help="Extra arguments for one stage, as NAME=ARGS, for example "
+        "train='--jobs 4'. Can be repeated.",
+        action="append",
+        default=[],
+    )
+
+    parser.add_argument(
+        "--jobs",
+        help="The number of independent stages to run at the same time.",
+        type=int,
+        default=2,
+    )
+
+    parser.add_argument(
+        "--dry-run",
+        help="Only print which stages are stale.",
+        action="store_true",
+    )
+
+    # Fingerprints and timings are kept here, with a log of every stage run
+    # next to it
+    parser.add_argument(
+        "--state",
+        help="The pipeline state file, defaults to pipeline-state.json in --data.",
+        default=None,
+    )
+
+    # The limits are for the whole pipeline, and split evenly between the
+    # stages that run at the same time
+    add_rate_limit_arguments(parser)
+
+    # Get the arguments
+    args = parser.parse_args()
+
+    # Set the logging level
+    logging.basicConfig(level=logging.INFO)
+
+    names = parse_names(args.stages)
+    force = parse_names(args.force)
+
+    stage_args = parse_stage_args(args.stage_args)
+
+    stages = [
+        stage
+        for stage in make_stages(args.data, args.models, args.limit, stage_args)
+        if stage.name in names
+    ]
+
+    environment = get_rate_limit_environment(args, processes=max(1, min(args.jobs, len(stages))))
+    for stage in stages:
+        stage.env.update(environment)
+
+    state_filename = args.state
+    if state_filename is None:
+        state_filename = os.path.join(args.data, "pipeline-state.json")
+
+    pipeline = Pipeline(stages, state_filename, jobs=args.jobs)
+
+    results = pipeline.run(force=force, dry_run=args.dry_run)
+
+    print(format_results(results))
+
+    sys.exit(1 if any(result["status"] in ("failed", "blocked") for result in results) else 0)
+
+
+def make_stages(data, models, limit, stage_args={}):
+    """The pipeline stages with their files in the data and models directories."""
+    from shopper.classifier.lamini_classifier import SAVED_EXAMPLES_FILENAME
+
+    products_csv = os.path.join(data, "products.csv")
+    products = os.path.join(data, "products.jsonl")
+    classifier = os.path.join(models, "classifier.pkl")
+    recommendations = os.path.join(data, "recommendations.jsonl")
+    formatted = os.path.join(data, "formatted-recommendations.jsonl")
+    finetune_dataset = os.path.join(data, "finetune-dataset")
+    description_dataset = os.path.join(data, "description-tune-dataset")
+
+    # Training reads the examples generated by earlier runs and saves them
+    # again with the new ones
+    saved_examples = SAVED_EXAMPLES_FILENAME
+
+    stages = [
+        Stage(
+            "expand-products",
+            "expand-products",
+            args=[products_csv, "--output", products, "--limit", limit],
+            inputs=[products_csv],
+            outputs=[products],
+            code=["cli/expand_products.py"],
+        ),
+        Stage(
+            "train",
+            "train",
+            args=[products, "--output", classifier, "--limit", limit],
+            inputs=[products, saved_examples],
+            outputs=[classifier, saved_examples],
+            code=["cli/train.py", "classifier"],
+        ),
+        Stage(
+            "make-training-data",
+            "make-training-data",
+            args=[
+                products,
+                "--model",
+                classifier,
+                "--output",
+                recommendations,
+                "--limit",
+                limit,
+            ],
+            inputs=[products, classifier],
+            outputs=[recommendations],
+            code=["cli/make_training_data.py", "classifier"],
+        ),
+        Stage(
+            "format-training-data",
+            "format-training-data",
+            args=[recommendations, "--output", formatted, "--limit", limit],
+            inputs=[recommendations],
+            outputs=[formatted],
+            code=["cli/format_training_data.py"],
+        ),
+        Stage(
+            "finetune",
+            "finetune",
+            args=[formatted, "--dataset", finetune_dataset, "--limit", limit],
+            inputs=[formatted],
+            outputs=[finetune_dataset],
+            code=["cli/finetune.py", "util/dataset.py"],
+        ),
+        Stage(
+            "description-tune",
+            "description-tune",
+            args=[products, "--dataset", description_dataset],
+            inputs=[products],
+            outputs=[description_dataset],
+            code=["cli/description_tune.py", "util/dataset.py"],
+        ),
+    ]
+
+    for stage in stages:
+        stage.args += stage_args.get(stage.name, [])
+
+    return stages
+
+
+STAGE_NAMES = [stage.name for stage in make_stages("", "", 0)]
+
+
+def parse_names(value):
+    names = [name.strip() for name in value.split(",") if name.strip() != ""]
+
+    for name in names:
+        if name not in STAGE_NAMES:
+            raise Exception(f"Unknown pipeline stage '{name}', choose from {STAGE_NAMES}")
+
+    return names
+
+
+def parse_stage_args(values):
+    """Parse NAME=ARGS pairs into a dict of argument lists."""
+    stage_args = {}
+
+    for value in values:
+        name, separator, arguments = value.partition("=")
+        if separator == "":
+            raise Exception(f"Expected NAME=ARGS for --stage-args, got '{value}'")
+
+        parse_names(name)
+        stage_args.setdefault(name.strip(), []).extend(shlex.split(arguments))
+
+    return stage_args
+
+
+def format_results(results):
+    lines = []
+    for result in results:
+        line = f"{result['stage']:<22}{result['status']:<9}"
+        if "seconds" in result:
+            line += f"{result['seconds']:.1f}s"
+        lines.append(line)
+
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    main()
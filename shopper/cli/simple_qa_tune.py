@@ -1,8 +1,12 @@
-from lamini import MistralRunner, LaminiClassifier
+from shopper.util.jsonl import JsonlWriter, loads, dumps
+from shopper.util.profiling import add_profile_arguments, start_profiling
+from shopper.util.rate_limit import (
+    add_rate_limit_arguments,
+    configure_rate_limits,
+    limit_runner,
+)
 
-import jsonlines
 import random
-from tqdm import tqdm
 import argparse
 import logging
 import csv
@@ -10,14 +14,73 @@ import os
 
 logger = logging.getLogger(__name__)
 
-base_runner = MistralRunner()
+base_runner = None
+
+map_product_name_to_info = None
+
+
+def get_base_runner():
+    """ Create the runner on first use, so importing this module stays fast. """
+    global base_runner
+    if base_runner is None:
+        from lamini import MistralRunner
+
+        base_runner = limit_runner(MistralRunner())
+    return base_runner
 
 
 def main():
-    products = load_products(limit=3)
-    answers = generate_answers(products)
-    questions = generate_questions(answers)
-    filepath = create_qa_dataset(questions, answers)
+    """ Generate a question and answer dataset, one chunk of products at a time. """
+
+    parser = argparse.ArgumentParser(description="Generate a QA dataset")
+
+    # Limit the number of products to generate questions for
+    parser.add_argument(
+        "--limit",
+        help="The number of products to generate questions for.",
+        type=int,
+        default=3,
+    )
+
+    # The number of products carried through every stage together
+    parser.add_argument(
+        "--chunk-size",
+        help="The number of products to process per chunk.",
+        type=int,
+        default=20,
+    )
+
+    # The output of the program is a json lines file
+    parser.add_argument(
+        "--output",
+        help="The JSONL file to append the question and answer pairs to",
+        default="qa_dataset.jsonl",
+    )
+
+    add_profile_arguments(parser)
+    add_rate_limit_arguments(parser)
+
+    args = parser.parse_args()
+
+    # Profile the run if requested, the reports are written next to the output
+    start_profiling(args, args.output)
+
+    # Share the Lamini rate limits between every call this process makes
+    configure_rate_limits(args)
+
+    logging.basicConfig(level=logging.INFO)
+
+    product_classifier = create_product_classifier()
+
+    filepath = create_qa_dataset(
+        load_products(limit=args.limit),
+        product_classifier,
+        args.output,
+        chunk_size=args.chunk_size,
+        limit=args.limit,
+    )
+
+    logger.info(f"Saved QA dataset to {filepath}")
 
 def load_products(limit=None):
     """ Load the products from the csv file. """
@@ -30,7 +93,16 @@ def load_products(limit=None):
                 break
     return products
 
+def get_map_product_name_to_info():
+    """ Load the products the classifier was trained on once, by name. """
+    global map_product_name_to_info
+    if map_product_name_to_info is None:
+        map_product_name_to_info = { product['product_name']: product for product in load_products(limit=1000) }
+    return map_product_name_to_info
+
 def create_product_classifier():
+    from lamini import LaminiClassifier
+
     if os.path.exists('product_classifier.lamini'):
         return LaminiClassifier.load('product_classifier.lamini')
 
@@ -38,14 +110,14 @@ def create_product_classifier():
 
     classifier = LaminiClassifier()
 
-    prompts = {} 
+    prompts = {}
     for product in products:
         product_name = product['product_name']
-    
+
         classifier.add_data_to_class(product_name, product_name)
-        
+
         # prompts[product_name] = product_name
-    
+
     # Prompt train with descriptions of the products
     # print(prompts)
     # print('above are classifier prompts')
@@ -55,17 +127,17 @@ def create_product_classifier():
     classifier.save_local('/app/shopper/models/product_classifier.lamini')
     return classifier
 
-def generate_common_sense_product_groups(products):
+def generate_common_sense_product_groups(products, product_classifier):
     """
     Generate product groups, based on common sense using LLMs, for each product.
     Extend (suggested). You can take this to the next level by:
-        * Batching this operation
         * Expanding upon these product groups for better prompts
         * Generate descriptions of products for better embeddings, and for training a better LLM classifier (below)
         * Training an LLM classifier to classify the product pairs into categories
     """
-    map_product_name_to_info = { product['product_name']: product for product in products }
-    
+    # The classifier matches recommendations against the products it was trained on
+    map_product_name_to_info = get_map_product_name_to_info()
+
     # Create prompts, to get related products to each product using an LLM
     prompts = []
     for product in products:
@@ -81,20 +153,22 @@ def generate_common_sense_product_groups(products):
         "product_2": "str",
         "product_3": "str"
     }
-    print(prompts)
-    recommendations = base_runner(prompts, system_prompt, output_type=top_products)
-    print(recommendations)
+    logger.debug(prompts)
+    recommendations = get_base_runner()(prompts, system_prompt, output_type=top_products)
+    logger.debug(recommendations)
 
-    # Classify recommendations into products
-    product_classifier = create_product_classifier()
+    # Classify every recommendation in the chunk with one batched call
+    recommended_names = []
     for recommendation in recommendations:
-        matched_products = product_classifier.predict([recommendation['product_1'], recommendation['product_2'], recommendation['product_3']])
-        print(matched_products)
-        print('matched')
+        recommended_names += [recommendation['product_1'], recommendation['product_2'], recommendation['product_3']]
+
+    matched_products = product_classifier.predict(recommended_names)
+    logger.debug(f"Matched {len(matched_products)} recommendations to products")
 
-        # Extend: Turn these into groups, not just pairs 
-        product_pairs = []
-        for matched_product in matched_products:
+    # Extend: Turn these into groups, not just pairs
+    product_pairs = []
+    for index, product in enumerate(products):
+        for matched_product in matched_products[index * 3:(index + 1) * 3]:
             matched_product_info = map_product_name_to_info[matched_product]
 
             product_pair = {
@@ -106,8 +180,8 @@ def generate_common_sense_product_groups(products):
     return product_pairs
 
 
-def generate_answers(products):
-    product_pairs = generate_common_sense_product_groups(products)
+def generate_answers(products, product_classifier):
+    product_pairs = generate_common_sense_product_groups(products, product_classifier)
 
     system_prompt = "You are an expert on grocery products. You know all of the details about the products. You are given a grocery item that you might find at a supermarket."
 
@@ -115,11 +189,11 @@ def generate_answers(products):
     for product_pair in product_pairs:
         recommendation_prompt = f"You recommended that '{product_pair['recommended_product']['product_name']}' would go well with '{product_pair['product']['product_name']}'. Write a three sentence detailed and concise description of {product_pair['recommended_product']['product_name']}. Get straight to the point. End with a period and new line."
         prompts.append(recommendation_prompt)
-    
+
     # Run the model
-    print(prompts)
-    answers = base_runner(prompts, system_prompt=system_prompt)
-    print(answers)
+    logger.debug(prompts)
+    answers = get_base_runner()(prompts, system_prompt=system_prompt)
+    logger.debug(answers)
 
     return answers
 
@@ -131,21 +205,84 @@ def generate_questions(answers):
         prompt = answer['output'] + '\n' + 'Write a question that the customer might have asked that led to your recommendation. End with a period and new line.'
         prompts.append(prompt)
 
-    print(prompts)
-    questions = base_runner(prompts, system_prompt=system_prompt)
-    print(questions)
+    logger.debug(prompts)
+    questions = get_base_runner()(prompts, system_prompt=system_prompt)
+    logger.debug(questions)
 
     return questions
 
-def create_qa_dataset(questions, answers):
-    # Write question and answer pairs to a jsonl file
-    filepath = 'qa_dataset.jsonl'
-    with jsonlines.open(filepath, 'w') as writer:
-        for question, answer in zip(questions, answers):
-            writer.write({
-                'question': question,
-                'answer': answer
-            })
+def create_qa_dataset(products, product_classifier, filepath, chunk_size=20, limit=None):
+    """
+    Write question and answer pairs to a jsonl file, one chunk of products at a time.
+
+    After each chunk is appended, the number of finished chunks and the size of
+    the file are recorded next to it, so a rerun resumes after the last complete
+    chunk instead of paying for the upstream stages again. The chunk size and
+    limit are recorded too, since the chunks only line up with the same ones.
+    """
+    from tqdm import tqdm
+
+    settings = {'chunk_size': chunk_size, 'limit': limit}
+
+    progress = load_progress(filepath, settings)
+    check_progress_settings(filepath, progress, settings)
+
+    # Drop any rows from a chunk that did not finish
+    if os.path.exists(filepath):
+        with open(filepath, 'r+b') as f:
+            f.truncate(progress['offset'])
+
+    chunks = [products[i:i + chunk_size] for i in range(0, len(products), chunk_size)]
+
+    logger.info(f"Resuming after {progress['chunks']} of {len(chunks)} chunks")
+
+    for index in tqdm(range(progress['chunks'], len(chunks))):
+        answers = generate_answers(chunks[index], product_classifier)
+        questions = generate_questions(answers)
+
+        with JsonlWriter(filepath, 'a') as writer:
+            for question, answer in zip(questions, answers):
+                writer.write({
+                    'question': question,
+                    'answer': answer
+                })
+
+        save_progress(filepath, {'chunks': index + 1, 'offset': os.path.getsize(filepath), **settings})
+
     return filepath
 
-main()
\ No newline at end of file
+def progress_filepath(filepath):
+    return filepath + '.progress'
+
+def load_progress(filepath, settings):
+    if not os.path.exists(filepath) or os.path.getsize(filepath) == 0:
+        return {'chunks': 0, 'offset': 0, **settings}
+
+    # Without the progress file there is no telling where the chunks end
+    if not os.path.exists(progress_filepath(filepath)):
+        raise Exception(
+            f"{filepath} exists but {progress_filepath(filepath)} does not. "
+            f"Move {filepath} away to start over."
+        )
+
+    with open(progress_filepath(filepath), 'r') as f:
+        return loads(f.read())
+
+def check_progress_settings(filepath, progress, settings):
+    """ Refuse to resume chunks that were made with different settings. """
+    for name, value in settings.items():
+        if progress[name] != value:
+            raise Exception(
+                f"{filepath} was started with {name} {progress[name]}, not {value}. "
+                f"Rerun with the same setting, or delete {progress_filepath(filepath)} to start over."
+            )
+
+def save_progress(filepath, progress):
+    # Write then rename so the progress file is never half written
+    temporary_filepath = progress_filepath(filepath) + '.tmp'
+    with open(temporary_filepath, 'w') as f:
+        f.write(dumps(progress))
+    os.replace(temporary_filepath, progress_filepath(filepath))
+
+if __name__ == "__main__":
+    main()
@@ -1,8 +1,6 @@
-from shopper.classifier.lamini_classifier import LaminiClassifier
-
-import jsonlines
-import os
-from tqdm import tqdm
+from shopper.util.jsonl import dumps, read_jsonl
+from shopper.util.profiling import add_profile_arguments, start_profiling
+from shopper.util.rate_limit import add_rate_limit_arguments, configure_rate_limits
 
 import argparse
 
@@ -40,9 +38,146 @@ def main():
         default=100,
     )
 
+    # Classify department -> aisle -> product instead of one flat softmax
+    parser.add_argument(
+        "--hierarchical",
+        help="Train a hierarchical department, aisle, product classifier.",
+        action="store_true",
+    )
+
+    # The number of partial paths kept at each level of the hierarchy
+    parser.add_argument(
+        "--beam-width",
+        help="The beam width of the hierarchical classifier.",
+        type=int,
+        default=3,
+    )
+
+    # Train one-vs-rest heads across several processes
+    parser.add_argument(
+        "--jobs",
+        help="The number of processes to train with, 0 uses every core.",
+        type=int,
+        default=1,
+    )
+
+    # Reduce the embeddings before they reach the classifier
+    parser.add_argument(
+        "--projection",
+        help="Project the embeddings with 'pca' or 'random' before training.",
+        choices=["pca", "random"],
+        default=None,
+    )
+
+    parser.add_argument(
+        "--projection-dim",
+        help="The number of dimensions to project the embeddings to.",
+        type=int,
+        default=128,
+    )
+
+    parser.add_argument(
+        "--quantize",
+        help="Quantize the projected embeddings to 'float16' or 'int8'.",
+        choices=["float16", "int8"],
+        default=None,
+    )
+
+    parser.add_argument(
+        "--report-projection-accuracy",
+        help="Log the held-out accuracy with and without the projection.",
+        action="store_true",
+    )
+
+    # Train on datasets larger than RAM
+    parser.add_argument(
+        "--training-matrix",
+        help="Memory-map the training embeddings from this .npy file.",
+        default=None,
+    )
+
+    parser.add_argument(
+        "--minibatch-size",
+        help="Stream mini-batches of this many examples through an incremental learner.",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--epochs",
+        help="The number of passes over the data in mini-batch training.",
+        type=int,
+        default=5,
+    )
+
+    # Generate a little more than needed to cover duplicates and failures
+    parser.add_argument(
+        "--overprovision",
+        help="Request this many times the examples still needed per class.",
+        type=float,
+        default=1.25,
+    )
+
+    # Spend generation only on the classes the classifier confuses
+    parser.add_argument(
+        "--active-budget",
+        help="Train with active learning, making at most this many LLM calls.",
+        type=int,
+        default=None,
+    )
+
+    parser.add_argument(
+        "--seed-examples",
+        help="The examples generated for every class before active learning.",
+        type=int,
+        default=2,
+    )
+
+    parser.add_argument(
+        "--classes-per-round",
+        help="The weakest classes given more examples each active learning round.",
+        type=int,
+        default=None,
+    )
+
+    # Cross-validate a grid of C, solver and class_weight on the generated
+    # examples, and train with the cheapest of the most accurate settings
+    parser.add_argument(
+        "--tune",
+        help="Choose the LogisticRegression parameters by cross-validation.",
+        action="store_true",
+    )
+
+    parser.add_argument(
+        "--cv-folds",
+        help="The number of cross-validation folds for --tune.",
+        type=int,
+        default=5,
+    )
+
+    parser.add_argument(
+        "--top-k",
+        help="Report how often the right class is in the top k for --tune.",
+        type=int,
+        default=5,
+    )
+
+    add_profile_arguments(parser)
+    add_rate_limit_arguments(parser)
+
     # Get the arguments
     args = parser.parse_args()
 
+    # Fail before paying for generation rather than after
+    if args.tune and args.hierarchical:
+        parser.error("--tune only supports flat classifiers, not --hierarchical")
+
+    # Profile the run if requested, the reports are written next to the output
+    start_profiling(args, args.output)
+
+    # Share the Lamini rate limits between every call this process makes
+    configure_rate_limits(args)
+
     # Set the logging level
     #logging.basicConfig(level=logging.DEBUG)
 
@@ -59,15 +194,69 @@ def main():
         }
     }
 
-    classifier = LaminiClassifier()#config=staging_config)
+    from shopper.classifier.lamini_classifier import LaminiClassifier
+    from shopper.classifier.hierarchical_classifier import HierarchicalLaminiClassifier
+    from shopper.classifier.projection import EmbeddingProjection
+
+    n_jobs = args.jobs if args.jobs > 0 else None
+
+    projection = None
+    if args.projection is not None:
+        projection = EmbeddingProjection(
+            method=args.projection,
+            n_components=args.projection_dim,
+            quantize=args.quantize,
+        )
+
+    classifier_args = {
+        "n_jobs": n_jobs,
+        "projection": projection,
+        "report_projection_accuracy": args.report_projection_accuracy,
+        "training_matrix_path": args.training_matrix,
+        "minibatch_size": args.minibatch_size,
+        "minibatch_epochs": args.epochs,
+        "overprovision": args.overprovision,
+    }
+
+    if args.hierarchical:
+        classifier = HierarchicalLaminiClassifier(
+            beam_width=args.beam_width, **classifier_args
+        )
+    else:
+        classifier = LaminiClassifier(**classifier_args)#config=staging_config)
+
+    # Attach the catalog entry, which places each product in the hierarchy
+    for product in products:
+        classifier.add_class(product["product"]["product_name"])
+        classifier.add_metadata_to_class(
+            product["product"]["product_name"], product["product"]
+        )
+
+    prompts = {
+        product["product"]["product_name"]: product["descriptions"]
+        for product in products
+    }
 
     # Train the classifier
-    classifier.prompt_train(
-        {
-            product["product"]["product_name"]: product["descriptions"]
-            for product in products
-        }
-    )
+    if args.active_budget is not None:
+        classifier.active_prompt_train(
+            prompts,
+            budget=args.active_budget,
+            seed_example_count=args.seed_examples,
+            classes_per_round=args.classes_per_round,
+        )
+    elif args.tune:
+        # Train once, after tuning on the same embeddings
+        classifier.generate_classes(prompts)
+    else:
+        classifier.prompt_train(prompts)
+
+    if args.tune:
+        classifier.tune(folds=args.cv_folds, top_k=args.top_k)
+        classifier.train()
+
+        with open(args.output + ".tuning.json", "w") as f:
+            f.write(dumps(classifier.tuning_report))
 
     # Save the classifier
     classifier.save(args.output)
@@ -75,19 +264,21 @@ def main():
 
 def load_products(args):
     """Load the products from the jsonl file."""
+    from tqdm import tqdm
 
     # Load the products
     products = []
-    with jsonlines.open(args.product_jsonl) as reader:
-        for product in tqdm(reader, total=int(args.limit)):
-            products.append(product)
+    reader = read_jsonl(args.product_jsonl)
+    for product in tqdm(reader, total=int(args.limit)):
+        products.append(product)
 
-            if len(products) >= int(args.limit):
-                break
+        if len(products) >= int(args.limit):
+            break
 
     logging.info(f"Loaded {len(products)} products.")
 
     return products
 
 
-main()
+if __name__ == "__main__":
+    main()
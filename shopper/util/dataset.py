@@ -0,0 +1,178 @@
+from shopper.util.jsonl import dumps, loads, read_jsonl
+
+import hashlib
+import os
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class ShardWriter:
+    """Streams records into fixed-size JSONL shards in a directory.
+
+    Each shard is named by the sha256 of its content, so that an unchanged
+    shard keeps its name across builds. Closing the writer writes a
+    manifest.json listing the shards in order with their row counts and
+    hashes, and a hash of the whole dataset. Only one record is held in
+    memory at a time.
+    """
+
+    def __init__(self, directory, shard_size=1000):
+        self.directory = directory
+        self.shard_size = shard_size
+
+        os.makedirs(directory, exist_ok=True)
+
+        self.shards = []
+        self.file = None
+        self.hasher = None
+        self.rows = 0
+
+    def write(self, record):
+        if self.file is None:
+            self.file = open(self.get_temporary_filename(), "w", encoding="utf-8")
+            self.hasher = hashlib.sha256()
+            self.rows = 0
+
+        line = dumps(record) + "\n"
+        self.file.write(line)
+        self.hasher.update(line.encode("utf-8"))
+        self.rows += 1
+
+        if self.rows >= self.shard_size:
+            self.finish_shard()
+
+    def write_all(self, records):
+        for record in records:
+            self.write(record)
+
+    def finish_shard(self):
+        if self.file is None:
+            return
+
+        self.file.close()
+        self.file = None
+
+        content_hash = self.hasher.hexdigest()
+        filename = f"shard-{content_hash[:16]}.jsonl"
+
+        # Identical content already on disk from an earlier build is kept
+        os.replace(self.get_temporary_filename(), os.path.join(self.directory, filename))
+
+        self.shards.append({"filename": filename, "rows": self.rows, "hash": content_hash})
+
+    def close(self):
+        self.finish_shard()
+
+        manifest = {
+            "shard_size": self.shard_size,
+            "rows": sum(shard["rows"] for shard in self.shards),
+            "hash": hashlib.sha256(
+                "".join(shard["hash"] for shard in self.shards).encode("utf-8")
+            ).hexdigest(),
+            "shards": self.shards,
+        }
+
+        with open(os.path.join(self.directory, "manifest.json"), "w") as f:
+            f.write(dumps(manifest))
+
+        # Remove the shards of earlier builds that are no longer used
+        current = set(shard["filename"] for shard in self.shards)
+        for filename in os.listdir(self.directory):
+            if filename.startswith("shard-") and filename not in current:
+                os.remove(os.path.join(self.directory, filename))
+
+        logger.info(
+            f"Wrote {manifest['rows']} rows in {len(self.shards)} shards to {self.directory}"
+        )
+
+        return manifest
+
+    def get_temporary_filename(self):
+        return os.path.join(self.directory, "shard.jsonl.tmp")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        elif self.file is not None:
+            self.file.close()
+
+
+def build_dataset(records, directory, shard_size=1000):
+    """Write records into shards in directory and return the manifest."""
+    with ShardWriter(directory, shard_size=shard_size) as writer:
+        writer.write_all(records)
+
+    return load_manifest(directory)
+
+
+def load_manifest(directory):
+    with open(os.path.join(directory, "manifest.json")) as f:
+        return loads(f.read())
+
+
+def read_shard(directory, shard):
+    return read_jsonl(os.path.join(directory, shard["filename"]))
+
+
+def read_dataset(directory):
+    """Yield every record of a dataset, one shard at a time."""
+    for shard in load_manifest(directory)["shards"]:
+        yield from read_shard(directory, shard)
+
+
+class SubmissionLog:
+    """Remembers which content hashes were submitted under each key, such as
+    a model name, in a json file that survives between runs."""
+
+    def __init__(self, filename):
+        self.filename = filename
+
+        self.submitted = {}
+        if os.path.exists(filename):
+            with open(filename) as f:
+                self.submitted = loads(f.read())
+
+    def is_submitted(self, key, content_hash):
+        return content_hash in self.submitted.get(key, [])
+
+    def mark_submitted(self, key, content_hash):
+        self.submitted.setdefault(key, []).append(content_hash)
+
+        # Write a new file and swap it in, so an interrupted run never
+        # leaves a truncated log
+        with open(self.filename + ".tmp", "w") as f:
+            f.write(dumps(self.submitted))
+        os.replace(self.filename + ".tmp", self.filename)
+
+
+def get_submission_log(directory):
+    return SubmissionLog(os.path.join(directory, "submitted.json"))
+
+
+def submit_dataset(directory, submit, key):
+    """Call submit(records) with an iterator over the whole dataset, unless
+    the identical dataset was already submitted under key. Returns True if it
+    was submitted.
+
+    The records are read one shard at a time as submit consumes them, so the
+    dataset is never held in memory by this side of the upload.
+    """
+
+    log = get_submission_log(directory)
+    manifest = load_manifest(directory)
+
+    if log.is_submitted(key, manifest["hash"]):
+        logger.info(
+            f"Skipping submission, dataset {manifest['hash'][:16]} was already submitted for {key}"
+        )
+        return False
+
+    submit(read_dataset(directory))
+    log.mark_submitted(key, manifest["hash"])
+
+    return True
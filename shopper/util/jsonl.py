@@ -0,0 +1,222 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import gzip
+import io
+import json
+import os
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Prefer the fastest JSON codec that is installed, falling back to the stdlib
+try:
+    import orjson
+
+    def loads(data):
+        return orjson.loads(data)
+
+    def dumps(obj):
+        return orjson.dumps(obj).decode("utf-8")
+
+    codec = "orjson"
+except ImportError:
+    try:
+        import ujson
+
+        def loads(data):
+            return ujson.loads(data)
+
+        def dumps(obj):
+            return ujson.dumps(obj, ensure_ascii=False)
+
+        codec = "ujson"
+    except ImportError:
+
+        def loads(data):
+            return json.loads(data)
+
+        def dumps(obj):
+            return json.dumps(obj, ensure_ascii=False)
+
+        codec = "json"
+
+# The parallel reader decodes ranges of about this many bytes, and keeps at
+# most two ranges per worker decoded or in flight ahead of the reader
+RANGE_SIZE = 16 * 1024 * 1024
+
+
+def open_file(filename, mode="r"):
+    """Open a text file, transparently handling .gz and .zst compression."""
+
+    text_mode = mode.replace("b", "").replace("t", "")
+
+    if filename.endswith(".gz"):
+        return gzip.open(filename, text_mode + "t", encoding="utf-8")
+
+    if filename.endswith(".zst"):
+        try:
+            import zstandard
+        except ImportError:
+            raise Exception(
+                f"Reading or writing '{filename}' requires the zstandard package"
+            )
+
+        if text_mode == "r":
+            stream = zstandard.ZstdDecompressor().stream_reader(
+                open(filename, "rb"), read_across_frames=True
+            )
+        else:
+            stream = zstandard.ZstdCompressor().stream_writer(
+                open(filename, text_mode + "b")
+            )
+        return io.TextIOWrapper(stream, encoding="utf-8")
+
+    return open(filename, text_mode, encoding="utf-8")
+
+
+def is_compressed(filename):
+    return filename.endswith(".gz") or filename.endswith(".zst")
+
+
+def read_jsonl(filename, workers=None, min_parallel_size=64 * 1024 * 1024):
+    """Yield the rows of a jsonl file.
+
+    When workers > 1 and the file is large and uncompressed, the file is split
+    into byte ranges on newline boundaries and each range is decoded in a
+    separate process. Rows are still yielded in file order.
+    """
+
+    if workers is None:
+        workers = int(os.environ.get("SHOPPER_JSONL_WORKERS", 1))
+
+    if (
+        workers > 1
+        and not is_compressed(filename)
+        and os.path.getsize(filename) >= min_parallel_size
+    ):
+        yield from read_jsonl_parallel(filename, workers)
+        return
+
+    with open_file(filename) as f:
+        for line in f:
+            if line.strip():
+                yield loads(line)
+
+
+def read_jsonl_parallel(filename, workers):
+    """Decode a jsonl file across a process pool, preserving row order.
+
+    Ranges are submitted as the reader consumes them rather than all at
+    once, so only a window of decoded ranges is ever held in memory.
+    """
+
+    count = max(workers * 4, os.path.getsize(filename) // RANGE_SIZE)
+    ranges = deque(split_on_newlines(filename, count))
+
+    logger.debug(f"Reading {filename} in {len(ranges)} ranges with {workers} workers")
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        while len(ranges) > 0 or len(pending) > 0:
+            while len(ranges) > 0 and len(pending) < workers * 2:
+                pending.append(pool.submit(read_range, filename, *ranges.popleft()))
+
+            yield from pending.popleft().result()
+
+
+def split_on_newlines(filename, count):
+    """Split a file into at most count byte ranges that end on newlines."""
+
+    size = os.path.getsize(filename)
+    step = max(1, size // count)
+
+    boundaries = [0]
+    with open(filename, "rb") as f:
+        while boundaries[-1] < size:
+            f.seek(min(boundaries[-1] + step, size))
+            f.readline()
+            boundaries.append(min(f.tell(), size))
+
+    return list(zip(boundaries[:-1], boundaries[1:]))
+
+
+def read_range(filename, start, end):
+    with open(filename, "rb") as f:
+        f.seek(start)
+        data = f.read(end - start)
+
+    return [loads(line) for line in data.splitlines() if line.strip()]
+
+
+def count_rows(filename):
+    """Count the rows in a jsonl file without decoding them."""
+
+    if not os.path.exists(filename):
+        return 0
+
+    if is_compressed(filename):
+        with open_file(filename) as f:
+            return sum(1 for line in f if line.strip())
+
+    count = 0
+    last_block = b""
+    with open(filename, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            count += block.count(b"\n")
+            last_block = block
+
+    # The final row may not be terminated by a newline
+    if len(last_block) > 0 and not last_block.endswith(b"\n"):
+        count += 1
+
+    return count
+
+
+class JsonlWriter:
+    """A buffered jsonl writer that flushes rows to disk in batches."""
+
+    def __init__(self, filename, mode="w", batch_size=1000):
+        self.filename = filename
+        self.batch_size = batch_size
+        self.buffer = []
+        self.file = open_file(filename, mode)
+
+    def write(self, row):
+        self.buffer.append(dumps(row))
+
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def write_all(self, rows):
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.file.write("\n".join(self.buffer) + "\n")
+            self.buffer = []
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_jsonl(filename, rows, mode="w", batch_size=1000):
+    """Write an iterable of rows to a jsonl file and return the row count."""
+
+    count = 0
+    with JsonlWriter(filename, mode=mode, batch_size=batch_size) as writer:
+        for row in rows:
+            writer.write(row)
+            count += 1
+
+    return count
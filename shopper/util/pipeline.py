@@ -0,0 +1,324 @@
+from shopper.util.jsonl import JsonlWriter, dumps, loads
+
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The shopper package, which code fingerprints are relative to
+PACKAGE_DIRECTORY = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Stage:
+    """One step of a pipeline, a shopper command with declared files.
+
+    inputs and outputs are files or directories. A stage depends on the
+    stages whose outputs it reads. A file that is both an input and an output
+    is state the stage keeps, such as a cache it reads and updates. code
+    lists the source files and packages,
+    relative to the shopper package, that decide what the stage produces.
+    env adds environment variables that do not change the outputs, such as
+    rate limits, so they are not part of the fingerprint.
+    """
+
+    def __init__(self, name, command, args=(), inputs=(), outputs=(), code=(), env={}):
+        self.name = name
+        self.command = command
+        self.args = [str(arg) for arg in args]
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.code = list(code)
+        self.env = dict(env)
+
+    def get_argv(self):
+        return [sys.executable, "-m", "shopper", self.command] + self.args
+
+
+class Pipeline:
+    """Runs the stages of a pipeline that are out of date.
+
+    A stage is fingerprinted from its command, arguments, code and the
+    content of its inputs. It is skipped if its fingerprint and outputs are
+    unchanged since it last succeeded. Stages run as soon as the stages they
+    depend on finish, up to jobs at a time, so independent branches run in
+    parallel. Fingerprints, file hashes and timings are kept in a json state
+    file, and every stage run is appended to a jsonl log next to it.
+
+    Stages resume from the outputs they find, so before a stage reruns
+    because its fingerprint changed, or because it is forced, its outputs
+    are moved aside to a .previous copy and it starts from scratch. Outputs
+    that are also inputs are kept in place.
+    """
+
+    def __init__(self, stages, state_filename, jobs=1):
+        self.stages = stages
+        self.state_filename = state_filename
+        self.jobs = jobs
+
+        self.state = {"stages": {}, "files": {}}
+        if os.path.exists(state_filename):
+            with open(state_filename) as f:
+                self.state = loads(f.read())
+
+        self.dependencies = self.get_dependencies()
+
+    def get_dependencies(self):
+        """The names of the stages that produce each stage's inputs."""
+        producers = {}
+        for stage in self.stages:
+            for output in stage.outputs:
+                producers[os.path.abspath(output)] = stage.name
+
+        dependencies = {}
+        for stage in self.stages:
+            dependencies[stage.name] = set(
+                producers[os.path.abspath(path)]
+                for path in stage.inputs
+                if os.path.abspath(path) in producers
+            )
+            dependencies[stage.name].discard(stage.name)
+
+        return dependencies
+
+    def run(self, force=(), dry_run=False):
+        """Run the out of date stages, returning one result per stage with
+        its status: ran, skipped, failed, blocked or, in a dry run, stale."""
+        status = {}
+        results = []
+        pending = list(self.stages)
+        running = {}
+
+        with ThreadPoolExecutor(max_workers=max(1, self.jobs)) as pool:
+            while len(pending) > 0 or len(running) > 0:
+                progress = False
+
+                for stage in list(pending):
+                    dependency_status = [status.get(name) for name in self.dependencies[stage.name]]
+
+                    if any(s in ("failed", "blocked") for s in dependency_status):
+                        pending.remove(stage)
+                        status[stage.name] = "blocked"
+                        results.append({"stage": stage.name, "status": "blocked"})
+                        progress = True
+                        continue
+
+                    if not all(s in ("ran", "skipped", "stale") for s in dependency_status):
+                        continue
+
+                    if len(running) >= max(1, self.jobs):
+                        break
+
+                    pending.remove(stage)
+                    progress = True
+
+                    # Upstream stages that will rerun change the inputs
+                    if "stale" in dependency_status:
+                        status[stage.name] = "stale"
+                        results.append({"stage": stage.name, "status": "stale"})
+                        continue
+
+                    fingerprint = self.get_fingerprint(stage)
+
+                    if stage.name not in force and self.is_up_to_date(stage, fingerprint):
+                        logger.info(f"Skipping stage '{stage.name}', it is up to date")
+                        status[stage.name] = "skipped"
+                        results.append({"stage": stage.name, "status": "skipped"})
+                        continue
+
+                    if dry_run:
+                        status[stage.name] = "stale"
+                        results.append({"stage": stage.name, "status": "stale"})
+                        continue
+
+                    if stage.name in force or self.is_changed(stage, fingerprint):
+                        self.rotate_outputs(stage)
+
+                    logger.info(f"Running stage '{stage.name}': {' '.join(stage.get_argv())}")
+                    running[pool.submit(run_stage, stage)] = (stage, fingerprint)
+
+                if len(running) == 0:
+                    if not progress and len(pending) > 0:
+                        raise Exception(
+                            f"Pipeline stages depend on each other in a cycle: "
+                            f"{[stage.name for stage in pending]}"
+                        )
+                    continue
+
+                if progress and len(running) < max(1, self.jobs):
+                    continue
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+
+                for future in done:
+                    stage, fingerprint = running.pop(future)
+                    result = self.finish_stage(stage, fingerprint, *future.result())
+                    status[stage.name] = result["status"]
+                    results.append(result)
+
+        return results
+
+    def finish_stage(self, stage, fingerprint, returncode, started, seconds):
+        result = {
+            "stage": stage.name,
+            "status": "ran" if returncode == 0 else "failed",
+            "started": started,
+            "seconds": seconds,
+            "returncode": returncode,
+            "fingerprint": fingerprint,
+        }
+
+        if returncode == 0:
+            logger.info(f"Stage '{stage.name}' finished in {seconds:.1f}s")
+
+            self.state["stages"][stage.name] = {
+                "fingerprint": fingerprint,
+                "outputs": self.get_output_hashes(stage),
+                "started": started,
+                "seconds": seconds,
+            }
+        else:
+            logger.error(f"Stage '{stage.name}' failed with exit code {returncode}")
+
+            # A failed stage may have changed its outputs, so always rerun it
+            self.state["stages"].pop(stage.name, None)
+
+        self.save_state()
+
+        with JsonlWriter(self.get_log_filename(), mode="a") as writer:
+            writer.write(result)
+
+        return result
+
+    def is_up_to_date(self, stage, fingerprint):
+        previous = self.state["stages"].get(stage.name)
+
+        if previous is None or previous["fingerprint"] != fingerprint:
+            return False
+
+        return previous["outputs"] == self.get_output_hashes(stage)
+
+    def is_changed(self, stage, fingerprint):
+        """Whether a stage last succeeded with a different fingerprint. A
+        stage that never succeeded may have been interrupted, and resumes."""
+        previous = self.state["stages"].get(stage.name)
+
+        return previous is not None and previous["fingerprint"] != fingerprint
+
+    def rotate_outputs(self, stage):
+        """Move a stage's outputs to .previous copies, replacing older ones."""
+        inputs = set(os.path.abspath(path) for path in stage.inputs)
+
+        for path in stage.outputs:
+            if os.path.abspath(path) in inputs or not os.path.exists(path):
+                continue
+
+            previous = path + ".previous"
+            if os.path.isdir(previous):
+                shutil.rmtree(previous)
+
+            logger.info(f"Moving the output of stage '{stage.name}' aside to {previous}")
+            os.replace(path, previous)
+
+    def get_fingerprint(self, stage):
+        """A hash of everything that decides what a stage produces.
+
+        Inputs the stage also writes are left out, since running the stage
+        changes them. They are covered by the output hashes instead.
+        """
+        outputs = set(os.path.abspath(path) for path in stage.outputs)
+
+        fingerprint = {
+            "command": stage.command,
+            "args": stage.args,
+            "inputs": {
+                path: self.hash_path(path)
+                for path in stage.inputs
+                if os.path.abspath(path) not in outputs
+            },
+            "code": {
+                path: self.hash_path(os.path.join(PACKAGE_DIRECTORY, path))
+                for path in stage.code
+            },
+        }
+
+        return hashlib.sha256(dumps(fingerprint).encode("utf-8")).hexdigest()
+
+    def get_output_hashes(self, stage):
+        return {path: self.hash_path(path) for path in stage.outputs}
+
+    def hash_path(self, path):
+        """The sha256 of a file, or of the relative paths and contents of the
+        files in a directory. None if the path does not exist."""
+        if os.path.isfile(path):
+            return self.hash_file(path)
+
+        if not os.path.isdir(path):
+            return None
+
+        hasher = hashlib.sha256()
+        for directory, directories, filenames in os.walk(path):
+            directories[:] = sorted(d for d in directories if d != "__pycache__")
+
+            for filename in sorted(filenames):
+                if filename.endswith((".pyc", ".tmp")):
+                    continue
+
+                filename = os.path.join(directory, filename)
+                hasher.update(os.path.relpath(filename, path).encode("utf-8"))
+                hasher.update(self.hash_file(filename).encode("utf-8"))
+
+        return hasher.hexdigest()
+
+    def hash_file(self, filename):
+        """The sha256 of a file, reused while its size and mtime are unchanged."""
+        stat = os.stat(filename)
+        key = os.path.abspath(filename)
+
+        cached = self.state["files"].get(key)
+        if (
+            cached is not None
+            and cached["size"] == stat.st_size
+            and cached["mtime_ns"] == stat.st_mtime_ns
+        ):
+            return cached["hash"]
+
+        hasher = hashlib.sha256()
+        with open(filename, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                hasher.update(chunk)
+
+        self.state["files"][key] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "hash": hasher.hexdigest(),
+        }
+
+        return self.state["files"][key]["hash"]
+
+    def save_state(self):
+        # Write a new file and swap it in, so an interrupted run never
+        # leaves a truncated state
+        with open(self.state_filename + ".tmp", "w") as f:
+            f.write(dumps(self.state))
+        os.replace(self.state_filename + ".tmp", self.state_filename)
+
+    def get_log_filename(self):
+        return os.path.splitext(self.state_filename)[0] + "-runs.jsonl"
+
+
+def run_stage(stage):
+    """Run a stage's command, returning its exit code, start time and seconds."""
+    started = time.time()
+    start = time.perf_counter()
+
+    returncode = subprocess.run(stage.get_argv(), env={**os.environ, **stage.env}).returncode
+
+    return returncode, started, time.perf_counter() - start
@@ -0,0 +1,319 @@
+from collections import Counter
+
+import atexit
+import cProfile
+import functools
+import io
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import tracemalloc
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+MODES = ("cprofile", "sample", "tracemalloc")
+
+
+def add_profile_arguments(parser):
+    """Add the common profiling flags to a CLI's argument parser."""
+
+    parser.add_argument(
+        "--profile",
+        help="Comma separated profilers to enable: cprofile, sample, tracemalloc. "
+        "Defaults to the SHOPPER_PROFILE environment variable.",
+        default=os.environ.get("SHOPPER_PROFILE"),
+    )
+
+    parser.add_argument(
+        "--profile-interval",
+        help="Seconds between wall clock stack samples.",
+        type=float,
+        default=float(os.environ.get("SHOPPER_PROFILE_INTERVAL", 0.01)),
+    )
+
+    parser.add_argument(
+        "--profile-top",
+        help="The number of entries in each profile report.",
+        type=int,
+        default=int(os.environ.get("SHOPPER_PROFILE_TOP", 30)),
+    )
+
+    parser.add_argument(
+        "--profile-threads",
+        help="Comma separated thread name prefixes to sample, e.g. MainThread. "
+        "Defaults to every thread.",
+        default=os.environ.get("SHOPPER_PROFILE_THREADS"),
+    )
+
+
+def start_profiling(args, output):
+    """Start profiling a CLI run if it was requested, writing the reports
+    next to output when the process exits.
+
+    args may be None for CLIs without flags, in which case only the
+    SHOPPER_PROFILE environment variable is consulted.
+    """
+
+    if args is not None and hasattr(args, "profile"):
+        modes, interval, top = args.profile, args.profile_interval, args.profile_top
+        threads = args.profile_threads
+    else:
+        modes = os.environ.get("SHOPPER_PROFILE")
+        interval = float(os.environ.get("SHOPPER_PROFILE_INTERVAL", 0.01))
+        top = int(os.environ.get("SHOPPER_PROFILE_TOP", 30))
+        threads = os.environ.get("SHOPPER_PROFILE_THREADS")
+
+    if not modes:
+        return None
+
+    profiler = Profiler(parse_modes(modes), interval=interval, top=top, threads=threads)
+    profiler.start()
+
+    atexit.register(profiler.write_reports, output)
+
+    return profiler
+
+
+def profile_methods(
+    target, method_names, output, modes="cprofile", interval=0.01, top=30, threads=None
+):
+    """Profile individual methods of a class or instance, for example
+
+        profile_methods(LaminiClassifier, ["train", "predict_proba"], "/tmp/classifier")
+
+    Every call to a wrapped method is accumulated into one profile, which is
+    written next to output when the process exits.
+    """
+
+    profiler = Profiler(parse_modes(modes), interval=interval, top=top, threads=threads)
+
+    for method_name in method_names:
+        method = getattr(target, method_name)
+        setattr(target, method_name, profiler.wrap(method))
+
+    atexit.register(profiler.write_reports, output)
+
+    return profiler
+
+
+def parse_modes(modes):
+    if isinstance(modes, str):
+        modes = [mode.strip() for mode in modes.split(",") if mode.strip()]
+
+    for mode in modes:
+        if mode not in MODES:
+            raise Exception(f"Unknown profiler '{mode}', expected one of {MODES}")
+
+    return list(modes)
+
+
+class Profiler:
+    """Runs any combination of cProfile, a wall clock stack sampler and
+    tracemalloc, accumulating across start/stop pairs.
+
+    cProfile only sees the thread that starts it, while the sampler sees
+    every thread, or those whose names start with one of threads.
+    """
+
+    def __init__(self, modes, interval=0.01, top=30, threads=None):
+        self.modes = modes
+        self.interval = interval
+        self.top = top
+
+        # Wrapped methods can run on several threads at once
+        self.lock = threading.Lock()
+        self.depth = 0
+        self.profile = cProfile.Profile() if "cprofile" in modes else None
+        self.sampler = StackSampler(interval, threads) if "sample" in modes else None
+        self.snapshot = None
+
+    def start(self):
+        # Wrapped methods may call each other, only the outermost call counts
+        with self.lock:
+            self.depth += 1
+            if self.depth == 1:
+                self.start_profilers()
+
+    def stop(self):
+        with self.lock:
+            self.depth -= 1
+            if self.depth == 0:
+                self.stop_profilers()
+
+    def start_profilers(self):
+        if self.profile is not None:
+            self.profile.enable()
+
+        if self.sampler is not None:
+            self.sampler.start()
+
+        if "tracemalloc" in self.modes and not tracemalloc.is_tracing():
+            tracemalloc.start()
+
+    def stop_profilers(self):
+        if self.profile is not None:
+            self.profile.disable()
+
+        if self.sampler is not None:
+            self.sampler.stop()
+
+        if "tracemalloc" in self.modes and tracemalloc.is_tracing():
+            self.snapshot = tracemalloc.take_snapshot()
+
+    def wrap(self, function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            self.start()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.stop()
+
+        return wrapper
+
+    def write_reports(self, output):
+        """Write one report per enabled profiler next to output."""
+
+        with self.lock:
+            if self.depth > 0:
+                self.depth = 0
+                self.stop_profilers()
+
+        reports = {}
+
+        if self.profile is not None:
+            stream = io.StringIO()
+            stream.write(
+                f"Only the {threading.current_thread().name} thread is profiled, work "
+                f"on other threads such as thread pools shows up as waits here. "
+                f"The sample profile covers every thread.\n\n"
+            )
+            stats = pstats.Stats(self.profile, stream=stream)
+            stats.sort_stats("cumulative").print_stats(self.top)
+            reports["cprofile"] = stream.getvalue()
+
+        if self.sampler is not None:
+            reports["sample"] = self.sampler.report(self.top)
+
+        if self.snapshot is not None:
+            reports["tracemalloc"] = format_snapshot(self.snapshot, self.top)
+
+        for mode, report in reports.items():
+            filename = f"{output}.{mode}.txt"
+            with open(filename, "w") as f:
+                f.write(report)
+            logger.info(f"Wrote {mode} profile to {filename}")
+
+
+class StackSampler:
+    """Samples the wall clock stacks of every thread at a fixed interval.
+
+    threads is an optional comma separated string or list of thread name
+    prefixes to sample. Each stack is rooted at its thread's name, with the
+    numbering of pool threads removed so that a pool is counted as one.
+    """
+
+    def __init__(self, interval, threads=None):
+        self.interval = interval
+        if isinstance(threads, str):
+            threads = [thread.strip() for thread in threads.split(",") if thread.strip()]
+        self.threads = tuple(threads) if threads else None
+        self.stacks = Counter()
+        self.samples = 0
+        self.ticks = 0
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        sampler_id = threading.get_ident()
+
+        while self.running:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == sampler_id:
+                    continue
+
+                name = names.get(thread_id, str(thread_id))
+                if self.threads is not None and not name.startswith(self.threads):
+                    continue
+
+                root = (f"thread {get_thread_group(name)}", "", 0)
+                self.stacks[(root,) + format_stack(frame)] += 1
+                self.samples += 1
+
+            self.ticks += 1
+            time.sleep(self.interval)
+
+    def report(self, top):
+        if self.samples == 0:
+            return "No samples collected\n"
+
+        # Time spent in each function, including its callees
+        functions = Counter()
+        for stack, count in self.stacks.items():
+            for function in set((name, filename) for name, filename, _ in stack):
+                functions[function] += count
+
+        report = (
+            f"{self.samples} thread samples in {self.ticks} ticks every {self.interval}s, "
+            f"threads: {', '.join(self.threads) if self.threads else 'all'}\n"
+            "Idle threads, such as pool workers waiting for work, are sampled too, "
+            "so shares are of every thread's time\n\n"
+        )
+        report += "Functions by share of wall clock samples:\n"
+        for (name, filename), count in functions.most_common(top):
+            report += f"{100 * count / self.samples:6.1f}% {name} ({filename})\n"
+
+        report += "\nMost common stacks, innermost frame last:\n"
+        for stack, count in self.stacks.most_common(top):
+            report += f"\n{100 * count / self.samples:6.1f}%\n"
+            for name, filename, line in stack:
+                report += f"    {name} ({filename}:{line})\n"
+
+        return report
+
+
+def get_thread_group(name):
+    """The name of a thread without the number of a pool thread, e.g.
+    ThreadPoolExecutor-0_3 is ThreadPoolExecutor-0."""
+    return re.sub(r"_\d+$", "", name)
+
+
+def format_stack(frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append((code.co_name, code.co_filename, frame.f_lineno))
+        frame = frame.f_back
+
+    return tuple(reversed(stack))
+
+
+def format_snapshot(snapshot, top):
+    statistics = snapshot.statistics("lineno")
+
+    total = sum(statistic.size for statistic in statistics)
+
+    report = f"{total / 1024 / 1024:.1f} MB allocated and still live\n\n"
+    report += "Top allocations by line:\n"
+    for statistic in statistics[:top]:
+        report += f"{statistic.size / 1024:10.1f} KB {statistic.count:8d} blocks {statistic.traceback}\n"
+
+    return report
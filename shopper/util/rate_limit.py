@@ -0,0 +1,316 @@
+from collections import deque
+from contextlib import contextmanager
+
+import atexit
+import functools
+import os
+import threading
+import time
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Lamini calls are limited separately for each of these endpoints
+ENDPOINTS = ("completion", "embedding")
+
+# Calls in flight per endpoint when nothing else is configured
+DEFAULT_MAX_IN_FLIGHT = 16
+
+
+class TokenBucket:
+    """A thread safe token bucket refilled at rate tokens per second.
+
+    Tokens are reserved in arrival order, so the bucket can go negative and
+    each caller sleeps until its own reservation is covered.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.capacity = burst if burst is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """Take tokens, sleeping until they are available. Returns the
+        seconds slept."""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+
+            wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+        if wait > 0:
+            time.sleep(wait)
+
+        return wait
+
+
+class FairSemaphore:
+    """A semaphore that hands released slots to waiters in arrival order, so
+    that a thread making call after call cannot starve the others."""
+
+    def __init__(self, value):
+        self.value = value
+        self.waiters = deque()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.value > 0 and len(self.waiters) == 0:
+                self.value -= 1
+                return
+
+            waiter = threading.Lock()
+            waiter.acquire()
+            self.waiters.append(waiter)
+
+        # Released by release, which hands over its slot
+        waiter.acquire()
+
+    def release(self):
+        with self.lock:
+            if len(self.waiters) > 0:
+                self.waiters.popleft().release()
+            else:
+                self.value += 1
+
+
+class EndpointLimiter:
+    """Limits the calls to one endpoint to a rate and a number in flight,
+    and records how long callers queue for them."""
+
+    def __init__(self, name, requests_per_second=None, burst=None, max_in_flight=None):
+        self.name = name
+        self.requests_per_second = requests_per_second
+        self.max_in_flight = max_in_flight
+
+        self.bucket = None
+        if requests_per_second:
+            self.bucket = TokenBucket(requests_per_second, burst=burst)
+
+        self.slots = None
+        if max_in_flight:
+            self.slots = FairSemaphore(max_in_flight)
+
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+        self.waited_calls = 0
+
+    @contextmanager
+    def limit(self, cost=1):
+        """Hold a slot and cost tokens for the duration of one call."""
+        start = time.perf_counter()
+
+        if self.slots is not None:
+            self.slots.acquire()
+
+        try:
+            if self.bucket is not None:
+                self.bucket.acquire(cost)
+
+            self.record_start(time.perf_counter() - start)
+
+            try:
+                yield
+            finally:
+                with self.lock:
+                    self.in_flight -= 1
+        finally:
+            if self.slots is not None:
+                self.slots.release()
+
+    def record_start(self, wait):
+        with self.lock:
+            self.calls += 1
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            self.total_wait += wait
+            self.max_wait = max(self.max_wait, wait)
+            self.waited_calls += 1 if wait > 0.001 else 0
+
+    def get_stats(self):
+        with self.lock:
+            return {
+                "calls": self.calls,
+                "requests_per_second": self.requests_per_second,
+                "max_in_flight": self.max_in_flight,
+                "peak_in_flight": self.peak_in_flight,
+                "waited_calls": self.waited_calls,
+                "total_wait": self.total_wait,
+                "mean_wait": self.total_wait / self.calls if self.calls > 0 else 0.0,
+                "max_wait": self.max_wait,
+            }
+
+
+class LimitedRunner:
+    """Wraps a lamini runner so that every call goes through the limiter of
+    an endpoint. Calling the runner, call, generate and train each count as
+    one request."""
+
+    def __init__(self, runner, endpoint="completion"):
+        self.runner = runner
+        self.endpoint = endpoint
+
+    def __call__(self, *args, **kwargs):
+        with limit(self.endpoint):
+            return self.runner(*args, **kwargs)
+
+    def __getattr__(self, name):
+        attribute = getattr(self.runner, name)
+
+        if name not in ("call", "generate", "train"):
+            return attribute
+
+        @functools.wraps(attribute)
+        def limited(*args, **kwargs):
+            with limit(self.endpoint):
+                return attribute(*args, **kwargs)
+
+        return limited
+
+
+limiters = {}
+limiters_lock = threading.Lock()
+
+
+def get_limiter(endpoint):
+    """The process wide limiter of an endpoint, configured from the
+    environment on first use."""
+    with limiters_lock:
+        if endpoint not in limiters:
+            limiters[endpoint] = EndpointLimiter(endpoint, **get_environment_limits(endpoint))
+
+        return limiters[endpoint]
+
+
+def configure_limiter(endpoint, requests_per_second=None, burst=None, max_in_flight=None):
+    """Replace the limiter of an endpoint. None or 0 leaves that limit off."""
+    if endpoint not in ENDPOINTS:
+        raise Exception(f"Unknown endpoint '{endpoint}', expected one of {ENDPOINTS}")
+
+    with limiters_lock:
+        limiters[endpoint] = EndpointLimiter(
+            endpoint,
+            requests_per_second=requests_per_second,
+            burst=burst,
+            max_in_flight=max_in_flight,
+        )
+
+        return limiters[endpoint]
+
+
+def limit(endpoint, cost=1):
+    """A context manager that holds one call to an endpoint, for example
+
+        with limit("embedding"):
+            embeddings = query_run_embedding(examples, config=config)
+    """
+    return get_limiter(endpoint).limit(cost)
+
+
+def limit_runner(runner, endpoint="completion"):
+    return LimitedRunner(runner, endpoint=endpoint)
+
+
+def get_rate_limit_stats():
+    with limiters_lock:
+        return {endpoint: limiter.get_stats() for endpoint, limiter in limiters.items()}
+
+
+def log_rate_limit_stats():
+    for endpoint, stats in get_rate_limit_stats().items():
+        if stats["calls"] == 0:
+            continue
+
+        logger.info(
+            f"{endpoint} calls: {stats['calls']}, {stats['waited_calls']} queued, "
+            f"mean wait {stats['mean_wait']:.3f}s, max wait {stats['max_wait']:.3f}s, "
+            f"peak in flight {stats['peak_in_flight']}"
+        )
+
+
+def get_environment_variable(endpoint, limit_name):
+    return f"SHOPPER_{endpoint.upper()}_{limit_name}"
+
+
+def get_environment_limits(endpoint):
+    """The limits of an endpoint from SHOPPER_<ENDPOINT>_RPS, _BURST and
+    _MAX_IN_FLIGHT."""
+
+    def read(limit_name, convert, default=None):
+        value = os.environ.get(get_environment_variable(endpoint, limit_name), "")
+        return convert(value) if value != "" else default
+
+    return {
+        "requests_per_second": read("RPS", float),
+        "burst": read("BURST", float),
+        "max_in_flight": read("MAX_IN_FLIGHT", int, DEFAULT_MAX_IN_FLIGHT),
+    }
+
+
+def add_rate_limit_arguments(parser):
+    """Add the per endpoint rate limit flags to a CLI's argument parser."""
+
+    for endpoint in ENDPOINTS:
+        limits = get_environment_limits(endpoint)
+
+        parser.add_argument(
+            f"--{endpoint}-rps",
+            help=f"The most {endpoint} requests per second, 0 for no limit. Defaults to "
+            f"the {get_environment_variable(endpoint, 'RPS')} environment variable.",
+            type=float,
+            default=limits["requests_per_second"],
+        )
+
+        parser.add_argument(
+            f"--{endpoint}-max-in-flight",
+            help=f"The most {endpoint} requests in flight at once, 0 for no limit. "
+            f"Defaults to the {get_environment_variable(endpoint, 'MAX_IN_FLIGHT')} "
+            f"environment variable or {DEFAULT_MAX_IN_FLIGHT}.",
+            type=int,
+            default=limits["max_in_flight"],
+        )
+
+
+def configure_rate_limits(args):
+    """Configure the limiters from the flags of add_rate_limit_arguments, and
+    log the queueing of every endpoint when the process exits."""
+
+    for endpoint in ENDPOINTS:
+        configure_limiter(
+            endpoint,
+            requests_per_second=getattr(args, f"{endpoint}_rps"),
+            burst=get_environment_limits(endpoint)["burst"],
+            max_in_flight=getattr(args, f"{endpoint}_max_in_flight"),
+        )
+
+    atexit.register(log_rate_limit_stats)
+
+
+def get_rate_limit_environment(args, processes=1):
+    """Environment variables that split the limits of args evenly between
+    processes running at the same time."""
+    environment = {}
+
+    for endpoint in ENDPOINTS:
+        requests_per_second = getattr(args, f"{endpoint}_rps")
+        if requests_per_second:
+            environment[get_environment_variable(endpoint, "RPS")] = str(
+                requests_per_second / processes
+            )
+
+        max_in_flight = getattr(args, f"{endpoint}_max_in_flight")
+        if max_in_flight:
+            environment[get_environment_variable(endpoint, "MAX_IN_FLIGHT")] = str(
+                max(1, max_in_flight // processes)
+            )
+
+    return environment